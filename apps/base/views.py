@@ -9,7 +9,9 @@ from django.shortcuts import render_to_response
 from django.template import RequestContext, loader
 from django.views.debug import get_safe_settings
 
-from jetpack.models import Package, SDK
+from jetpack import sdk_registry
+from jetpack.models import Package
+from xpi import artifacts
 import base.tasks
 from base.models import CeleryResponse
 
@@ -46,6 +48,8 @@ def site_settings(request):
 def monitor(request):
     status = True
     data = {}
+    # created with the first build
+    artifacts.makedirs(settings.XPI_TARGETDIR)
 
     filepaths = [
          (settings.UPLOAD_DIR, os.R_OK | os.W_OK, 'We want read + write.'),
@@ -56,7 +60,7 @@ def monitor(request):
                           'We want read + write. Should be a shared directory '
                           'on multiserver installations'))
 
-    for sdk in SDK.objects.all():
+    for sdk in sdk_registry.get_all():
         filepaths.append((sdk.get_source_dir(), os.R_OK,
                           'We want read on %s' % sdk.version),)
 
@@ -8,21 +8,26 @@ from django.conf import settings
 import commonware
 import cronjobs
 
+from xpi import artifacts
+
 log = commonware.log.getLogger('f.cron')
 
-def _prune_older_files(directory, age):
+def _prune_older_files(directory, age, exclude=()):
     """
     Analyzes a directory looking for files or directories older than `age`.
     Any found files will be removed.  `directory` should be an absolute
-    path, `age` a UNIX timestamp.
+    path, `age` a UNIX timestamp. Paths listed in `exclude` are skipped.
     """
 
     log.info('(GC) Pruning files older than (%s) from (%s)' % (age, directory))
 
     age = mktime((datetime.today() - age).timetuple())
+    exclude = set(os.path.realpath(path) for path in exclude if path)
 
     for filename in os.listdir(directory):
         filename = os.path.join(directory, filename)
+        if os.path.realpath(filename) in exclude:
+            continue
         if os.path.getmtime(filename) < age:
             log.debug('(GC) Removing: %s' % filename)
             try:
@@ -41,8 +46,15 @@ def gc():
 
     one_day_ago = timedelta(days=1)
 
-    if os.path.isdir(settings.XPI_TARGETDIR):
-        _prune_older_files(settings.XPI_TARGETDIR, one_day_ago)
+    # XPIs are evicted when stores outgrow their budgets, this only keeps
+    # the counted sizes right
+    for store in artifacts.get_stores():
+        artifacts.evict(store)
 
+    # leftovers of the builds, stores and caches are kept
     if os.path.isdir(settings.SDKDIR_PREFIX):
-        _prune_older_files(settings.SDKDIR_PREFIX, one_day_ago)
+        _prune_older_files(settings.SDKDIR_PREFIX, one_day_ago, exclude=[
+                settings.ARTIFACTS_ROOT, settings.LIBRARY_EXPORT_DIR,
+                settings.XPI_SEGMENT_DIR] + [
+                directory for directory, _ in
+                artifacts.get_stores().values()])
@@ -39,7 +39,8 @@ from utils import validator
 from utils.exceptions import SimpleException
 from utils.helpers import pathify, alphanum, alphanum_plus
 from utils.os_utils import make_path
-from xpi import xpi_utils
+from xpi import (assembler, engine, incremental, library_cache, status,
+                 tracing, xpi_utils)
 
 log = commonware.log.getLogger('f.jetpack')
 
@@ -161,11 +162,22 @@ class PackageRevision(BaseModel):
     def get_dir_name(self, packages_dir):
         return os.path.join(packages_dir, self.name)
 
+    def check_dir(self, packages_dir):
+        """
+        raise :class:`xpi.engine.PackageConflict` if package has the name of
+        an SDK package linked into packages - it would be written into the
+        SDK source
+        """
+        if xpi_utils.is_sdk_link(self.get_dir_name(packages_dir)):
+            raise engine.PackageConflict(
+                    "Package %s has the name of an SDK package" % self.name)
+
     def make_dir(self, packages_dir):
         """
         create package directories inside packages
         return package directory name
         """
+        self.check_dir(packages_dir)
         package_dir = self.get_dir_name(packages_dir)
         if not os.path.isdir(package_dir):
             os.mkdir(package_dir)
@@ -1132,6 +1144,29 @@ class PackageRevision(BaseModel):
 
         return self.sdk.kit_lib if self.sdk.kit_lib else self.sdk.core_lib
 
+    def get_build_fingerprint(self):
+        """Returns a hash of everything which affects the XPI built from
+        this revision - SDK, manifest, modules, attachments and all
+        dependencies (transitive)
+        """
+        digest = hashlib.sha1()
+        digest.update('sdk:%s:%s\n' % (self.sdk.version, self.sdk.dir))
+        self.update_build_digest(digest, sdk=self.sdk)
+        return digest.hexdigest()
+
+    def update_build_digest(self, digest, sdk=None):
+        " feeds digest with the content exported by ``export_files`` "
+        digest.update(self.get_manifest_json(sdk=sdk).encode('utf-8'))
+        for mod in self.modules.order_by('filename', 'pk'):
+            digest.update('\nmodule:%s\n' % mod.filename.encode('utf-8'))
+            digest.update(mod.code.encode('utf-8'))
+        for att in self.attachments.order_by('filename', 'ext', 'pk'):
+            digest.update('\nattachment:%s\n' %
+                          att.get_filename().encode('utf-8'))
+            xpi_utils.hash_file(digest, att.get_file_path())
+        for lib in self.dependencies.order_by('pk'):
+            lib.update_build_digest(digest, sdk=sdk)
+
     def build_xpi(self, modules=[], attachments=[], hashtag=None, rapid=False,
             tstart=None):
         """
@@ -1157,25 +1192,53 @@ class PackageRevision(BaseModel):
         if not tstart:
             tstart = time.time()
 
+        if modules or attachments:
+            tincremental = time.time()
+            response = incremental.rebuild(self, modules=modules,
+                    attachments=attachments, hashtag=hashtag, tstart=tstart)
+            if response:
+                tracing.add_span(hashtag, 'incremental', tincremental)
+                tracing.finish(hashtag)
+                return response
+
+        if settings.XPI_ASSEMBLER:
+            try:
+                response = assembler.build(self, modules=modules,
+                        attachments=attachments, hashtag=hashtag,
+                        tstart=tstart)
+            except Exception, err:
+                log.warning("[xpi:%s] Assembling failed, building with cfx: "
+                            "%s" % (hashtag, str(err)))
+                statsd.incr('xpi.build.assembler_failed')
+            else:
+                self._keep_xpi(response, hashtag, modules, attachments)
+                return response
+
         # sdk_dir = self.get_sdk_dir(hashtag)
         sdk_dir = tempfile.mkdtemp()
         sdk_source = self.sdk.get_source_dir()
 
-        # XPI: Copy files from NFS to local temp dir
-        xpi_utils.sdk_copy(sdk_source, sdk_dir)
-        t1 = (time.time() - tstart) * 1000
-        log.debug("[xpi:%s] SDK copied (time %dms)" % (hashtag, t1))
+        # XPI: Link SDK files from NFS in local temp dir
+        tsdk = time.time()
+        xpi_utils.sdk_workspace(sdk_source, sdk_dir)
+        t = tracing.add_span(hashtag, 'sdk', tsdk)
+        log.debug("[xpi:%s] SDK linked (time %dms)" % (hashtag, t))
 
         # TODO: check if it's still needed
         self.export_keys(sdk_dir)
 
         packages_dir = os.path.join(sdk_dir, 'packages')
+        try:
+            self.check_dir(packages_dir)
+        except engine.PackageConflict, err:
+            return self._fail_conflict(err, sdk_dir, hashtag)
         package_dir = self.make_dir(packages_dir)
         # XPI: create manifest (from memory to local)
         self.export_manifest(package_dir)
 
         # export modules with ability to use edited code (from modules var)
         # XPI: memory/database to local
+        tmodules = time.time()
         lib_dir = os.path.join(package_dir, self.get_lib_dir())
         for mod in self.modules.all():
             mod_edited = False
@@ -1185,12 +1248,13 @@ class PackageRevision(BaseModel):
                     e_mod.export_code(lib_dir)
             if not mod_edited:
                 mod.export_code(lib_dir)
-        t2 = (time.time() - (t1 / 1000) - tstart) * 1000
-        statsd.timing('xpi.build.modules', t2)
-        log.debug("[xpi:%s] modules exported (time %dms)" % (hashtag, t2))
+        t = tracing.add_span(hashtag, 'modules', tmodules)
+        statsd.timing('xpi.build.modules', t)
+        log.debug("[xpi:%s] modules exported (time %dms)" % (hashtag, t))
 
         # export atts with ability to use edited code (from attachments var)
         # XPI: memory/database/NFS to local
+        tattachments = time.time()
         data_dir = os.path.join(package_dir, self.get_data_dir())
         for att in self.attachments.all():
             att_edited = False
@@ -1200,19 +1264,47 @@ class PackageRevision(BaseModel):
                     e_att.export_code(data_dir)
             if not att_edited:
                 att.export_file(data_dir)
-        t3 = (time.time() - (t2 / 1000) - tstart) * 1000
-        statsd.timing('xpi.build.attachments', t3)
-        log.debug("[xpi:%s] attachments exported (time %dms)" % (hashtag, t3))
+        t = tracing.add_span(hashtag, 'attachments', tattachments)
+        statsd.timing('xpi.build.attachments', t)
+        log.debug("[xpi:%s] attachments exported (time %dms)" % (hashtag, t))
 
         # XPI: copying to local from memory/db/files
-        self.export_dependencies(packages_dir, sdk=self.sdk)
-        t4 = (time.time() - (t3 / 1000) - tstart) * 1000
-        statsd.timing('xpi.build.dependencies', t4)
-        log.debug("[xpi:%s] dependencies exported (time %dms)" % (hashtag, t4))
+        tdependencies = time.time()
+        try:
+            self.export_dependencies(packages_dir, sdk=self.sdk)
+        except engine.PackageConflict, err:
+            return self._fail_conflict(err, sdk_dir, hashtag)
+        t = tracing.add_span(hashtag, 'dependencies', tdependencies)
+        statsd.timing('xpi.build.dependencies', t)
+        log.debug("[xpi:%s] dependencies exported (time %dms)" % (hashtag, t))
 
         # XPI: building locally and copying to NFS
-        return xpi_utils.build(sdk_dir, self.get_dir_name(packages_dir),
-                self.name, hashtag, tstart=tstart)
+        response = xpi_utils.build(sdk_dir, self.get_dir_name(packages_dir),
+                self.name, hashtag, tstart=tstart, sdk_source=sdk_source)
+
+        self._keep_xpi(response, hashtag, modules, attachments)
+        return response
+
+    def _fail_conflict(self, err, sdk_dir, hashtag):
+        " fail the build of a package named like an SDK package "
+        log.warning("[xpi:%s] %s" % (hashtag, str(err)))
+        status.finish(hashtag, 'error', str(err))
+        tracing.finish(hashtag, error='conflict')
+        shutil.rmtree(sdk_dir)
+        return '', str(err)
+
+    def _keep_xpi(self, response, hashtag, modules, attachments):
+        """
+        keep the built XPI as a base of incremental test builds and store it
+        in the build cache if built from the saved data only
+        """
+        if response[1]:
+            return
+        xpi_path = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+        incremental.remember(self, xpi_path, modules=modules,
+                             attachments=attachments)
+        if not modules and not attachments:
+            xpi_utils.cache_xpi(xpi_path, self.get_build_fingerprint())
 
     def export_keys(self, sdk_dir):
         """Export private and public keys to file."""
@@ -1244,7 +1336,11 @@ class PackageRevision(BaseModel):
     def export_dependencies(self, packages_dir, sdk=None):
         """Creates dependency package directory for each dependency."""
         for lib in self.dependencies.all():
-            lib.export_files_with_dependencies(packages_dir, sdk=sdk)
+            lib.check_dir(packages_dir)
+            if library_cache.link(lib, packages_dir, sdk=sdk):
+                lib.export_dependencies(packages_dir, sdk=sdk)
+            else:
+                lib.export_files_with_dependencies(packages_dir, sdk=sdk)
 
     def export_files(self, packages_dir, sdk=None):
         """Calls all export functions - creates all packages files."""
@@ -2047,6 +2143,14 @@ exports.main = function() {};"""
 post_save.connect(save_first_revision, sender=Package)
 
 
+def invalidate_sdk_registry(**kwargs):
+    " SDK was added, changed or removed, see :mod:`jetpack.sdk_registry` "
+    from jetpack import sdk_registry
+    sdk_registry.invalidate()
+post_save.connect(invalidate_sdk_registry, sender=SDK)
+post_delete.connect(invalidate_sdk_registry, sender=SDK)
+
+
 def manage_empty_lib_dirs(instance, action, **kwargs):
     """
     create EmptyDirs when all modules in a "dir" are deleted,
@@ -0,0 +1,166 @@
+"""
+jetpack.sdk_registry
+--------------------
+
+In-process registry of the installed SDKs.
+
+Views listing SDKs, looking for the latest one or for the version of its
+Add-on Kit read :class:`SDKInfo` snapshots from the registry instead of
+querying the database and parsing ``package.json`` on every request. The
+registry is loaded on first use and dropped when an
+:class:`jetpack.models.SDK` is saved or deleted (``add_core_lib``,
+``force_sdk``, fixtures). The process dropping it stores a new generation
+in the Django cache, other processes reload the registry when they see it.
+Without a shared cache (e.g. ``DummyCache``) there is no generation,
+other processes compare the number and the highest id of SDKs in the
+database instead, at most every ``SDK_REGISTRY_CHECK_INTERVAL`` seconds.
+"""
+import os
+import simplejson
+import threading
+import time
+
+import commonware.log
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+log = commonware.log.getLogger('f.jetpack.sdk_registry')
+
+GENERATION_KEY = 'sdk_registry:generation'
+
+_lock = threading.Lock()
+_registry = {
+    'sdks': None,
+    'generation': None,
+    # (count, highest id) of SDKs in the database and when it was checked
+    'fingerprint': None,
+    'checked': 0,
+    # manifests of SDK sources which are not registered
+    'manifests': {}}
+
+
+def read_manifest(sdk_source_dir, name='addon-kit'):
+    " returns the parsed ``package.json`` of the SDK's package or None "
+    path = os.path.join(sdk_source_dir, 'packages', name, 'package.json')
+    try:
+        with open(path) as f:
+            return simplejson.load(f)
+    except (IOError, ValueError), err:
+        log.warning("Failed to read SDK manifest (%s): %s" % (path, str(err)))
+        return None
+
+
+class SDKInfo(object):
+    """Snapshot of the :class:`jetpack.models.SDK`
+
+    Holds the fields used by views and templates, the manifests of its
+    core library and the Add-on Kit and the revisions of both libraries.
+    """
+
+    def __init__(self, sdk):
+        self.id = self.pk = sdk.pk
+        self.version = sdk.version
+        self.dir = sdk.dir
+        self.source_dir = sdk.get_source_dir()
+        self.deprecated = sdk.is_deprecated()
+        self.core_name = sdk.core_lib.package.name
+        self.core_lib_id = sdk.core_lib_id
+        self.core_revision_number = sdk.core_lib.revision_number
+        self.kit_lib_id = sdk.kit_lib_id
+        self.kit_revision_number = (sdk.kit_lib.revision_number
+                                    if sdk.kit_lib else None)
+        self.manifests = {
+            self.core_name: read_manifest(self.source_dir, self.core_name),
+            'addon-kit': read_manifest(self.source_dir, 'addon-kit')}
+
+    def __unicode__(self):
+        return self.version
+
+    def get_source_dir(self):
+        return self.source_dir
+
+    def is_deprecated(self):
+        return self.deprecated
+
+    def get_manifest(self, name='addon-kit'):
+        return self.manifests.get(name)
+
+
+def _get_fingerprint():
+    from jetpack.models import SDK
+    data = SDK.objects.aggregate(count=Count('pk'), last=Max('pk'))
+    return (data['count'], data['last'])
+
+
+def _load():
+    from jetpack.models import SDK
+    sdks = [SDKInfo(sdk) for sdk in SDK.objects.select_related(
+            'core_lib', 'core_lib__package', 'kit_lib')]
+    log.debug("SDK registry loaded (%d SDKs)" % len(sdks))
+    return sdks
+
+
+def get_all():
+    """:returns: (list) :class:`SDKInfo` of all SDKs, the latest first (as
+    ordered by :class:`jetpack.models.SDK`)
+    """
+    generation = cache.get(GENERATION_KEY)
+    with _lock:
+        now = time.time()
+        if (_registry['sdks'] is not None and generation is None
+                and now - _registry['checked']
+                    >= settings.SDK_REGISTRY_CHECK_INTERVAL):
+            # no generation in the cache, SDKs might have changed in
+            # another process
+            _registry['checked'] = now
+            if _get_fingerprint() != _registry['fingerprint']:
+                _registry['sdks'] = None
+        if (_registry['sdks'] is None
+                or _registry['generation'] != generation):
+            _registry['fingerprint'] = _get_fingerprint()
+            _registry['checked'] = now
+            _registry['sdks'] = _load()
+            _registry['generation'] = generation
+            _registry['manifests'] = {}
+        return _registry['sdks']
+
+
+def get_latest():
+    " returns :class:`SDKInfo` of the latest SDK or None "
+    sdks = get_all()
+    return sdks[0] if sdks else None
+
+
+def get_manifest(sdk_source_dir, name='addon-kit'):
+    """returns the manifest of the package ``name`` of the SDK found in
+    ``sdk_source_dir``, it doesn't have to be a registered SDK (see
+    ``REPACKAGE_SDK_SOURCE``)
+    """
+    for sdk in get_all():
+        if sdk.source_dir == sdk_source_dir and name in sdk.manifests:
+            return sdk.get_manifest(name)
+    key = (sdk_source_dir, name)
+    # read under the lock, a manifest read before invalidate() must not be
+    # stored after it
+    with _lock:
+        manifest = _registry['manifests'].get(key)
+        if manifest is None:
+            manifest = read_manifest(sdk_source_dir, name)
+            if manifest is not None:
+                _registry['manifests'][key] = manifest
+    return manifest
+
+
+def invalidate(**kwargs):
+    """Drop the registry in this process and tell other processes to reload
+
+    Connected to ``post_save`` and ``post_delete`` of
+    :class:`jetpack.models.SDK`
+    """
+    with _lock:
+        _registry['sdks'] = None
+        _registry['manifests'] = {}
+    cache.set(GENERATION_KEY, time.time())
+    log.info("SDK registry invalidated")
@@ -0,0 +1,110 @@
+"""
+jetpack.tests.test_sdk_registry
+-------------------------------
+"""
+import os
+import shutil
+import simplejson
+import tempfile
+
+from mock import Mock
+from nose.tools import eq_
+from test_utils import TestCase
+
+from django.conf import settings
+
+from jetpack import sdk_registry
+from jetpack.models import PackageRevision, SDK
+
+
+class SDKRegistryTest(TestCase):
+    fixtures = ['mozilla_user', 'users', 'core_sdk', 'packages']
+
+    def setUp(self):
+        self.sdk = SDK.objects.get()
+        sdk_registry.invalidate()
+
+    def tearDown(self):
+        sdk_registry.invalidate()
+
+    def test_get_all(self):
+        sdks = sdk_registry.get_all()
+        eq_(len(sdks), 1)
+        eq_(sdks[0].id, self.sdk.id)
+        eq_(sdks[0].version, self.sdk.version)
+        eq_(sdks[0].get_source_dir(), self.sdk.get_source_dir())
+        eq_(sdks[0].core_revision_number, self.sdk.core_lib.revision_number)
+        eq_(sdk_registry.get_latest().id, self.sdk.id)
+
+    def test_loaded_once(self):
+        sdk_registry.get_all()
+        old_load = sdk_registry._load
+        sdk_registry._load = Mock(return_value=[])
+        try:
+            eq_(len(sdk_registry.get_all()), 1)
+            eq_(sdk_registry._load.call_count, 0)
+        finally:
+            sdk_registry._load = old_load
+
+    def test_reloaded_without_generation(self):
+        sdk_registry.get_all()
+        old_load = sdk_registry._load
+        old_fingerprint = sdk_registry._get_fingerprint
+        old_interval = settings.SDK_REGISTRY_CHECK_INTERVAL
+        old_cache = sdk_registry.cache
+        # SDK added by another process, generation is not shared
+        sdk_registry.cache = Mock()
+        sdk_registry.cache.get = Mock(return_value=None)
+        sdk_registry._load = Mock(return_value=[])
+        sdk_registry._get_fingerprint = Mock(return_value=(2, 1000))
+        settings.SDK_REGISTRY_CHECK_INTERVAL = 0
+        try:
+            eq_(sdk_registry.get_all(), [])
+            eq_(sdk_registry._load.call_count, 1)
+            # fingerprint didn't change since
+            sdk_registry.get_all()
+            eq_(sdk_registry._load.call_count, 1)
+        finally:
+            sdk_registry._load = old_load
+            sdk_registry._get_fingerprint = old_fingerprint
+            settings.SDK_REGISTRY_CHECK_INTERVAL = old_interval
+            sdk_registry.cache = old_cache
+
+    def test_invalidated_by_signal(self):
+        eq_(len(sdk_registry.get_all()), 1)
+        version = 'testsdk'
+        kit_lib = PackageRevision.objects.create(
+                author=self.sdk.kit_lib.author,
+                package=self.sdk.kit_lib.package,
+                revision_number=self.sdk.kit_lib.revision_number + 1,
+                version_name=version)
+        core_lib = PackageRevision.objects.create(
+                author=self.sdk.core_lib.author,
+                package=self.sdk.core_lib.package,
+                revision_number=self.sdk.core_lib.revision_number + 1,
+                version_name=version)
+        sdk = SDK.objects.create(
+                version=version,
+                kit_lib=kit_lib,
+                core_lib=core_lib,
+                dir='somefakedir')
+        sdks = sdk_registry.get_all()
+        eq_(len(sdks), 2)
+        eq_(sdk_registry.get_latest().id, sdk.id)
+        sdk.delete(purge=False)
+        eq_(len(sdk_registry.get_all()), 1)
+
+    def test_manifest_of_unregistered_sdk(self):
+        sdk_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(sdk_dir, 'packages', 'addon-kit'))
+            with open(os.path.join(
+                    sdk_dir, 'packages', 'addon-kit', 'package.json'),
+                    'w') as f:
+                simplejson.dump({'version': '1.0test'}, f)
+            eq_(sdk_registry.get_manifest(sdk_dir)['version'], '1.0test')
+        finally:
+            shutil.rmtree(sdk_dir)
+        # read once
+        eq_(sdk_registry.get_manifest(sdk_dir)['version'], '1.0test')
+        eq_(sdk_registry.get_manifest(sdk_dir, 'api-utils'), None)
@@ -31,6 +31,7 @@ from base.shortcuts import get_object_with_related_or_404
 from utils import validator
 from utils.helpers import pathify, render, render_json
 
+from jetpack import sdk_registry
 from jetpack.package_helpers import (get_package_revision,
         create_package_from_xpi)
 from jetpack.models import (Package, PackageRevision, Module, Attachment, SDK,
@@ -146,7 +147,7 @@ def edit(request, revision):
     sdk_list = None
     if revision.package.is_addon():
         library_counter += 1
-        sdk_list = SDK.objects.all()
+        sdk_list = sdk_registry.get_all()
 
     return render(request,
         "%s_edit.html" % revision.package.get_type_name(), {
@@ -0,0 +1,114 @@
+"""
+repackage.download_cache
+------------------------
+
+Local cache of XPIs downloaded for rebuilds, keyed by URL.
+
+Every cached XPI ``<key>.xpi`` has ``<key>.json`` with its URL, ``ETag``,
+``Last-Modified`` and SHA-256 digest. :meth:`Repackage.download` revalidates
+the cached file with a conditional request and reads it from disk if the
+server answers ``304 Not Modified``. The cache is a size-bounded store of
+:mod:`xpi.artifacts` (``REPACKAGE_DOWNLOAD_CACHE_MAX_SIZE``).
+"""
+import hashlib
+import os
+import shutil
+import simplejson
+import tempfile
+
+import commonware.log
+
+from django.conf import settings
+
+from xpi import artifacts
+
+log = commonware.log.getLogger('f.repackage.download_cache')
+
+CACHED_SCHEMES = ('http', 'https')
+
+
+def is_cacheable(location):
+    return (bool(settings.REPACKAGE_DOWNLOAD_CACHE_DIR)
+            and location.split(':', 1)[0].lower() in CACHED_SCHEMES)
+
+
+def _get_base(location):
+    return os.path.join(settings.REPACKAGE_DOWNLOAD_CACHE_DIR,
+                        hashlib.md5(location).hexdigest())
+
+
+def get(location):
+    """:returns: (dict) ``url``, ``etag``, ``last_modified``, ``sha256``,
+    ``size`` and ``path`` of the cached XPI or None
+    """
+    if not is_cacheable(location):
+        return None
+    base = _get_base(location)
+    try:
+        with open('%s.json' % base) as f:
+            meta = simplejson.load(f)
+    except (IOError, ValueError):
+        return None
+    meta['path'] = '%s.xpi' % base
+    if meta.get('url') != location or not os.path.isfile(meta['path']):
+        return None
+    return meta
+
+
+def get_headers(meta):
+    " returns headers of the request revalidating the cached XPI "
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def put(location, xpi_file, etag=None, last_modified=None, sha256=None,
+        size=None):
+    """Store the downloaded XPI
+
+    Only responses with a validator (``ETag`` or ``Last-Modified``) are
+    stored as only these can be revalidated.
+
+    :params:
+        * location (String) URL the XPI was downloaded from
+        * xpi_file (file) downloaded XPI, read from the current position
+        * etag, last_modified (String) validators sent by the server
+        * sha256 (String) hex digest of the XPI
+        * size (int) size of the XPI in bytes
+    """
+    if not is_cacheable(location) or not (etag or last_modified):
+        return
+    directory = settings.REPACKAGE_DOWNLOAD_CACHE_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    base = _get_base(location)
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(xpi_file, f, settings.REPACKAGE_CHUNK_SIZE)
+        os.rename(temp_path, '%s.xpi' % base)
+        with open('%s.json' % base, 'w') as f:
+            simplejson.dump({
+                'url': location,
+                'etag': etag,
+                'last_modified': last_modified,
+                'sha256': sha256,
+                'size': size}, f)
+    except Exception, err:
+        log.warning("Failed to cache XPI (%s): %s" % (location, str(err)))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    artifacts.add('download', '%s.xpi' % base)
+    log.debug("Cached XPI (%s)" % location)
+
+
+def remove(location):
+    " forget the cached XPI "
+    base = _get_base(location)
+    for path in ('%s.xpi' % base, '%s.json' % base):
+        if os.path.exists(path):
+            os.remove(path)
@@ -2,35 +2,143 @@
 repackage.helpers
 -----------------
 """
+import hashlib
 import os
-import rdflib
 import shutil
 import simplejson
 import tempfile
 import urllib2
 import zipfile
+import StringIO
+
+from xml.etree import cElementTree
 
 import commonware.log
+from statsd import statsd
+
 from django.conf import settings
 from django.http import Http404
 from django.template.defaultfilters import slugify
 
-from xpi import xpi_utils
+from repackage import download_cache
+from utils import exceptions
+from xpi import artifacts, xpi_utils
 
 log = commonware.log.getLogger('f.repackage')
 
+#: directories of a package stored in the XPI
+SECTIONS = ('lib', 'data', 'tests')
+#: packages provided by the SDK the XPI is rebuilt with
+SDK_DEPENDENCIES = ('addon-kit', 'api-utils')
+
+
+class XPITooBigException(exceptions.SimpleException):
+    """XPI is bigger than ``REPACKAGE_MAX_XPI_SIZE``
+    """
+
+
+class BadXPIException(exceptions.SimpleException):
+    """XPI would be extracted outside of the SDK's ``packages``
+    """
+
+
+def _read_chunks(f, chunk_size=None):
+    " iterate over the file-like object in chunks "
+    chunk_size = chunk_size or settings.REPACKAGE_CHUNK_SIZE
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+EM_NS = 'http://www.mozilla.org/2004/em-rdf#'
+#: attributes making a property element something else than a literal,
+#: RDF attributes are accepted without the namespace as well
+RDF_NODE_ATTRIBUTES = [prefix + name
+                       for name in ('resource', 'nodeID', 'parseType')
+                       for prefix in ('', '{%s}' % RDF_NS)]
+
+
+def read_install_rdf(install_rdf, fields):
+    """Read literal ``em:`` properties of the install manifest in one pass
+    of a streaming XML parser
+
+    Understands the layout written by the SDK - a ``Description`` of
+    ``urn:mozilla:install-manifest`` in the ``RDF`` element with properties
+    as its child elements or attributes.
+
+    :params:
+        * install_rdf (file) content of ``install.rdf``
+        * fields (list) names of the properties which have to be literals
+    :returns: (dict) ``{name: value}`` or None if the layout is different
+    """
+    properties = {}
+    description = '{%s}Description' % RDF_NS
+    em_prefix = '{%s}' % EM_NS
+    found = False
+    depth = 0
+    manifest_depth = None
+    for event, element in cElementTree.iterparse(install_rdf,
+                                                 ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if (depth == 2 and element.tag == description
+                    and (element.get('about') or
+                         element.get('{%s}about' % RDF_NS))
+                        == Extractor.manifest):
+                if found:
+                    # manifest described more than once
+                    return None
+                found = True
+                manifest_depth = depth
+                for key, value in element.attrib.items():
+                    if key.startswith(em_prefix):
+                        properties.setdefault(key[len(em_prefix):],
+                                              unicode(value))
+            continue
+        if (manifest_depth is not None and depth == manifest_depth + 1
+                and element.tag.startswith(em_prefix)):
+            name = element.tag[len(em_prefix):]
+            if len(element) or [attribute for attribute in RDF_NODE_ATTRIBUTES
+                                if attribute in element.attrib]:
+                if name in fields:
+                    return None
+            else:
+                properties.setdefault(name, unicode(element.text or u''))
+        if depth == manifest_depth:
+            manifest_depth = None
+        depth -= 1
+    return properties if found else None
+
 
 class Extractor(object):
     """Extracts manifest from ``install.rdf``
 
     modified ``Extractor`` class from ``zamboni/apps/versions/compare.py``
+
+    ``install.rdf`` is read with :func:`read_install_rdf`, ``rdflib`` is used
+    only if its layout is not the usual one.
     """
     manifest = u'urn:mozilla:install-manifest'
     ADDON_EXTENSION = '2'
-
-    def __init__(self, install_rdf):
-        self.rdf = rdflib.Graph().parse(install_rdf)
-        self.find_root()
+    #: properties read by :meth:`read_manifest`
+    FIELDS = ('id', 'type', 'name', 'version', 'homepageURL', 'description',
+              'creator', 'license', 'lib', 'data', 'tests', 'main')
+
+    def __init__(self, install_rdf, use_rdflib=False):
+        content = install_rdf.read()
+        self.rdf = None
+        self.properties = None
+        if not use_rdflib:
+            self.properties = read_install_rdf(StringIO.StringIO(content),
+                                               self.FIELDS)
+        if self.properties is None:
+            log.debug("Reading install.rdf with rdflib")
+            import rdflib
+            self.rdf = rdflib.Graph().parse(StringIO.StringIO(content))
+            self.find_root()
         # TODO: check if it's a JetPack addon
         self.data = {}
 
@@ -63,14 +171,15 @@ class Extractor(object):
         return self.data
 
     def uri(self, name):
-        namespace = 'http://www.mozilla.org/2004/em-rdf'
-        return rdflib.term.URIRef('%s#%s' % (namespace, name))
+        import rdflib
+        return rdflib.term.URIRef('%s%s' % (EM_NS, name))
 
     def find_root(self):
         # If the install-manifest root is well-defined, it'll show up when we
         # search for triples with it. If not, we have to find the context that
         # defines the manifest and use that as our root.
         # http://www.w3.org/TR/rdf-concepts/#section-triples
+        import rdflib
         manifest = rdflib.term.URIRef(self.manifest)
         if list(self.rdf.triples((manifest, None, None))):
             self.root = manifest
@@ -79,6 +188,8 @@ class Extractor(object):
 
     def find(self, name, ctx=None):
         """Like $() for install.rdf, where name is the selector."""
+        if self.rdf is None:
+            return self.properties.get(name)
         if ctx is None:
             ctx = self.root
         # predicate it maps to <em:{name}>.
@@ -94,6 +205,12 @@ class Repackage(object):
         """Downloads the XPI (from ``location``) and
         instantiates XPI in ``self.xpi_zip``
 
+        The XPI is streamed to a temporary file, download is aborted with
+        :class:`XPITooBigException` as soon as it's known to be bigger than
+        ``REPACKAGE_MAX_XPI_SIZE``. XPIs downloaded over HTTP are kept in
+        :mod:`repackage.download_cache` and downloaded again only if they
+        were modified.
+
         This eventually will record statistics about build times
 
         :param: location (String) location of the file to download rebuild
@@ -103,10 +220,20 @@ class Repackage(object):
         """
 
         log.info("Downloading file to rebuild from (%s)" % location)
+        cached = download_cache.get(location)
+        request = location
+        if cached:
+            request = urllib2.Request(location,
+                    headers=download_cache.get_headers(cached))
         try:
-            xpi_remote_file = urllib2.urlopen(location,
+            xpi_remote_file = urllib2.urlopen(request,
                     timeout=settings.URLOPEN_TIMEOUT)
         except IOError, err:
+            if cached and getattr(err, 'code', None) == 304:
+                if self._read_cached(cached):
+                    return
+                # cached XPI is broken and removed, download it again
+                return self.download(location)
             log.warning("Downloading XPI (%s) for rebuild failed\n(%s)" %
                     (location, str(err)))
             raise
@@ -124,20 +251,89 @@ class Repackage(object):
                     raise Http404
 
         # zipfile doesn't work on the urllib filelike entities
-        self.xpi_temp = tempfile.TemporaryFile()
-        self.xpi_temp.write(xpi_remote_file.read())
-        self.xpi_zip = zipfile.ZipFile(self.xpi_temp)
-        xpi_remote_file.close()
+        try:
+            info = {}
+            if hasattr(xpi_remote_file, 'info'):
+                info = xpi_remote_file.info()
+            length = info.get('Content-Length')
+            if length and length.isdigit():
+                self._check_size(int(length), location)
+            self._store(_read_chunks(xpi_remote_file), location)
+            if download_cache.is_cacheable(location):
+                self.xpi_temp.seek(0)
+                download_cache.put(location, self.xpi_temp,
+                        etag=info.get('ETag'),
+                        last_modified=info.get('Last-Modified'),
+                        sha256=self.xpi_hash, size=self.xpi_size)
+        finally:
+            xpi_remote_file.close()
+
+    def _read_cached(self, cached):
+        """Use the XPI from the download cache
+
+        :param: cached (dict) see :func:`repackage.download_cache.get`
+        :returns: (bool) False if the cached XPI is broken
+        """
+        try:
+            with open(cached['path'], 'rb') as f:
+                self._store(_read_chunks(f), cached['url'])
+        except (IOError, zipfile.BadZipfile), err:
+            # the file might have been evicted after it was found
+            log.warning("Cached XPI (%s) is broken: %s" % (
+                        cached['url'], str(err)))
+            download_cache.remove(cached['url'])
+            return False
+        if cached.get('sha256') and cached['sha256'] != self.xpi_hash:
+            log.warning("Cached XPI (%s) does not match its hash" %
+                        cached['url'])
+            self.cleanup()
+            download_cache.remove(cached['url'])
+            return False
+        artifacts.touch(cached['path'])
+        log.debug("XPI not modified, using cached file (%s)" % cached['url'])
+        statsd.incr('repackage.download.not_modified')
+        return True
 
     def retrieve(self, xpi_from):
         """Handles upload
 
         :param: xpi_from (element of request.FILES)
         """
+        self._check_size(xpi_from.size, xpi_from.name)
+        self._store(xpi_from.chunks(settings.REPACKAGE_CHUNK_SIZE),
+                    xpi_from.name)
+
+    def _check_size(self, size, source):
+        max_size = settings.REPACKAGE_MAX_XPI_SIZE
+        if max_size and size > max_size:
+            log.warning("XPI (%s) is too big to rebuild (%d bytes)" % (
+                        source, size))
+            raise XPITooBigException(
+                    "XPI is bigger than %d bytes" % max_size)
+
+    def _store(self, chunks, source):
+        """Write ``chunks`` of the XPI to a temporary file, stop as soon as
+        it's bigger than ``REPACKAGE_MAX_XPI_SIZE``
+
+        Sets ``self.xpi_temp``, ``self.xpi_zip``, ``self.xpi_size`` and
+        ``self.xpi_hash`` (SHA-256 hex digest of the XPI). The temporary
+        file is closed if anything fails.
+        """
+        digest = hashlib.sha256()
+        size = 0
         self.xpi_temp = tempfile.TemporaryFile()
-        for chunk in xpi_from.chunks():
-            self.xpi_temp.write(chunk)
-        self.xpi_zip = zipfile.ZipFile(self.xpi_temp)
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                self._check_size(size, source)
+                digest.update(chunk)
+                self.xpi_temp.write(chunk)
+            self.xpi_zip = zipfile.ZipFile(self.xpi_temp)
+        except:
+            self.xpi_temp.close()
+            raise
+        self.xpi_size = size
+        self.xpi_hash = digest.hexdigest()
 
     def rebuild(self, sdk_source_dir, hashtag, package_overrides={}):
         """Drive the rebuild process
@@ -152,7 +348,7 @@ class Repackage(object):
         log.debug("[%s] Rebuilding XPI" % hashtag)
         response = xpi_utils.build(sdk_dir,
                 os.path.join(sdk_dir, 'packages', self.manifest['name']),
-                self.manifest['name'], hashtag)
+                self.manifest['name'], hashtag, sdk_source=sdk_source_dir)
         log.debug("[%s] Done rebuilding XPI; cleaning up" % hashtag)
         # clean up (sdk_dir is already removed)
         self.cleanup()
@@ -180,57 +376,84 @@ class Repackage(object):
         # add default dependency
         self.manifest['dependencies'] = ['addon-kit']
 
+    def index_packages(self):
+        """Parse the member list of the XPI once
+
+        Package files are stored in ``resources/<prefix>-<package>-<section>/``
+        directories of the XPI, where section is one of :data:`SECTIONS`.
+        Files of SDK packages are not indexed.
+
+        :returns: (list) ``[(package name, {section: [(ZipInfo, path)]})]``
+                  in order of the first appearance of the package, ``path`` is
+                  relative to the section directory
+        """
+        members = self.xpi_zip.infolist()
+        resource_dir_prefix = "resources/%s-" % (
+                self.manifest['id'].split('@')[0].lower())
+        # SDK 1.0 changed the resource naming convention
+        resource_dir_prefix_1 = "resources/%s-" % (
+                self.manifest['id'].lower().replace('@', '-at-'))
+        for member in members:
+            if member.filename.startswith(resource_dir_prefix_1):
+                resource_dir_prefix = resource_dir_prefix_1
+                break
+        prefix_length = len(resource_dir_prefix)
+
+        packages = []
+        index = {}
+        for member in members:
+            if not member.filename.startswith(resource_dir_prefix):
+                continue
+            resource_dir, _, path = member.filename[
+                    prefix_length:].partition('/')
+            package_name, _, section = resource_dir.rpartition('-')
+            if (not package_name or section not in SECTIONS
+                    or package_name in SDK_DEPENDENCIES):
+                continue
+            if package_name not in index:
+                index[package_name] = {}
+                packages.append((package_name, index[package_name]))
+            index[package_name].setdefault(section, []).append(
+                    (member, path))
+        return packages
+
     def extract_packages(self, sdk_source_dir):
         """Builds SDK environment and calls the :method:`xpi.xpi_utils.build`
 
+        Files of the add-on and its dependencies are streamed from the XPI
+        into the ``packages`` directory (see :meth:`index_packages`).
+
         :returns: temporary sdk_dir
         """
-
-        def get_package_dir(dir_name, current_package_name):
-            #returns the target path to the lib, data etc. dirs
-            return os.path.join(sdk_dir, 'packages', current_package_name,
-                    self.manifest[dir_name])
-
         # create temporary directory for SDK
         sdk_dir = tempfile.mkdtemp()
-        for d in os.listdir(sdk_source_dir):
-            s_d = os.path.join(sdk_source_dir, d)
-            if os.path.isdir(s_d):
-                shutil.copytree(s_d, os.path.join(sdk_dir, d))
-            else:
-                shutil.copy(s_d, sdk_dir)
-        sdk_dependencies = ['addon-kit', 'api-utils']
+        xpi_utils.sdk_workspace(sdk_source_dir, sdk_dir)
         package_name = self.manifest['name']
-        resource_dir_prefix = "resources/%s-" % (
-                self.manifest['id'].split('@')[0].lower())
-        # SDK 1.0 changed the resource naming convention
-        resource_dir_prefix_1 = "resources/%s-" % (
-                self.manifest['id'].lower().replace('@', '-at-'))
-        # help lists to collect dependencies
-        exporting = []
+        packages_dir = os.path.join(sdk_dir, 'packages')
         dependencies = []
-
-        def _extract(f, name, resource_dir_prefix):
-            # extract only package files
-            if name not in f or resource_dir_prefix not in f:
-                return
-            # get current package name from directory name (f)
-            current_package_name = '-'.join(f.split(
-                resource_dir_prefix)[1].split('/')[0].split('-')[:-1])
-            # do not extract SDK libs
-            if current_package_name in sdk_dependencies:
-                return
-
-            # create lib, data and tests directories
-            if (current_package_name, name) not in exporting:
-                # create appropriate directory
-                os.makedirs(get_package_dir(name, current_package_name))
-                exporting.append((current_package_name, name))
-
-            if (current_package_name != package_name
-                    and current_package_name not in dependencies):
+        created = set()
+
+        def makedirs(path):
+            if path not in created:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                created.add(path)
+
+        def get_package_dir(name):
+            path = os.path.join(packages_dir, name)
+            if os.path.dirname(os.path.normpath(path)) != packages_dir:
+                raise BadXPIException("Invalid package name (%s)" % name)
+            # never write into the SDK source
+            if xpi_utils.unlink_package(path):
+                log.info("Package %s of the XPI overrides the SDK one" % name)
+            return path
+
+        for current_package_name, sections in self.index_packages():
+            current_package_dir = get_package_dir(current_package_name)
+            if current_package_name != package_name:
                 # collect info about exported dependencies
                 dependencies.append(current_package_name)
+                makedirs(current_package_dir)
                 # export package.json
                 try:
                     p_meta = self.harness_options['metadata'].get(
@@ -239,45 +462,43 @@ class Repackage(object):
                     log.error("No metadata about dependency "
                             "(%s) required by (%s)\n%s" % (
                             current_package_name, package_name, str(err)))
-                    return
-                with open(os.path.join(sdk_dir, 'packages',
-                    current_package_name, 'package.json'),
-                        'w') as manifest:
-                    manifest.write(simplejson.dumps(p_meta))
-
-            # create aprropriate subdirectories and export files
-            resource_dir = lambda x: "%s%s-%s/" % (
-                    resource_dir_prefix, current_package_name, x)
-            if f.startswith(resource_dir(name)) and f != resource_dir(name):
-                f_name = "%s/%s" % (
-                        get_package_dir(name, current_package_name),
-                        f.split(resource_dir(name))[1])
-                # if f is a directory, create it only
-                if f.endswith('/'):
-                    if not os.path.isdir(f_name):
-                        os.makedirs(f_name)
-                    return
-                # if directory does not exist - cxreate it
-                parent_dir = '/'.join(f_name.split('/')[:-1])
-                if not os.path.isdir(parent_dir):
-                    os.makedirs(parent_dir)
-                # export file
-                with open(f_name, 'w') as f_file:
-                    f_file.write(self.xpi_zip.open(f).read())
-
-        for f in self.xpi_zip.namelist():
-            if resource_dir_prefix != resource_dir_prefix_1:
-                if resource_dir_prefix_1 in f:
-                    resource_dir_prefix = resource_dir_prefix_1
-            for name in ['lib', 'data', 'tests']:
-                _extract(f, name, resource_dir_prefix)
+                else:
+                    with open(os.path.join(current_package_dir,
+                            'package.json'), 'w') as manifest:
+                        manifest.write(simplejson.dumps(p_meta))
+
+            for section, members in sections.items():
+                section_dir = os.path.join(current_package_dir,
+                                           self.manifest[section])
+                makedirs(section_dir)
+                for member, path in members:
+                    if not path:
+                        continue
+                    f_name = os.path.normpath(os.path.join(section_dir,
+                                                           path))
+                    if not f_name.startswith(current_package_dir + os.sep):
+                        raise BadXPIException(
+                                "Invalid file name (%s)" % member.filename)
+                    # if member is a directory, create it only
+                    if path.endswith('/'):
+                        makedirs(f_name.rstrip('/'))
+                        continue
+                    makedirs(os.path.dirname(f_name))
+                    # export file
+                    source = self.xpi_zip.open(member)
+                    try:
+                        with open(f_name, 'wb') as f_file:
+                            shutil.copyfileobj(source, f_file,
+                                               settings.REPACKAGE_CHUNK_SIZE)
+                    finally:
+                        source.close()
         # Add all dependencies to the manifest
         self.manifest['dependencies'].extend(dependencies)
 
         # create add-on's package.json
-        with open(os.path.join(
-                sdk_dir, 'packages', package_name, 'package.json'),
-                'w') as manifest:
+        package_dir = get_package_dir(package_name)
+        makedirs(package_dir)
+        with open(os.path.join(package_dir, 'package.json'), 'w') as manifest:
             manifest.write(simplejson.dumps(self.manifest))
         return sdk_dir
 
@@ -2,24 +2,106 @@
 repackage.models
 ----------------
 """
-import os
-import shutil
-import simplejson
-import tempfile
-import urllib
-import zipfile
+import datetime
+import hashlib
 
 import commonware.log
 
-#from django.conf import settings
-from django.http import Http404
-from django.template.defaultfilters import slugify
+from django.db import models
 
-#from base.models import BaseModel
-from xpi import xpi_utils
-
-from repackage.helpers import Extractor
+from base.models import BaseModel
 
 log = commonware.log.getLogger('f.repackage')
 
 
+class BatchJob(BaseModel):
+    """Bulk rebuild identified by the ``uuid`` sent by AMO
+
+    Resubmitted jobs are matched by ``uuid``, items which are already
+    rebuilt are not queued again.
+    """
+    uuid = models.CharField(max_length=255, unique=True)
+    sdk_version = models.CharField(max_length=10, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.uuid
+
+    def get_progress(self):
+        """:returns: (dict) number of items in every state, ``progress``
+        (finished items / all items) and ``throughput`` (finished items per
+        minute since the job was created)
+        """
+        states = dict((state, 0) for state, _ in BatchItem.STATES)
+        for item in self.items.values('state').annotate(
+                count=models.Count('id')):
+            states[item['state']] = item['count']
+        total = sum(states.values())
+        finished = states['done'] + states['failed']
+        last = self.items.filter(finished_at__isnull=False).aggregate(
+                last=models.Max('finished_at'))['last']
+        throughput = None
+        if last and last > self.created_at:
+            elapsed = last - self.created_at
+            minutes = (elapsed.days * 24 * 60 * 60 + elapsed.seconds) / 60.0
+            throughput = finished / minutes if minutes else None
+        return {
+            'uuid': self.uuid,
+            'total': total,
+            'states': states,
+            'progress': float(finished) / total if total else 0,
+            'throughput': throughput,
+            'created_at': self.created_at.isoformat(),
+            'last_finished_at': last.isoformat() if last else None}
+
+
+class BatchItem(BaseModel):
+    """Add-on of the :class:`BatchJob`
+
+    ``key`` identifies the add-on within the job (see :meth:`get_key`)
+    """
+    STATES = (
+        ('queued', 'queued'),
+        ('running', 'running'),
+        ('done', 'done'),
+        ('failed', 'failed'))
+
+    job = models.ForeignKey(BatchJob, related_name='items')
+    key = models.CharField(max_length=32)
+    hashtag = models.CharField(max_length=255)
+    state = models.CharField(max_length=10, choices=STATES, default='queued')
+    message = models.TextField(blank=True, default='')
+    modified_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ('job', 'key')
+
+    def __unicode__(self):
+        return '%s:%s' % (self.job_id, self.hashtag)
+
+    @staticmethod
+    def get_key(location=None, upload_hash=None):
+        """returns the key of the add-on given by location or upload
+
+        Uploads are identified by the SHA-256 of their content, different
+        files of the same name are different add-ons
+        """
+        if location:
+            return hashlib.md5('location:%s' % location).hexdigest()
+        return hashlib.md5('upload:%s' % upload_hash).hexdigest()
+
+    @classmethod
+    def set_state(cls, pk, state, message=''):
+        """Update the state of the item without loading it
+
+        Called from rebuild tasks, it's fine if the item does not exist
+        """
+        fields = {
+            'state': state,
+            'message': message,
+            'modified_at': datetime.datetime.now()}
+        if state in ('done', 'failed'):
+            fields['finished_at'] = fields['modified_at']
+        cls.objects.filter(pk=pk).update(**fields)
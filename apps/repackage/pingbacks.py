@@ -0,0 +1,191 @@
+"""
+repackage.pingbacks
+-------------------
+
+Delivery of rebuild results to the pingback URL.
+
+Results are posted by :meth:`repackage.tasks.deliver_pingbacks` running on
+its own queue, so build workers never wait for the receiver. Results sent
+to the same URL within ``REPACKAGE_PINGBACK_WINDOW`` seconds are collected
+in the cache (see :func:`queue`) and delivered by a single task. Every
+delivery thread keeps one persistent HTTP connection per receiver and
+posts all collected results over it. Results which were not delivered
+because the receiver was not reachable or failed (5xx) are queued again
+with an exponential backoff, results refused by the receiver (4xx) are
+dropped.
+"""
+import hashlib
+import httplib
+import socket
+import threading
+import time
+import urllib
+
+from urlparse import urlparse
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = commonware.log.getLogger('f.repackage.pingbacks')
+
+# connections of the current thread, (scheme, host, port) -> HTTPConnection
+_local = threading.local()
+
+
+class PingbackError(Exception):
+    " Receiver did not accept the result "
+
+    def __init__(self, message, status=None):
+        super(PingbackError, self).__init__(message)
+        self.status = status
+
+    @property
+    def permanent(self):
+        " receiver refused the result, it makes no sense to post it again "
+        return bool(self.status) and 400 <= self.status < 500
+
+
+def _get_connections():
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+    return _local.connections
+
+
+def _get_connection(scheme, netloc):
+    connections = _get_connections()
+    key = (scheme, netloc)
+    if key not in connections:
+        connection_class = (httplib.HTTPSConnection if scheme == 'https'
+                            else httplib.HTTPConnection)
+        connections[key] = connection_class(
+                netloc, timeout=settings.URLOPEN_TIMEOUT)
+    return connections[key]
+
+
+def _close_connection(scheme, netloc):
+    connection = _get_connections().pop((scheme, netloc), None)
+    if connection:
+        connection.close()
+
+
+def _get_window_key(url, window):
+    return 'repackage:pingbacks:%s:%d' % (hashlib.md5(url.encode('utf-8')).hexdigest(),
+                                          window)
+
+
+def queue(url, data):
+    """Collect ``data`` with other results sent to ``url`` in the current
+    window
+
+    :returns: (int) window which has to be delivered by the caller after
+              :func:`get_countdown` (first result of the window), 0 if
+              it's delivered already, None if results can't be collected
+              (cache is not shared or ``CELERY_ALWAYS_EAGER``)
+    """
+    if not settings.REPACKAGE_PINGBACK_WINDOW or settings.CELERY_ALWAYS_EAGER:
+        return None
+    window = int(time.time() / settings.REPACKAGE_PINGBACK_WINDOW)
+    key = _get_window_key(url, window)
+    timeout = settings.REPACKAGE_PINGBACK_WINDOW * 10
+    cache.add(key, 0, timeout)
+    try:
+        number = cache.incr(key)
+    except ValueError:
+        return None
+    cache.set('%s:%d' % (key, number), data, timeout)
+    return window if number == 1 else 0
+
+
+def get_countdown(window):
+    """returns seconds to wait before delivering the ``window``, results
+    being queued at its end are included
+    """
+    tend = (window + 2) * settings.REPACKAGE_PINGBACK_WINDOW
+    return max(0, tend - time.time())
+
+
+def take(url, window):
+    " returns results collected in the ``window`` and forgets them "
+    key = _get_window_key(url, window)
+    number = cache.get(key) or 0
+    keys = ['%s:%d' % (key, i) for i in range(1, number + 1)]
+    results = cache.get_many(keys)
+    cache.delete_many(keys + [key])
+    return [results[k] for k in keys if k in results]
+
+
+def post(url, data):
+    """Post ``data`` to the ``url`` over the persistent connection
+
+    A connection closed by the receiver in the meantime is opened again.
+
+    :params:
+        * url (String) pingback URL
+        * data (dict) result of the rebuild
+    :raises: :class:`PingbackError`, ``httplib.HTTPException``,
+             ``socket.error``
+    """
+    parsed = urlparse(url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path = '%s?%s' % (path, parsed.query)
+    body = urllib.urlencode(data)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    for attempt in (1, 2):
+        connection = _get_connection(parsed.scheme, parsed.netloc)
+        try:
+            connection.request('POST', path, body, headers)
+            response = connection.getresponse()
+            # response has to be read before the connection is reused
+            response.read()
+        except (httplib.HTTPException, socket.error):
+            _close_connection(parsed.scheme, parsed.netloc)
+            if attempt == 2:
+                raise
+            continue
+        if response.will_close:
+            _close_connection(parsed.scheme, parsed.netloc)
+        if response.status >= 400:
+            raise PingbackError("Pingback (%s) responded with %d" % (
+                                url, response.status), response.status)
+        return
+
+
+def deliver(url, results):
+    """Post every result to the ``url``
+
+    :returns: (list) results which were not delivered and should be posted
+              again
+    """
+    failed = []
+    for i, data in enumerate(results):
+        tstart = time.time()
+        try:
+            post(url, data)
+        except PingbackError, err:
+            if err.permanent:
+                log.error("%s, dropped" % str(err))
+                statsd.incr('repackage.pingback.refused')
+                continue
+            log.warning(str(err))
+            statsd.incr('repackage.pingback.failed')
+            failed.append(data)
+            continue
+        except Exception, err:
+            # receiver is not reachable, do not wait for it with the rest
+            log.warning("Pingback (%s) failed: %s" % (url, str(err)))
+            statsd.incr('repackage.pingback.failed', len(results) - i)
+            failed.extend(results[i:])
+            break
+        statsd.timing('repackage.pingback.time',
+                      (time.time() - tstart) * 1000)
+        statsd.incr('repackage.pingback.delivered')
+    return failed
+
+
+def get_backoff(attempt):
+    " returns the countdown (seconds) before the next delivery attempt "
+    return settings.REPACKAGE_PINGBACK_BACKOFF * 2 ** attempt
@@ -1,28 +1,44 @@
 import commonware.log
 import os.path
-import urllib
-import urllib2
+import time
 
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
 from celery.decorators import task
+from statsd import statsd
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from xpi.xpi_utils import info_write
+from django.db import connection
+from xpi import engine, scheduler, status
 
+from repackage import pingbacks as delivery
 from repackage.helpers import Repackage
+from repackage.models import BatchItem
 
 log = commonware.log.getLogger('f.repackage.tasks')
 
 
-@task(rate_limit='5/m')
+def _bulk(func):
+    " record the bulk task picked up from the queue, then call ``func`` "
+    def run(*args, **kwargs):
+        scheduler.started('bulk', kwargs.pop('user', None),
+                          kwargs.pop('tqueued', None))
+        return func(*args, **kwargs)
+    return run
+
+
+@task
 def low_rebuild(*args, **kwargs):
     """A wrapper for :meth:`download_and_rebuild` needed to create
     different route in celery for low priority rebuilds
     https://bugzilla.mozilla.org/show_bug.cgi?id=656978
+
+    Queued in the ``bulk`` class by :func:`xpi.scheduler.enqueue`, runs
+    within its share
     """
     log.info("Starting low priority package rebuild...")
-    return rebuild(*args, **kwargs)
+    return scheduler.run(low_rebuild, 'bulk', _bulk(rebuild), args, kwargs)
 
 
 @task(rate_limit='30/m')
@@ -35,9 +51,160 @@ def high_rebuild(*args, **kwargs):
     return rebuild(*args, **kwargs)
 
 
+@task
+def batch_rebuild(*args, **kwargs):
+    """A wrapper for :meth:`rebuild_batch` queued in the ``bulk`` class by
+    :func:`xpi.scheduler.enqueue`, a batch takes one slot of its share
+    """
+    return scheduler.run(batch_rebuild, 'bulk', _bulk(rebuild_batch), args,
+                         kwargs)
+
+
+def rebuild_batch(addons, sdk_source_dir, pingback=None, post=None,
+        **kwargs):
+    """Rebuild a batch of add-ons downloaded from their locations
+
+    Add-ons are rebuilt by ``REPACKAGE_BATCH_CONCURRENCY`` threads, the
+    ``cfx`` runs are subprocesses or jobs of the pre-forked build pool
+    (``XPI_BUILD_POOL_ADDRESS``) and run in parallel. Every subprocess
+    imports the SDK again, only the pool has it loaded once per process.
+    Builds in process (``XPI_BUILD_IN_PROCESS`` without the pool) share the
+    SDK loaded once before the batch, but :mod:`xpi.engine` runs one
+    ``cfx`` at a time, so they are rebuilt one by one without threads. The
+    result of every add-on is queued for delivery to ``pingback`` as soon
+    as it is rebuilt. If the batch itself fails, add-ons which were not
+    rebuilt are reported as failed.
+
+    :params:
+        * addons (list) dicts with ``location``, ``hashtag``, ``filename``
+          and ``package_overrides`` of every add-on
+        * sdk_source_dir (String) absolute path of the SDK
+        * pingback (String) URL to pass the results
+        * post (String) urlified ``request.POST``
+
+    :returns: (list) ``cfx xpi`` response of every add-on, None if its
+              rebuild failed
+    """
+    tstart = time.time()
+    log.info("Starting batch rebuild of %d add-ons..." % len(addons))
+    # hashtags of add-ons which were rebuilt or failed on their own
+    finished = set()
+
+    def rebuild_addon(addon):
+        try:
+            return rebuild(addon['location'], None, sdk_source_dir,
+                    addon['hashtag'],
+                    package_overrides=addon.get('package_overrides', {}),
+                    filename=addon.get('filename'), pingback=pingback,
+                    post=post, batch_item=addon.get('batch_item'))
+        except Exception, err:
+            # reported by rebuild, other add-ons of the batch continue
+            log.warning("[%s] Rebuild in batch failed: %s" % (
+                addon['hashtag'], str(err)))
+            return None
+        finally:
+            finished.add(addon['hashtag'])
+
+    def rebuild_addon_in_thread(addon):
+        try:
+            return rebuild_addon(addon)
+        finally:
+            # every thread opens its own database connection
+            connection.close()
+
+    try:
+        if (settings.XPI_BUILD_IN_PROCESS
+                and not settings.XPI_BUILD_POOL_ADDRESS):
+            if not engine.is_warm(sdk_source_dir):
+                # load the SDK once for the whole batch
+                engine.warm(sdk_source_dir)
+            # cfx runs in process are serialized by the engine
+            responses = map(rebuild_addon, addons)
+        else:
+            pool = ThreadPool(min(settings.REPACKAGE_BATCH_CONCURRENCY,
+                                  len(addons)) or 1)
+            try:
+                responses = pool.map(rebuild_addon_in_thread, addons)
+            finally:
+                pool.close()
+                pool.join()
+    except Exception, err:
+        log.error("Batch rebuild of %d add-ons failed: %s" % (
+                  len(addons), str(err)))
+        for addon in addons:
+            if addon['hashtag'] not in finished:
+                _fail_addon(addon, err, pingback)
+        raise
+    failed = len([r for r in responses if r is None or r[1]])
+    log.info("Finished batch rebuild of %d add-ons (%d failed) in %dms" % (
+        len(addons), failed, (time.time() - tstart) * 1000))
+    return responses
+
+
+@task
+def deliver_pingbacks(url, results, attempt=0, **kwargs):
+    """Post rebuild results to the pingback ``url``
+
+    Runs on its own queue (see ``CELERY_ROUTES``). Undelivered results are
+    queued again with exponential backoff up to
+    ``REPACKAGE_PINGBACK_RETRIES`` times.
+
+    :params:
+        * url (String) pingback URL
+        * results (list) dicts posted to the ``url``
+        * attempt (int) number of previous attempts
+    """
+    failed = delivery.deliver(url, results)
+    if not failed:
+        return
+    if attempt < settings.REPACKAGE_PINGBACK_RETRIES:
+        countdown = delivery.get_backoff(attempt)
+        log.info("Retrying %d pingbacks (%s) in %ds" % (
+                 len(failed), url, countdown))
+        statsd.incr('repackage.pingback.retried', len(failed))
+        deliver_pingbacks.apply_async(args=[url, failed],
+                kwargs={'attempt': attempt + 1}, countdown=countdown)
+    else:
+        log.error("Dropping %d pingbacks (%s) after %d attempts" % (
+                  len(failed), url, attempt + 1))
+        statsd.incr('repackage.pingback.dropped', len(failed))
+
+
+@task
+def deliver_queued_pingbacks(url, window, **kwargs):
+    " post results sent to the pingback ``url`` within the ``window`` "
+    results = delivery.take(url, window)
+    if results:
+        deliver_pingbacks(url, results)
+
+
+def _send_pingback(url, data):
+    """queue delivery of the result, results sent to the same ``url`` in
+    ``REPACKAGE_PINGBACK_WINDOW`` are delivered together
+    """
+    window = delivery.queue(url, data)
+    if window is None:
+        deliver_pingbacks.delay(url, [data])
+    elif window:
+        deliver_queued_pingbacks.apply_async(args=[url, window],
+                countdown=delivery.get_countdown(window))
+
+
+def _fail_addon(addon, err, pingback=None):
+    " report the add-on of the failed batch which was not rebuilt "
+    status.finish(addon['hashtag'], 'error', str(err))
+    if addon.get('batch_item'):
+        BatchItem.set_state(addon['batch_item'], 'failed', str(err))
+    if pingback:
+        _send_pingback(pingback, {
+            'secret': settings.AMO_SECRET_KEY,
+            'result': 'failure',
+            'msg': str(err)})
+
+
 def rebuild(location, upload, sdk_source_dir, hashtag,
         package_overrides={}, filename=None, pingback=None, post=None,
-        **kwargs):
+        batch_item=None, **kwargs):
     """creates a Repackage instance, downloads xpi and rebuilds it
 
     :params:
@@ -48,13 +215,15 @@ def rebuild(location, upload, sdk_source_dir, hashtag,
         * filename (String) desired filename for the downloaded ``XPI``
         * pingback (String) URL to pass the result
         * post (String) urlified ``request.POST``
+        * batch_item (int) id of the tracked :class:`BatchItem`
         * kwargs is just collecting the task decorator overhead
 
     :returns: (list) ``cfx xpi`` response where ``[0]`` is ``stdout`` and
               ``[1]`` ``stderr``
     """
+    if batch_item:
+        BatchItem.set_state(batch_item, 'running')
     rep = Repackage()
-    info_path = '%s.json' % os.path.join(settings.XPI_TARGETDIR, hashtag)
     data = {
         'secret': settings.AMO_SECRET_KEY,
         'result': 'failure'}
@@ -63,13 +232,14 @@ def rebuild(location, upload, sdk_source_dir, hashtag,
         try:
             rep.download(location)
         except Exception, err:
-            info_write(info_path, 'error', str(err), hashtag)
+            status.finish(hashtag, 'error', str(err))
+            if batch_item:
+                BatchItem.set_state(batch_item, 'failed', str(err))
             log.warning("%s: Error in downloading xpi (%s)\n%s" % (hashtag,
                 location, str(err)))
             if pingback:
                 data['msg'] = str(err)
-                urllib2.urlopen(pingback, data=urllib.urlencode(data),
-                        timeout=settings.URLOPEN_TIMEOUT)
+                _send_pingback(pingback, data)
             raise
         log.debug("[%s] XPI file downloaded (%s)" % (hashtag, location))
         if not filename:
@@ -81,13 +251,14 @@ def rebuild(location, upload, sdk_source_dir, hashtag,
         try:
             rep.retrieve(upload)
         except Exception, err:
-            info_write(info_path, 'error', str(err), hashtag)
+            status.finish(hashtag, 'error', str(err))
+            if batch_item:
+                BatchItem.set_state(batch_item, 'failed', str(err))
             log.warning("%s: Error in retrieving xpi (%s)\n%s" % (hashtag,
                 upload, str(err)))
             if pingback:
                 data['msg'] = str(err)
-                urllib2.urlopen(pingback, data=urllib.urlencode(data),
-                        timeout=settings.URLOPEN_TIMEOUT)
+                _send_pingback(pingback, data)
             raise
         log.debug("[%s] XPI file retrieved from upload" % hashtag)
         if not filename:
@@ -95,19 +266,26 @@ def rebuild(location, upload, sdk_source_dir, hashtag,
 
     else:
         log.error("[%s] No location or upload provided" % hashtag)
+        if batch_item:
+            BatchItem.set_state(batch_item, 'failed',
+                                "No location or upload provided")
         raise ValueError("No location or upload provided")
 
     try:
         response = rep.rebuild(sdk_source_dir, hashtag, package_overrides)
     except Exception, err:
-        info_write(info_path, 'error', str(err), hashtag)
+        status.finish(hashtag, 'error', str(err))
+        if batch_item:
+            BatchItem.set_state(batch_item, 'failed', str(err))
         log.warning("%s: Error in rebuilding xpi (%s)" % (hashtag, str(err)))
         if pingback:
             data['msg'] = str(err)
-            urllib2.urlopen(pingback, data=urllib.urlencode(data),
-                    timeout=settings.URLOPEN_TIMEOUT)
+            _send_pingback(pingback, data)
         raise
     log.debug('[%s] Response from rebuild: %s' % (hashtag, str(response)))
+    if batch_item:
+        BatchItem.set_state(batch_item,
+                'failed' if response[1] else 'done', response[1] or '')
 
     if pingback:
         data.update({
@@ -118,8 +296,7 @@ def rebuild(location, upload, sdk_source_dir, hashtag,
                 reverse('jp_download_xpi', args=[hashtag, filename]))})
         if post:
             data['request'] = post
-        urllib2.urlopen(pingback, data=urllib.urlencode(data),
-                timeout=settings.URLOPEN_TIMEOUT)
+        _send_pingback(pingback, data)
         log.debug('[%s] Pingback: %s' % (hashtag, pingback))
     log.info("[%s] Finished package rebuild." % hashtag)
     return response
@@ -0,0 +1,100 @@
+"""
+repackage.tests.test_download_cache
+-----------------------------------
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import urllib2
+
+from nose.tools import eq_
+from utils.test import TestCase
+
+from django.conf import settings
+
+from repackage import download_cache
+from repackage.helpers import Repackage
+
+OLDURLOPEN = urllib2.urlopen
+LOCATION = 'http://example.com/addon.xpi'
+
+
+class DownloadCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache_dir = settings.REPACKAGE_DOWNLOAD_CACHE_DIR
+        settings.REPACKAGE_DOWNLOAD_CACHE_DIR = tempfile.mkdtemp()
+        self.sample = os.path.join(settings.ROOT,
+                'apps/xpi/tests/sample_addons/sample_add-on-1.0rc2.xpi')
+        with open(self.sample, 'rb') as f:
+            self.sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    def tearDown(self):
+        urllib2.urlopen = OLDURLOPEN
+        shutil.rmtree(settings.REPACKAGE_DOWNLOAD_CACHE_DIR)
+        settings.REPACKAGE_DOWNLOAD_CACHE_DIR = self.cache_dir
+
+    def _put(self, etag='"abc"'):
+        with open(self.sample, 'rb') as f:
+            download_cache.put(LOCATION, f, etag=etag, sha256=self.sha256)
+
+    def test_put_and_get(self):
+        self._put()
+        cached = download_cache.get(LOCATION)
+        eq_(cached['etag'], '"abc"')
+        eq_(cached['sha256'], self.sha256)
+        eq_(os.path.getsize(cached['path']), os.path.getsize(self.sample))
+        eq_(download_cache.get_headers(cached), {'If-None-Match': '"abc"'})
+
+    def test_not_cacheable(self):
+        assert not download_cache.is_cacheable('file://%s' % self.sample)
+        # responses without validators are not stored
+        self._put(etag=None)
+        eq_(download_cache.get(LOCATION), None)
+
+    def test_not_modified(self):
+        self._put()
+        requests = []
+
+        def urlopen(request, **kwargs):
+            requests.append(request)
+            raise urllib2.HTTPError(LOCATION, 304, 'Not Modified', {}, None)
+
+        urllib2.urlopen = urlopen
+        rep = Repackage()
+        rep.download(LOCATION)
+        eq_(rep.xpi_hash, self.sha256)
+        eq_(requests[0].get_header('If-none-match'), '"abc"')
+        rep.cleanup()
+
+    def test_broken_cached_file(self):
+        self._put()
+        with open(download_cache.get(LOCATION)['path'], 'wb') as f:
+            f.write('broken')
+        self._download_again()
+
+    def test_evicted_cached_file(self):
+        self._put()
+        # evicted while revalidating
+        self._download_again(evict=True)
+
+    def _download_again(self, evict=False):
+        responses = [urllib2.HTTPError(LOCATION, 304, 'Not Modified', {},
+                                       None),
+                     open(self.sample, 'rb')]
+
+        def urlopen(request, **kwargs):
+            if evict and download_cache.get(LOCATION):
+                os.remove(download_cache.get(LOCATION)['path'])
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        urllib2.urlopen = urlopen
+        rep = Repackage()
+        rep.download(LOCATION)
+        eq_(rep.xpi_hash, self.sha256)
+        eq_(responses, [])
+        rep.cleanup()
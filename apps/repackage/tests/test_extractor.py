@@ -0,0 +1,96 @@
+"""
+repackage.tests.test_extractor
+------------------------------
+
+Parity of the streaming ``install.rdf`` reader with ``rdflib``
+"""
+import os
+import zipfile
+import StringIO
+
+from nose.tools import eq_
+from utils.test import TestCase
+
+from django.conf import settings
+
+from repackage.helpers import Extractor
+
+MANIFEST_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<%(rdf)sRDF xmlns%(ns)s="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <%(rdf)sDescription %(rdf)sabout="urn:mozilla:install-manifest"%(attrs)s>
+%(properties)s
+    <em:targetApplication>
+      <%(rdf)sDescription>
+        <em:id>{ec8030f7-c20a-464f-9b0e-13a3a9e97384}</em:id>
+        <em:minVersion>4.0</em:minVersion>
+        <em:maxVersion>7.0a1</em:maxVersion>
+      </%(rdf)sDescription>
+    </em:targetApplication>
+  </%(rdf)sDescription>
+</%(rdf)sRDF>
+"""
+
+PROPERTIES = """
+    <em:id>addon@example.com</em:id>
+    <em:version>1.0.1</em:version>
+    <em:type>2</em:type>
+    <em:name>Example &amp; Co</em:name>
+    <em:description>Za\xc5\xbc\xc3\xb3\xc5\x82\xc4\x87 g\xc4\x99\xc5\x9bl\xc4\x85 ja\xc5\xba\xc5\x84</em:description>
+    <em:creator>Jane Doe &lt;jane@example.com&gt;</em:creator>
+    <em:homepageURL>http://example.com/</em:homepageURL>
+    <em:iconURL/>
+"""
+
+
+def _manifest(rdf='', properties=PROPERTIES, attrs=''):
+    return MANIFEST_TEMPLATE % {
+        'rdf': '%s:' % rdf if rdf else '',
+        'ns': ':%s' % rdf if rdf else '',
+        'attrs': attrs,
+        'properties': properties}
+
+
+class ExtractorParityTest(TestCase):
+
+    def _compare(self, content, fast=True):
+        extracted = Extractor(StringIO.StringIO(content))
+        eq_(extracted.rdf is None, fast)
+        expected = Extractor(StringIO.StringIO(content), use_rdflib=True)
+        eq_(extracted.read_manifest(), expected.read_manifest())
+        for name in Extractor.FIELDS:
+            eq_(extracted.find(name), expected.find(name))
+
+    def test_sample_addons(self):
+        samples_dir = os.path.join(settings.ROOT,
+                                   'apps/xpi/tests/sample_addons')
+        for sample in os.listdir(samples_dir):
+            xpi = zipfile.ZipFile(os.path.join(samples_dir, sample))
+            self._compare(xpi.read('install.rdf'))
+
+    def test_default_namespace(self):
+        self._compare(_manifest())
+
+    def test_prefixed_namespace(self):
+        self._compare(_manifest(rdf='RDF'))
+
+    def test_property_attributes(self):
+        self._compare(_manifest(rdf='RDF', properties='',
+            attrs=' em:id="addon@example.com" em:version="2.0" em:name="A"'))
+
+    def test_missing_properties(self):
+        self._compare(_manifest(properties='<em:id>a@b</em:id>'))
+
+    def test_resource_property_uses_rdflib(self):
+        self._compare(_manifest(properties=PROPERTIES.replace(
+            '<em:homepageURL>http://example.com/</em:homepageURL>',
+            '<em:homepageURL resource="http://example.com/"/>')),
+            fast=False)
+
+    def test_typed_manifest_node_uses_rdflib(self):
+        content = _manifest().replace(
+            '<Description about="urn:mozilla:install-manifest">',
+            '<em:Manifest about="urn:mozilla:install-manifest">', 1)
+        content = content.replace('</Description>\n</RDF>',
+                                  '</em:Manifest>\n</RDF>')
+        self._compare(content, fast=False)
@@ -3,6 +3,7 @@ repackage.tests.test_models
 ---------------------------
 """
 import commonware
+import hashlib
 import os
 import tempfile
 import urllib2
@@ -14,7 +15,7 @@ from utils.test import TestCase
 from django.conf import settings
 
 from base.templatetags.base_helpers import hashtag
-from repackage.helpers import Repackage
+from repackage.helpers import Repackage, XPITooBigException
 
 log = commonware.log.getLogger('f.tests')
 
@@ -63,3 +64,40 @@ class RepackageTest(TestCase):
             rep.download(os.path.join(self.xpi_file_prefix, sample))
             rep.get_manifest({'version': 'force.version'})
         eq_(rep.manifest['version'], 'force.version')
+
+    def test_download_hash_and_size(self):
+        rep = Repackage()
+        rep.download(os.path.join(self.xpi_file_prefix,
+                                  self.sample_addons[0]))
+        with open(os.path.join(self.file_prefix,
+                               self.sample_addons[0])) as f:
+            content = f.read()
+        eq_(rep.xpi_size, len(content))
+        eq_(rep.xpi_hash, hashlib.sha256(content).hexdigest())
+        rep.cleanup()
+
+    def test_download_too_big(self):
+        max_size = settings.REPACKAGE_MAX_XPI_SIZE
+        settings.REPACKAGE_MAX_XPI_SIZE = 1024
+        try:
+            rep = Repackage()
+            self.assertRaises(XPITooBigException,
+                    rep.download,
+                    os.path.join(self.xpi_file_prefix, self.sample_addons[0]))
+        finally:
+            settings.REPACKAGE_MAX_XPI_SIZE = max_size
+
+    def test_index_packages(self):
+        rep = Repackage()
+        rep.download(os.path.join(self.xpi_file_prefix,
+                                  'sample_add-on-1.0rc2.xpi'))
+        rep.get_manifest()
+        packages = dict(rep.index_packages())
+        assert 'sample_add-on' in packages
+        assert 'addon-kit' not in packages
+        assert 'api-utils' not in packages
+        sections = packages['sample_add-on']
+        eq_(sorted(sections.keys()), ['data', 'lib'])
+        eq_(sorted(path for member, path in sections['lib']),
+            ['', 'a.js', 'a/a.js', 'a/b/b.js', 'main.js'])
+        rep.cleanup()
@@ -4,25 +4,29 @@ repackage.tests.test_tasks
 """
 import commonware
 import os
-import simplejson
 import tempfile
 import urllib2
-import urlparse
 import zipfile
 
 from django.conf import settings
+from django.core.cache import get_cache
 from django.core.urlresolvers import reverse
 
-from mock import Mock
+from mock import Mock, patch
 from nose.tools import eq_
 from utils.test import TestCase
 
 from base.templatetags.base_helpers import hashtag
-from repackage.tasks import rebuild
+from repackage import pingbacks
+from repackage.models import BatchJob, BatchItem
+from repackage.tasks import batch_rebuild, deliver_pingbacks, rebuild
+from xpi import status
 
 log = commonware.log.getLogger('f.repackage')
 
+cache = get_cache('locmem://')
 OLDURLOPEN = urllib2.urlopen
+OLDPOST = pingbacks.post
 
 class RepackageTaskTest(TestCase):
 
@@ -43,10 +47,10 @@ class RepackageTaskTest(TestCase):
 
     def tearDown(self):
         urllib2.urlopen = OLDURLOPEN
+        pingbacks.post = OLDPOST
         if os.path.exists('%s.xpi' % self.target_basename):
             os.remove('%s.xpi' % self.target_basename)
-        if os.path.exists('%s.json' % self.target_basename):
-            os.remove('%s.json' % self.target_basename)
+        status.clear(self.hashtag)
 
     def test_download_and_rebuild(self):
         rep_response = rebuild(
@@ -56,26 +60,25 @@ class RepackageTaskTest(TestCase):
                 self.sdk_source_dir, self.hashtag)
         assert not rep_response[1]
 
+    @patch('xpi.status.cache', cache)
     def test_download_and_failed_rebuild(self):
         with tempfile.NamedTemporaryFile() as bad_xpi:
             urllib2.urlopen = Mock(return_value=open(bad_xpi.name))
+            pingbacks.post = Mock()
             self.assertRaises(Exception,
                     rebuild,
                     'file://%s' % bad_xpi.name, None, self.sdk_source_dir,
                     self.hashtag,
                     pingback='test_pingback')
-        assert os.path.exists('%s.json' % self.target_basename)
-        response_json = {}
-        with open('%s.json' % self.target_basename) as response:
-            response_json = simplejson.loads(response.read())
-        eq_(response_json['status'], 'error')
-        params = urlparse.parse_qs(urllib2.urlopen.call_args[1]['data'])
-        eq_(params['result'][0], 'failure')
+        eq_(status.get(self.hashtag)['status'], 'error')
+        eq_(pingbacks.post.call_args[0][0], 'test_pingback')
+        eq_(pingbacks.post.call_args[0][1]['result'], 'failure')
 
     def test_pingback(self):
         urllib2.urlopen = Mock(return_value=open(os.path.join(
                 settings.ROOT, 'apps/xpi/tests/sample_addons/',
                 '%s.xpi' % self.sample_addons[0])))
+        pingbacks.post = Mock()
         rebuild(
                 os.path.join(
                     self.xpi_file_prefix, '%s.xpi' % self.sample_addons[0]),
@@ -92,7 +95,129 @@ class RepackageTaskTest(TestCase):
                 'post': None,
                 'id': 'jid0-S9EIBmWttfoZn92i5toIRoKXb1Y',
                 'result': 'success'}
-        params = urlparse.parse_qs(urllib2.urlopen.call_args[1]['data'])
-        eq_(desired_response['secret'], params['secret'][0])
-        eq_(desired_response['location'], params['location'][0])
-        eq_(desired_response['result'], params['result'][0])
+        params = pingbacks.post.call_args[0][1]
+        eq_(desired_response['secret'], params['secret'])
+        eq_(desired_response['location'], params['location'])
+        eq_(desired_response['result'], params['result'])
+
+    def test_batch_item_state(self):
+        job = BatchJob.objects.create(uuid='batch-uuid')
+        item = BatchItem.objects.create(job=job, hashtag=self.hashtag,
+                key=BatchItem.get_key('bad'))
+        with tempfile.NamedTemporaryFile() as bad_xpi:
+            urllib2.urlopen = Mock(return_value=open(bad_xpi.name))
+            self.assertRaises(Exception,
+                    rebuild,
+                    'file://%s' % bad_xpi.name, None, self.sdk_source_dir,
+                    self.hashtag, batch_item=item.pk)
+        item = BatchItem.objects.get(pk=item.pk)
+        eq_(item.state, 'failed')
+        assert item.message
+        assert item.finished_at
+        urllib2.urlopen = OLDURLOPEN
+        rebuild(os.path.join(
+                    self.xpi_file_prefix, '%s.xpi' % self.sample_addons[0]),
+                None, self.sdk_source_dir, self.hashtag, batch_item=item.pk)
+        eq_(BatchItem.objects.get(pk=item.pk).state, 'done')
+        eq_(job.get_progress()['progress'], 1)
+
+    def test_batch_continues_after_failure(self):
+        calls = []
+
+        def rebuild_addon(location, *args, **kwargs):
+            calls.append(kwargs)
+            if location == 'bad':
+                raise IOError('Not found')
+            return ['', '']
+
+        addons = [
+            {'location': 'good', 'hashtag': 'a'},
+            {'location': 'bad', 'hashtag': 'b'},
+            {'location': 'good', 'hashtag': 'c', 'filename': 'c'}]
+        with patch('repackage.tasks.rebuild', rebuild_addon):
+            responses = batch_rebuild(addons, self.sdk_source_dir,
+                                      pingback='test_pingback')
+        eq_(responses, [['', ''], None, ['', '']])
+        eq_(len(calls), 3)
+        eq_(calls[0]['pingback'], 'test_pingback')
+
+    def test_batch_in_process_without_threads(self):
+        old_in_process = settings.XPI_BUILD_IN_PROCESS
+        settings.XPI_BUILD_IN_PROCESS = True
+        addons = [{'location': 'good', 'hashtag': 'a'},
+                  {'location': 'good', 'hashtag': 'b'}]
+        try:
+            with patch('xpi.engine.is_warm', Mock(return_value=True)):
+                with patch('repackage.tasks.ThreadPool',
+                           Mock(side_effect=OSError('No threads'))):
+                    with patch('repackage.tasks.rebuild',
+                               Mock(return_value=['', ''])):
+                        responses = batch_rebuild(addons,
+                                                  self.sdk_source_dir)
+        finally:
+            settings.XPI_BUILD_IN_PROCESS = old_in_process
+        eq_(responses, [['', ''], ['', '']])
+
+    @patch('xpi.status.cache', cache)
+    def test_batch_failure_reported(self):
+        job = BatchJob.objects.create(uuid='batch-uuid')
+        addons = []
+        for location in ('a', 'b'):
+            item = BatchItem.objects.create(job=job, hashtag=hashtag(),
+                    key=BatchItem.get_key(location))
+            addons.append({'location': location, 'hashtag': item.hashtag,
+                           'batch_item': item.pk})
+        pingbacks.post = Mock()
+        with patch('repackage.tasks.ThreadPool',
+                   Mock(side_effect=OSError('No threads'))):
+            self.assertRaises(OSError, batch_rebuild, addons,
+                              self.sdk_source_dir, pingback='test_pingback')
+        for addon in addons:
+            eq_(BatchItem.objects.get(pk=addon['batch_item']).state,
+                'failed')
+            eq_(status.get(addon['hashtag'])['status'], 'error')
+            status.clear(addon['hashtag'])
+        eq_(pingbacks.post.call_count, 2)
+        eq_(pingbacks.post.call_args[0][1]['result'], 'failure')
+
+    def test_pingback_retried(self):
+        posted = []
+
+        def post(url, data):
+            posted.append(data)
+            if data['id'] == 'b' and len(posted) < 4:
+                raise pingbacks.PingbackError('Internal Server Error')
+
+        pingbacks.post = post
+        # CELERY_ALWAYS_EAGER - retries are run immediately
+        deliver_pingbacks(
+                'test_pingback', [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}])
+        eq_([data['id'] for data in posted], ['a', 'b', 'c', 'b'])
+
+    def test_refused_pingback_not_retried(self):
+        posted = []
+
+        def post(url, data):
+            posted.append(data)
+            if data['id'] == 'a':
+                raise pingbacks.PingbackError('Forbidden', 403)
+
+        pingbacks.post = post
+        deliver_pingbacks('test_pingback', [{'id': 'a'}, {'id': 'b'}])
+        eq_([data['id'] for data in posted], ['a', 'b'])
+
+    @patch('repackage.pingbacks.cache', cache)
+    def test_pingbacks_collected_in_window(self):
+        eager = settings.CELERY_ALWAYS_EAGER
+        settings.CELERY_ALWAYS_EAGER = False
+        try:
+            window = pingbacks.queue('test_pingback', {'id': 'a'})
+            assert window
+            eq_(pingbacks.queue('test_pingback', {'id': 'b'}), 0)
+            assert pingbacks.queue('other_pingback', {'id': 'c'})
+        finally:
+            settings.CELERY_ALWAYS_EAGER = eager
+        assert pingbacks.get_countdown(window) > 0
+        eq_(pingbacks.take('test_pingback', window),
+            [{'id': 'a'}, {'id': 'b'}])
+        eq_(pingbacks.take('test_pingback', window), [])
@@ -5,17 +5,20 @@ repackage.tests.test_views
 
 import commonware
 import os
+import shutil
 import simplejson
 import tempfile
 
-from mock import Mock
+from mock import Mock, patch
 from nose.tools import eq_
 from utils.test import TestCase
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError
 
 from repackage import tasks
+from repackage.models import BatchJob, BatchItem
 
 log = commonware.log.getLogger('f.repackage')
 
@@ -65,7 +68,7 @@ class RepackageViewsTest(TestCase):
         eq_(simplejson.loads(response.content)['status'], 'some failures')
 
     def test_repackage_with_download(self):
-        tasks.low_rebuild.delay = Mock(return_value=None)
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
         get_rebuild = lambda sample: self.client.post(self.rebuild_url, {
             'location': os.path.join(self.xpi_file_prefix, sample),
             'secret': settings.AMO_SECRET_KEY})
@@ -85,7 +88,7 @@ class RepackageViewsTest(TestCase):
         eq_(content['status'], 'success')
 
     def test_bulk_repackage_with_download(self):
-        tasks.low_rebuild.delay = Mock(return_value=None)
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
         response = self.client.post(self.rebuild_url, {
             'addons': simplejson.dumps([
                 {'location': os.path.join(
@@ -98,11 +101,11 @@ class RepackageViewsTest(TestCase):
         eq_(response.status_code, 200)
         content = simplejson.loads(response.content)
         eq_(content['status'], 'success')
-        eq_(tasks.low_rebuild.delay.call_count, 2)
+        eq_(tasks.low_rebuild.apply_async.call_count, 2)
 
     def test_single_upload_and_rebuild(self):
         file_pre = os.path.join(settings.ROOT, 'apps/xpi/tests/sample_addons/')
-        tasks.low_rebuild.delay = Mock(return_value=None)
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
         with open(os.path.join(file_pre, self.sample_addons[1])) as f:
             response = self.client.post(self.rebuild_url, {
                 'upload': f,
@@ -110,11 +113,11 @@ class RepackageViewsTest(TestCase):
         eq_(response.status_code, 200)
         content = simplejson.loads(response.content)
         eq_(content['status'], 'success')
-        eq_(tasks.low_rebuild.delay.call_count, 1)
+        eq_(tasks.low_rebuild.apply_async.call_count, 1)
 
     def test_bulk_upload_and_rebuild(self):
         file_pre = os.path.join(settings.ROOT, 'apps/xpi/tests/sample_addons/')
-        tasks.low_rebuild.delay = Mock(return_value=None)
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
         f0 = open(os.path.join(file_pre, self.sample_addons[0]))
         f1 = open(os.path.join(file_pre, self.sample_addons[1]))
         response = self.client.post(self.rebuild_url, {
@@ -128,15 +131,140 @@ class RepackageViewsTest(TestCase):
         eq_(response.status_code, 200)
         content = simplejson.loads(response.content)
         eq_(content['status'], 'success')
-        eq_(tasks.low_rebuild.delay.call_count, 2)
+        eq_(tasks.low_rebuild.apply_async.call_count, 2)
 
     def test_repackage_with_sdk_version_suffix(self):
         file_pre = os.path.join(settings.ROOT, 'apps/xpi/tests/sample_addons/')
-        tasks.low_rebuild.delay = Mock(return_value=None)
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
         with open(os.path.join(file_pre, self.sample_addons[1])) as f:
             response = self.client.post(self.rebuild_url, {
                 'upload': f,
                 'version': 'test-sdk-{sdk_version}',
                 'secret': settings.AMO_SECRET_KEY})
-        task_args = tasks.low_rebuild.delay.call_args
-        eq_(task_args[1]['package_overrides']['version'], 'test-sdk-1.0')
+        task_args = tasks.low_rebuild.apply_async.call_args
+        eq_(task_args[1]['kwargs']['package_overrides']['version'],
+            'test-sdk-1.0')
+
+    def test_bulk_repackage_in_batches(self):
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
+        tasks.batch_rebuild.apply_async = Mock(return_value=None)
+        batch_size = settings.REPACKAGE_BATCH_SIZE
+        settings.REPACKAGE_BATCH_SIZE = 2
+        try:
+            response = self.client.post(self.rebuild_url, {
+                'addons': simplejson.dumps([
+                    {'location': os.path.join(
+                        self.xpi_file_prefix, sample)}
+                    for sample in self.sample_addons]),
+                'secret': settings.AMO_SECRET_KEY})
+        finally:
+            settings.REPACKAGE_BATCH_SIZE = batch_size
+        eq_(response.status_code, 200)
+        content = simplejson.loads(response.content)
+        eq_(content['addons'], 3)
+        eq_(tasks.low_rebuild.apply_async.call_count, 0)
+        eq_(tasks.batch_rebuild.apply_async.call_count, 2)
+        batches = [call[1]['args'][0] for call in
+                   tasks.batch_rebuild.apply_async.call_args_list]
+        eq_([len(batch) for batch in batches], [2, 1])
+        assert batches[0][0]['hashtag']
+
+    def _post_batch(self, uuid):
+        return self.client.post(self.rebuild_url, {
+            'addons': simplejson.dumps([
+                {'location': os.path.join(self.xpi_file_prefix, sample)}
+                for sample in self.sample_addons]),
+            'uuid': uuid,
+            'secret': settings.AMO_SECRET_KEY})
+
+    def test_resubmitted_batch_skips_rebuilt_addons(self):
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
+        response = self._post_batch('batch-uuid')
+        content = simplejson.loads(response.content)
+        eq_(content['addons'], 3)
+        eq_(content['skipped'], 0)
+        job = BatchJob.objects.get(uuid='batch-uuid')
+        eq_(job.items.filter(state='queued').count(), 3)
+        item_ids = [call[1]['kwargs']['batch_item'] for call in
+                    tasks.low_rebuild.apply_async.call_args_list]
+        BatchItem.set_state(item_ids[0], 'done')
+        BatchItem.set_state(item_ids[1], 'failed', 'error')
+
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
+        response = self._post_batch('batch-uuid')
+        content = simplejson.loads(response.content)
+        eq_(content['addons'], 2)
+        eq_(content['skipped'], 1)
+        eq_(BatchJob.objects.count(), 1)
+        eq_(job.items.count(), 3)
+        eq_(sorted([call[1]['kwargs']['batch_item'] for call in
+                    tasks.low_rebuild.apply_async.call_args_list]),
+            sorted(item_ids[1:]))
+        eq_(BatchItem.objects.get(pk=item_ids[1]).state, 'queued')
+
+    @patch('repackage.models.BatchItem.objects.get_or_create',
+           Mock(side_effect=IntegrityError('duplicate key')))
+    def test_batch_item_created_concurrently(self):
+        rollback = Mock()
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
+        job = BatchJob.objects.create(uuid='batch-uuid')
+        for sample in self.sample_addons:
+            BatchItem.objects.create(job=job, hashtag='abc',
+                    key=BatchItem.get_key(os.path.join(
+                        self.xpi_file_prefix, sample)))
+        with patch('django.db.transaction.rollback_unless_managed',
+                   rollback):
+            response = self._post_batch('batch-uuid')
+        eq_(response.status_code, 200)
+        content = simplejson.loads(response.content)
+        eq_(content['addons'], 3)
+        eq_(job.items.count(), 3)
+        # items are looked up again in a new transaction
+        eq_(rollback.call_count, 3)
+
+    def test_batch_uploads_of_the_same_name(self):
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
+        file_pre = os.path.join(settings.ROOT, 'apps/xpi/tests/sample_addons/')
+        dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        try:
+            for directory, sample in zip(dirs, self.sample_addons):
+                shutil.copy(os.path.join(file_pre, sample),
+                            os.path.join(directory, 'addon.xpi'))
+            with open(os.path.join(dirs[0], 'addon.xpi')) as f0:
+                with open(os.path.join(dirs[1], 'addon.xpi')) as f1:
+                    response = self.client.post(self.rebuild_url, {
+                        'upload_a': f0,
+                        'upload_b': f1,
+                        'addons': simplejson.dumps([
+                            {'upload': 'upload_a'},
+                            {'upload': 'upload_b'}]),
+                        'uuid': 'batch-uuid',
+                        'secret': settings.AMO_SECRET_KEY})
+        finally:
+            for directory in dirs:
+                shutil.rmtree(directory)
+        content = simplejson.loads(response.content)
+        eq_(content['addons'], 2)
+        eq_(content['skipped'], 0)
+        eq_(BatchJob.objects.get(uuid='batch-uuid').items.count(), 2)
+
+    def test_batch_status(self):
+        tasks.low_rebuild.apply_async = Mock(return_value=None)
+        self._post_batch('batch-uuid')
+        item = BatchItem.objects.all()[0]
+        BatchItem.set_state(item.pk, 'done')
+        status_url = reverse('repackage_batch_status', args=['batch-uuid'])
+        response = self.client.get(status_url)
+        eq_(response.status_code, 403)
+        response = self.client.get(status_url, {
+            'secret': settings.AMO_SECRET_KEY})
+        eq_(response.status_code, 200)
+        content = simplejson.loads(response.content)
+        eq_(content['total'], 3)
+        eq_(content['states']['done'], 1)
+        eq_(content['states']['queued'], 2)
+        assert content['last_finished_at']
+        response = self.client.get(
+                reverse('repackage_batch_status', args=['unknown']),
+                {'secret': settings.AMO_SECRET_KEY})
+        eq_(response.status_code, 404)
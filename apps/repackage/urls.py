@@ -8,5 +8,7 @@ from django.conf.urls.defaults import url, patterns
 urlpatterns = patterns('repackage.views',
 
     url(r'^rebuild/$', 'rebuild', name='repackage_rebuild'),
+    url(r'^batch/(?P<uuid>[^/]+)/$', 'batch_status',
+        name='repackage_batch_status'),
 
 )
@@ -3,19 +3,25 @@ repackage.views
 ---------------
 """
 import commonware
+import hashlib
 import simplejson
 
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.http import (HttpResponse, HttpResponseBadRequest,
         HttpResponseForbidden)
+from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
-from jetpack.models import SDK
+from jetpack import sdk_registry
 from utils.helpers import get_random_string
 from utils import validator, exceptions
 
 from repackage import tasks
+from repackage.models import BatchJob, BatchItem
+from xpi import scheduler
 
 log = commonware.log.getLogger('f.repackage')
 
@@ -51,17 +57,77 @@ def _get_package_overrides(container, sdk_version=None):
 
 def _get_latest_sdk_source_dir():
     # get latest SDK
-    sdk = SDK.objects.latest('pk')
+    sdk = sdk_registry.get_latest()
     # if (when?) choosing POST['sdk_dir'] will be possible
     # sdk = SDK.objects.get(dir=sdk_dir) if sdk_dir else SDK.objects.all()[0]
     return sdk.get_source_dir()
 
 
+def _queue(task, uuid, *args, **kwargs):
+    """Queue the rebuild, low priority rebuilds go to the ``bulk`` class of
+    :mod:`xpi.scheduler`, shared fairly by batch jobs
+    """
+    if task == tasks.high_rebuild:
+        task.delay(*args, **kwargs)
+    else:
+        scheduler.enqueue(task, 'bulk', uuid, args=args, kwargs=kwargs)
+
+
+def _get_or_create(model, defaults, **lookup):
+    """``get_or_create`` of the object which might be created by
+    a concurrent request (the same batch resubmitted)
+    """
+    try:
+        return model.objects.get_or_create(defaults=defaults, **lookup)
+    except (IntegrityError, ValidationError):
+        # end the transaction started by the first lookup, its snapshot
+        # (REPEATABLE READ) does not contain the concurrently created row
+        transaction.rollback_unless_managed()
+        return model.objects.get(**lookup), False
+
+
+def _get_upload_hash(upload):
+    " returns SHA-256 hex digest of the uploaded XPI "
+    digest = hashlib.sha256()
+    for chunk in upload.chunks(settings.REPACKAGE_CHUNK_SIZE):
+        digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()
+
+
+def _track(job, hashtag, location=None, upload=None):
+    """Record the add-on as an item of the batch ``job``
+
+    :returns: (BatchItem) or None if the add-on was already rebuilt
+    """
+    item, created = _get_or_create(BatchItem, {'hashtag': hashtag},
+            job=job, key=BatchItem.get_key(location,
+                _get_upload_hash(upload) if upload else None))
+    if not created:
+        if item.state == 'done':
+            return None
+        # resubmitted, rebuild it again
+        item.hashtag = hashtag
+        item.state = 'queued'
+        item.message = ''
+        item.finished_at = None
+        item.save()
+    return item
+
+
 @csrf_exempt
 @require_POST
 def rebuild(request):
     """Rebuild ``XPI`` file. It can be provided as POST['location']
 
+    Add-ons of the POST['addons'] list are rebuilt in batches of
+    ``REPACKAGE_BATCH_SIZE`` if they're provided by location and the priority
+    is low (see :meth:`repackage.tasks.batch_rebuild`)
+
+    Add-ons of a request with POST['uuid'] are tracked as items of the
+    :class:`repackage.models.BatchJob`, add-ons which were already rebuilt
+    are skipped if the job is resubmitted (see :meth:`batch_status`)
+
     :returns: (JSON) contains one field - hashtag it is later used to download
               the xpi using :method:`xpi.views.check_download` and
               :method:`xpi.views.get_download`
@@ -85,15 +151,11 @@ def rebuild(request):
 
     sdk_source_dir = (settings.REPACKAGE_SDK_SOURCE
             or _get_latest_sdk_source_dir())
-    sdk_manifest = '%s/packages/%s/package.json' % (sdk_source_dir, 'addon-kit')
-    try:
-        handle = open(sdk_manifest)
-    except Exception, err:
-        log.critical("Problems loading SDK manifest\n%s" % str(err))
-        raise
-    else:
-        sdk_version = simplejson.loads(handle.read())['version']
-        handle.close()
+    sdk_manifest = sdk_registry.get_manifest(sdk_source_dir, 'addon-kit')
+    if not sdk_manifest:
+        log.critical("Problems loading SDK manifest (%s)" % sdk_source_dir)
+        raise IOError("No SDK manifest in %s" % sdk_source_dir)
+    sdk_version = sdk_manifest['version']
     pingback = request.POST.get('pingback', None)
     priority = request.POST.get('priority', None)
     post = request.POST.urlencode()
@@ -104,6 +166,18 @@ def rebuild(request):
     response = {'status': 'success'}
     errors = []
     counter = 0
+    skipped = 0
+    uuid = request.POST.get('uuid', None)
+    job = None
+    if uuid:
+        job, created = _get_or_create(BatchJob,
+                {'sdk_version': sdk_version}, uuid=uuid)
+        if not created:
+            log.info("Batch job resubmitted, uuid: %s" % uuid)
+    # add-ons to rebuild in batches
+    batch = []
+    batch_size = (settings.REPACKAGE_BATCH_SIZE
+                  if rebuild_task == tasks.low_rebuild else 0)
 
     if location or upload:
         hashtag = get_random_string(10)
@@ -121,12 +195,18 @@ def rebuild(request):
         except BadManifestFieldException, err:
             errors.append('[%s] %s' % (hashtag, str(err)))
         else:
-            rebuild_task.delay(
-                    location, upload, sdk_source_dir, hashtag,
-                    package_overrides=package_overrides,
-                    filename=filename, pingback=pingback,
-                    post=post)
-            counter = counter + 1
+            item = None
+            if job:
+                item = _track(job, hashtag, location, upload)
+            if job and not item:
+                skipped = skipped + 1
+            else:
+                _queue(rebuild_task, uuid,
+                        location, upload, sdk_source_dir, hashtag,
+                        package_overrides=package_overrides,
+                        filename=filename, pingback=pingback,
+                        post=post, batch_item=item.pk if item else None)
+                counter = counter + 1
 
     if addons:
         try:
@@ -156,13 +236,31 @@ def rebuild(request):
                 except Exception, err:
                     errors.append('[%s] %s' % (hashtag, str(err)))
                     error = True
-                if not error:
-                    rebuild_task.delay(
+                item = None
+                if not error and job:
+                    item = _track(job, hashtag, location, upload)
+                    if not item:
+                        skipped = skipped + 1
+                        continue
+                if not error and location and batch_size:
+                    batch.append({
+                        'location': location,
+                        'hashtag': hashtag,
+                        'filename': filename,
+                        'package_overrides': package_overrides,
+                        'batch_item': item.pk if item else None})
+                    counter = counter + 1
+                elif not error:
+                    _queue(rebuild_task, uuid,
                         location, upload, sdk_source_dir, hashtag,
                         package_overrides=package_overrides,
                         filename=filename, pingback=pingback,
-                        post=post)
+                        post=post, batch_item=item.pk if item else None)
                     counter = counter + 1
+            for start in range(0, len(batch), batch_size or 1):
+                _queue(tasks.batch_rebuild, uuid,
+                        batch[start:start + batch_size], sdk_source_dir,
+                        pingback=pingback, post=post)
 
     if errors:
         log.error("Errors reported when rebuilding")
@@ -173,10 +271,25 @@ def rebuild(request):
             log.error("    Error: %s" % e)
 
     response['addons'] = counter
-    uuid = request.POST.get('uuid', 'no uuid')
+    if job:
+        response['skipped'] = skipped
 
-    log.info("%d addon(s) will be created, %d syntax errors, uuid: %s" %
-            (counter, len(errors), uuid))
+    log.info("%d addon(s) will be created, %d skipped, %d syntax errors, "
+             "uuid: %s" % (counter, skipped, len(errors), uuid or 'no uuid'))
 
     return HttpResponse(simplejson.dumps(response),
             mimetype='application/json')
+
+
+def batch_status(request, uuid):
+    """Progress of the bulk rebuild
+
+    :returns: (JSON) see :meth:`repackage.models.BatchJob.get_progress`
+    """
+    secret = request.GET.get('secret', None)
+    if not secret or secret != settings.AMO_SECRET_KEY:
+        log.error("Batch status requested with an invalid key. Rejecting.")
+        return HttpResponseForbidden('Access denied')
+    job = get_object_or_404(BatchJob, uuid=uuid)
+    return HttpResponse(simplejson.dumps(job.get_progress()),
+            mimetype='application/json')
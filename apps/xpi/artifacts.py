@@ -0,0 +1,239 @@
+"""
+xpi.artifacts
+-------------
+
+Size-bounded stores of built XPIs.
+
+Every directory holding XPIs (see :func:`get_stores`) has a byte budget.
+Artifacts - ``<name>.xpi`` with its ``<name>.json`` or ``<name>.scan``
+(pickled scans of ``cuddlefish.manifest.ScanCache``) - are added to the
+store as they are created and marked as used (their mtime is updated)
+whenever they're read. When a store outgrows its budget the least recently
+used artifacts are removed until it fits in ``XPI_ARTIFACT_LOW_WATER`` of
+the budget. Artifacts created or used in the last ``MIN_EVICTION_AGE``
+seconds and artifacts pinned for download are never removed.
+
+Stores live under ``ARTIFACTS_ROOT``, every file named like an artifact in
+a store's directory is subject to eviction. The gc cron job leaves them
+alone.
+
+Sizes of the stores are counted in the cache, directories are listed only
+when evicting.
+
+The same XPI may be hardlinked into several stores (e.g. a cached build
+served for a new hashtag). Files of the stores are therefore never written
+in place, they're replaced with :func:`publish`.
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = commonware.log.getLogger('f.xpi.artifacts')
+
+#: artifacts which might be just built or waited for
+MIN_EVICTION_AGE = 2 * 60  # seconds
+ARTIFACT_RE = re.compile(r'^([a-zA-Z0-9]+)\.(xpi|json|scan)$')
+EVICTION_FILE = '.xpi_eviction'
+# store is scanned again if its counted size expires
+SIZE_TIMEOUT = 24 * 60 * 60  # seconds
+
+
+def get_stores():
+    " returns ``{name: (directory, max_size)}`` of stores in use "
+    stores = {
+        'target': (settings.XPI_TARGETDIR, settings.XPI_TARGETDIR_MAX_SIZE),
+        'cache': (settings.XPI_CACHE_DIR, settings.XPI_CACHE_MAX_SIZE),
+        'incremental': (settings.XPI_INCREMENTAL_DIR,
+                        settings.XPI_INCREMENTAL_MAX_SIZE),
+        'download': (settings.REPACKAGE_DOWNLOAD_CACHE_DIR,
+                     settings.REPACKAGE_DOWNLOAD_CACHE_MAX_SIZE),
+        'scan': (settings.XPI_SCAN_CACHE_DIR,
+                 settings.XPI_SCAN_CACHE_MAX_SIZE)}
+    return dict((name, store) for name, store in stores.items()
+                if store[0])
+
+
+def _get_size_key(directory):
+    return 'xpi:artifacts:%s' % hashlib.md5(directory).hexdigest()
+
+
+def _get_name(path):
+    " returns the name of the artifact the file belongs to or None "
+    match = ARTIFACT_RE.match(os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def touch(path):
+    " mark artifact as recently used, pinned artifacts stay pinned "
+    try:
+        if os.path.getmtime(path) < time.time():
+            os.utime(path, None)
+    except OSError:
+        pass
+
+
+def makedirs(directory):
+    " create the directory of a store if it's missing, writable by owner "
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0755)
+        except OSError:
+            # created by another process
+            if not os.path.isdir(directory):
+                raise
+
+
+def publish(source, path, link=True):
+    """Place the content of ``source`` under ``path`` atomically
+
+    The file is linked (or copied) under a temporary name and renamed over
+    ``path``. A previous file under ``path`` is unlinked, not overwritten,
+    so files sharing its inode are left untouched.
+
+    :params:
+        * source (String) path of the file to publish
+        * path (String) destination
+        * link (bool) hardlink ``source`` if it's on the same device
+    """
+    makedirs(os.path.dirname(path))
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix='.publish-')
+    os.close(fd)
+    try:
+        linked = False
+        if link and hasattr(os, 'link'):
+            os.remove(temp_path)
+            try:
+                os.link(source, temp_path)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            shutil.copyfile(source, temp_path)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def pin(path):
+    """Keep the artifact for ``XPI_ARTIFACT_PIN_TIMEOUT`` seconds
+
+    Its mtime is moved to the end of the pin, artifacts used in the last
+    ``MIN_EVICTION_AGE`` seconds are not evicted. Works without a shared
+    cache.
+    """
+    until = time.time() + settings.XPI_ARTIFACT_PIN_TIMEOUT
+    try:
+        os.utime(path, (until, until))
+    except OSError:
+        pass
+
+
+def _is_eviction_due(directory):
+    " limits the evictions when the size of the store is unknown "
+    try:
+        last = os.path.getmtime(os.path.join(directory, EVICTION_FILE))
+    except OSError:
+        return True
+    return time.time() - last > settings.XPI_ARTIFACT_EVICTION_INTERVAL
+
+
+def add(store, path):
+    """Add the created file to the ``store``, make room if needed
+
+    :params:
+        * store (String) name of the store (see :func:`get_stores`)
+        * path (String) path of the created file
+    """
+    stores = get_stores()
+    if store not in stores:
+        return
+    directory, max_size = stores[store]
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    key = _get_size_key(directory)
+    try:
+        total = cache.incr(key, size)
+    except ValueError:
+        total = None
+    if total is not None and total <= max_size:
+        return
+    if total is None and not _is_eviction_due(directory):
+        return
+    evict(store)
+
+
+def _list(directory):
+    """Find artifacts in the directory
+
+    :returns: (list) ``[last used, size, name, paths]`` sorted by use
+    """
+    artifacts = {}
+    for filename in os.listdir(directory):
+        name = _get_name(filename)
+        if not name:
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        artifact = artifacts.setdefault(name, [0, 0, name, []])
+        artifact[0] = max(artifact[0], stat.st_mtime)
+        artifact[1] += stat.st_size
+        artifact[3].append(path)
+    return sorted(artifacts.values())
+
+
+def evict(store):
+    """Remove least recently used artifacts of the ``store`` if it's over
+    its budget
+
+    :returns: (int) number of removed artifacts
+    """
+    stores = get_stores()
+    if store not in stores:
+        return 0
+    directory, max_size = stores[store]
+    if not os.path.isdir(directory):
+        return 0
+    with open(os.path.join(directory, EVICTION_FILE), 'w'):
+        pass
+    artifacts = _list(directory)
+    total = sum(artifact[1] for artifact in artifacts)
+    evicted = 0
+    if total > max_size:
+        target = max_size * settings.XPI_ARTIFACT_LOW_WATER
+        now = time.time()
+        for used, size, name, paths in artifacts:
+            # sorted by use, pinned artifacts are used in the future
+            if total <= target or now - used < MIN_EVICTION_AGE:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError, err:
+                    log.warning("Unable to evict artifact (%s): %s" % (
+                                path, str(err)))
+            total -= size
+            evicted += 1
+        log.info("Evicted %d artifacts from %s" % (evicted, directory))
+        statsd.incr('xpi.artifacts.%s.evicted' % store, evicted)
+    cache.set(_get_size_key(directory), total, SIZE_TIMEOUT)
+    statsd.timing('xpi.artifacts.%s.size' % store, total)
+    statsd.timing('xpi.artifacts.%s.count' % store,
+                  len(artifacts) - evicted)
+    return evicted
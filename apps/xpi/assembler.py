@@ -0,0 +1,213 @@
+"""
+xpi.assembler
+-------------
+
+Assembles the XPI straight into ``XPI_TARGETDIR``.
+
+``cfx`` needs only the ``package.json`` files and the modules (which it scans
+for ``require`` calls) on the disk. Attachments are streamed from the upload
+directory (or from the edited content) into the XPI, which is written by the
+SDK's own ``build_xpi`` directly to the target directory, so nothing is
+copied twice. ``cfx`` is run in process (see :mod:`xpi.engine`).
+"""
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+
+from xpi import (artifacts, engine, library_cache, status, tracing,
+                 xpi_utils)
+
+log = commonware.log.getLogger('f.xpi.assembler')
+
+# files and directories cfx leaves out of the XPI
+IGNORED_FILES = ('.hgignore', 'install.rdf', 'application.ini')
+IGNORED_FILE_SUFFIXES = ('~',)
+IGNORED_DIRS = ('.svn', '.hg', 'defaults')
+
+
+class AssemblerError(Exception):
+    " XPI could not be assembled, it should be built by cfx "
+
+
+def is_ignored(filename):
+    " check if cfx would leave the data file out of the XPI "
+    parts = filename.split('/')
+    if parts[-1] in IGNORED_FILES or parts[-1].endswith(IGNORED_FILE_SUFFIXES):
+        return True
+    return bool(set(parts[:-1]) & set(IGNORED_DIRS))
+
+
+def _export_package(revision, packages_dir, data_files, modules=(),
+                    attachments=(), sdk=None):
+    """Export manifest and modules of the package and its dependencies,
+    collect its attachments in ``data_files``
+
+    ``data_files`` is a list of ``(package_name, filename, path, content)``
+    where either ``path`` (uploaded file) or ``content`` (edited attachment)
+    is set.
+    """
+    package_dir = revision.make_dir(packages_dir)
+    if not package_dir:
+        # package included multiple times
+        return
+    revision.export_manifest(package_dir, sdk=sdk)
+
+    lib_dir = os.path.join(package_dir, revision.get_lib_dir())
+    edited = dict((mod.pk, mod) for mod in modules)
+    for mod in revision.modules.all():
+        edited.get(mod.pk, mod).export_code(lib_dir)
+
+    edited = dict((att.pk, att) for att in attachments)
+    for att in revision.attachments.all():
+        att = edited.get(att.pk, att)
+        filename = att.get_filename()
+        if is_ignored(filename):
+            continue
+        if hasattr(att, 'code'):
+            data_files.append((revision.name, filename, None,
+                               att.code.encode('utf-8')))
+        else:
+            data_files.append((revision.name, filename,
+                               att.get_file_path(), None))
+
+    _export_dependencies(revision, packages_dir, data_files,
+                         sdk or revision.sdk)
+
+
+def _export_dependencies(revision, packages_dir, data_files, sdk):
+    " link exported libraries or export them with the package "
+    for lib in revision.dependencies.all():
+        if library_cache.link(lib, packages_dir, sdk=sdk):
+            # attachments are already in the exported library
+            _export_dependencies(lib, packages_dir, data_files, sdk)
+        else:
+            _export_package(lib, packages_dir, data_files, sdk=sdk)
+
+
+def _get_data_resource(harness_options, package_name):
+    " returns name of the resource holding the data of the package "
+    url = harness_options['packageData'].get(package_name)
+    if not url or not url.startswith('resource://'):
+        raise AssemblerError("No data resource for package %s" %
+                             package_name)
+    return url[len('resource://'):].strip('/')
+
+
+def _get_writer(xpi_path, data_files, state):
+    """Create a replacement of ``cuddlefish.xpi.build_xpi``
+
+    The original function writes the XPI to ``xpi_path`` and attachments
+    are appended to the data resources afterwards.
+    """
+
+    def build_xpi(original, **kwargs):
+        state['called'] = True
+        try:
+            # argument was renamed in later SDKs
+            for name in ('xpi_path', 'xpi_name'):
+                if name in kwargs:
+                    kwargs[name] = xpi_path
+                    break
+            else:
+                raise AssemblerError("Unknown arguments of build_xpi (%s)" %
+                                     ', '.join(kwargs.keys()))
+            original(**kwargs)
+            harness_options = kwargs['harness_options']
+            zf = zipfile.ZipFile(xpi_path, 'a', zipfile.ZIP_DEFLATED)
+            try:
+                for package_name, filename, path, content in data_files:
+                    arcname = '/'.join(['resources', _get_data_resource(
+                        harness_options, package_name), filename])
+                    if path:
+                        zf.write(str(path), str(arcname))
+                    else:
+                        info = zipfile.ZipInfo(str(arcname),
+                                               time.localtime()[:6])
+                        info.external_attr = 0644 << 16L
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                        zf.writestr(info, content)
+            finally:
+                zf.close()
+        except Exception, err:
+            state['error'] = err
+            raise
+
+    return build_xpi
+
+
+def build(revision, modules=(), attachments=(), hashtag=None, tstart=None):
+    """Build XPI of the add-on into ``XPI_TARGETDIR/<hashtag>.xpi``
+
+    :params:
+        * revision (PackageRevision) add-on to build
+        * modules (list) edited modules
+        * attachments (list) edited attachments
+        * hashtag (String) name of the XPI and its info file
+        * tstart (float) time.time() of the build start
+
+    :raises: AssemblerError if the XPI should be built by cfx instead
+    :returns: (list) ``cfx xpi`` response where ``[0]`` is ``stdout`` and
+              ``[1]`` ``stderr``
+    """
+    if not tstart:
+        tstart = time.time()
+    texport = time.time()
+    sdk_source = revision.sdk.get_source_dir()
+    sdk_dir = tempfile.mkdtemp()
+    artifacts.makedirs(settings.XPI_TARGETDIR)
+    fd, xpi_path = tempfile.mkstemp(suffix='.xpi', prefix='.%s-' % hashtag,
+                                    dir=settings.XPI_TARGETDIR)
+    os.close(fd)
+    state = {}
+    try:
+        xpi_utils.sdk_workspace(sdk_source, sdk_dir)
+        revision.export_keys(sdk_dir)
+        packages_dir = os.path.join(sdk_dir, 'packages')
+        data_files = []
+        _export_package(revision, packages_dir, data_files, modules=modules,
+                        attachments=attachments)
+        package_dir = revision.get_dir_name(packages_dir)
+        t1 = time.time()
+        tracing.add_span(hashtag, 'export', texport, t1)
+        result = engine.run_cfx(
+                sdk_source, sdk_dir, package_dir,
+                ['--keydir=%s/%s' % (sdk_dir, settings.KEYDIR), 'xpi'],
+                build_xpi=_get_writer(xpi_path, data_files, state))
+        if state.get('error') or not (state.get('called') or result.stderr):
+            raise AssemblerError(state.get('error') or
+                                 "build_xpi was not called by cfx")
+    except:
+        os.remove(xpi_path)
+        shutil.rmtree(sdk_dir)
+        raise
+    shutil.rmtree(sdk_dir)
+    t2 = time.time()
+    build_time = tracing.add_span(hashtag, 'cfx', t1, t2)
+
+    response = result.get_response()
+    if response[1]:
+        os.remove(xpi_path)
+        status.finish(hashtag, 'error', response[1])
+        log.critical("[xpi:%s] Failed to assemble xpi." % hashtag)
+        tracing.finish(hashtag, t2, error='cfx')
+        return response
+
+    xpi_targetpath = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+    os.rename(xpi_path, xpi_targetpath)
+    artifacts.add('target', xpi_targetpath)
+    preparation_time = (t1 - tstart) * 1000
+    statsd.timing('xpi.build.prep', preparation_time)
+    statsd.timing('xpi.build.build', build_time)
+    statsd.incr('xpi.build.assembled')
+    log.info('[xpi:%s] Assembled xpi (prep time: %dms) (build time: %dms)' % (
+             hashtag, preparation_time, build_time))
+    status.finish(hashtag, 'success', response[0])
+    tracing.finish(hashtag)
+    return response
@@ -0,0 +1,302 @@
+"""
+xpi.benchmark
+-------------
+
+Repeatable benchmark of the build pipeline on synthetic add-ons.
+
+:func:`run` creates an add-on with the given number and size of modules and
+attachments depending on a chain of ``depth`` libraries, builds it with
+:meth:`jetpack.models.PackageRevision.build_xpi` and repackages a sample
+XPI with :meth:`repackage.helpers.Repackage.rebuild`. Every run reports the
+spans of the build (see :mod:`xpi.tracing`), its total time, the peak RSS
+of the process and its children and the bytes they wrote.
+
+Builds use the SDK the tests are run with (``TEST_SDK``, ``lib/`` of the
+repository, registered by the ``core_sdk`` fixture), so results of
+different installations are comparable. Synthetic packages are created in
+a transaction which is rolled back after the benchmark. Used by the
+``xpi_benchmark`` management command.
+"""
+import os
+import resource
+import time
+
+import commonware.log
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from base.templatetags.base_helpers import hashtag as get_hashtag
+from jetpack.models import Package, SDK
+from repackage.helpers import Repackage
+from xpi import status, tracing
+
+log = commonware.log.getLogger('f.xpi.benchmark')
+
+SAMPLE_XPI = os.path.join(settings.ROOT,
+        'apps/xpi/tests/sample_addons/sample_add-on-1.0rc2.xpi')
+#: I/O counters of the process, reaped children are included
+PROC_IO = '/proc/self/io'
+
+
+def make_code(size, name='module'):
+    " returns JavaScript code of about ``size`` bytes "
+    lines = ['// synthetic %s\n' % name]
+    length = len(lines[0])
+    i = 0
+    while length < size:
+        line = 'exports.f%d = function() { return %d; };\n' % (i, i)
+        lines.append(line)
+        length += len(line)
+        i += 1
+    return ''.join(lines)
+
+
+def _create_package(author, package_type, name):
+    return Package.objects.create(
+            full_name='benchmark %s %s' % (name, get_hashtag()),
+            author=author,
+            type=package_type)
+
+
+def create_addon(author, sdk=None, modules=10, module_size=1024,
+                 attachments=2, attachment_size=10240, depth=1,
+                 library_modules=2):
+    """Create a synthetic add-on
+
+    :params:
+        * author (User) owner of the created packages
+        * sdk (SDK) the add-on is built with, the latest one by default
+        * modules (int) number of modules of the add-on
+        * module_size (int) size of a module in bytes
+        * attachments (int) number of attachments of the add-on
+        * attachment_size (int) size of an attachment in bytes
+        * depth (int) length of the chain of libraries the add-on depends on
+        * library_modules (int) number of modules of every library
+
+    :returns: (PackageRevision) latest revision of the add-on
+    """
+    dependency = None
+    for level in range(depth, 0, -1):
+        library = _create_package(author, 'l', 'library %d' % level)
+        revision = library.latest
+        for i in range(library_modules):
+            revision.module_create(save=False,
+                    filename='benchmark/module_%d' % i,
+                    code=make_code(module_size, 'library module'),
+                    author=author)
+        if dependency:
+            revision.dependency_add(dependency, save=False)
+        revision.save()
+        dependency = revision
+
+    addon = _create_package(author, 'a', 'add-on')
+    revision = addon.latest
+    for i in range(modules):
+        revision.module_create(save=False,
+                filename='benchmark/module_%d' % i,
+                code=make_code(module_size),
+                author=author)
+    for i in range(attachments):
+        att = revision.attachment_create(save=False,
+                filename='benchmark/attachment_%d' % i,
+                ext='dat',
+                author=author)
+        att.data = os.urandom(attachment_size)
+        att.write()
+    if dependency:
+        revision.dependency_add(dependency, save=False)
+    if sdk:
+        revision.sdk = sdk
+    revision.save()
+    return revision
+
+
+def get_benchmark_sdk():
+    " returns the SDK of ``TEST_SDK`` or None if it's not registered "
+    try:
+        return SDK.objects.get(dir=settings.TEST_SDK)
+    except SDK.DoesNotExist:
+        return None
+
+
+def _get_written():
+    """returns bytes passed to ``write()`` by the process and its finished
+    children (``wchar``), None if not available
+
+    Unlike blocks counted by ``getrusage`` it includes writes to the page
+    cache and tmpfs.
+    """
+    try:
+        with open(PROC_IO) as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'wchar':
+                    return int(value)
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _get_usage():
+    " returns ``(peak RSS in KB, bytes written)`` of self and children "
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ({'self': own.ru_maxrss, 'children': children.ru_maxrss},
+            _get_written())
+
+
+def measure(func, hashtag):
+    """Call ``func`` and measure it
+
+    :returns: (tuple) result of ``func`` and the measurement - a dict with
+              ``time`` (ms), ``spans`` (``{name: ms}`` recorded for
+              ``hashtag``), ``peak_rss_kb`` and ``bytes_written``
+
+    ``peak_rss_kb`` is the peak of the benchmark so far, ``bytes_written``
+    counts bytes written during the call (None if ``/proc/self/io`` is not
+    available).
+    """
+    spans = {}
+
+    def listener(span_hashtag, name, duration):
+        if span_hashtag == hashtag:
+            spans[name] = spans.get(name, 0) + duration
+
+    tracing.add_listener(listener)
+    written = _get_usage()[1]
+    tstart = time.time()
+    try:
+        result = func()
+    finally:
+        ttotal = (time.time() - tstart) * 1000
+        tracing.remove_listener(listener)
+    peak_rss, written_after = _get_usage()
+    return result, {
+        'time': ttotal,
+        'spans': spans,
+        'peak_rss_kb': peak_rss,
+        'bytes_written': (written_after - written
+                          if written is not None and written_after is not None
+                          else None)}
+
+
+def _remove_xpi(hashtag):
+    " returns the size of the built XPI "
+    path = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+    status.clear(hashtag)
+    if not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
+
+
+def _run(func, hashtag):
+    result, measurement = measure(func, hashtag)
+    measurement['hashtag'] = hashtag
+    measurement['error'] = result[1] if result and len(result) > 1 else None
+    measurement['xpi_size'] = _remove_xpi(hashtag)
+    return measurement
+
+
+def benchmark_build(revision, runs=5):
+    " returns measurements of building the ``revision`` ``runs`` times "
+    measurements = []
+    for i in range(runs):
+        hashtag = get_hashtag()
+        measurement = _run(lambda: revision.build_xpi(hashtag=hashtag),
+                           hashtag)
+        log.info("[xpi:%s] Benchmark build %d: %dms" % (
+                 hashtag, i + 1, measurement['time']))
+        measurements.append(measurement)
+    return measurements
+
+
+def benchmark_repackage(sdk_source_dir, location=None, runs=5):
+    """returns measurements of repackaging the XPI downloaded from
+    ``location`` (sample add-on by default) ``runs`` times
+    """
+    location = location or 'file://%s' % SAMPLE_XPI
+    measurements = []
+
+    def repackage(hashtag):
+        rep = Repackage()
+        tdownload = time.time()
+        rep.download(location)
+        tracing.add_span(hashtag, 'download', tdownload)
+        return rep.rebuild(sdk_source_dir, hashtag)
+
+    for i in range(runs):
+        hashtag = get_hashtag()
+        measurement = _run(lambda: repackage(hashtag), hashtag)
+        log.info("[xpi:%s] Benchmark repackage %d: %dms" % (
+                 hashtag, i + 1, measurement['time']))
+        measurements.append(measurement)
+    return measurements
+
+
+def summarize(measurements):
+    """:returns: (dict) ``{stage: {'min', 'median', 'max'}}`` of the spans and
+    the total time
+    """
+    values = {}
+    for measurement in measurements:
+        values.setdefault('total', []).append(measurement['time'])
+        for name, duration in measurement['spans'].items():
+            values.setdefault(name, []).append(duration)
+    summary = {}
+    for name, durations in values.items():
+        durations.sort()
+        summary[name] = {
+            'min': durations[0],
+            'median': durations[len(durations) / 2],
+            'max': durations[-1]}
+    return summary
+
+
+def run(sdk=None, author=None, runs=5, repackage=True, **addon_options):
+    """Run the benchmark
+
+    :params:
+        * sdk (SDK) used to build and repackage, ``TEST_SDK`` by default
+        * author (User) owner of synthetic packages, the first user by
+          default
+        * runs (int) number of builds and repackages
+        * repackage (bool) benchmark :meth:`Repackage.rebuild` as well
+        * addon_options - passed to :func:`create_addon`
+
+    :returns: (dict) options of the benchmark, measurements and their
+              summary
+    """
+    sdk = sdk or get_benchmark_sdk()
+    if not sdk:
+        raise SDK.DoesNotExist("SDK %s is not registered" % settings.TEST_SDK)
+    author = author or User.objects.order_by('pk')[0]
+    results = {
+        'started': time.time(),
+        'sdk': sdk.version,
+        'runs': runs,
+        'addon': addon_options}
+    attachment_paths = []
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        revision = create_addon(author, sdk=sdk, **addon_options)
+        attachment_paths = [att.get_file_path()
+                            for att in revision.attachments.all()]
+        results['build'] = benchmark_build(revision, runs)
+        results['summary'] = {'build': summarize(results['build'])}
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+        for path in attachment_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+    if repackage:
+        results['repackage'] = benchmark_repackage(sdk.get_source_dir(),
+                                                   runs=runs)
+        results['summary']['repackage'] = summarize(results['repackage'])
+    results['finished'] = time.time()
+    return results
@@ -0,0 +1,373 @@
+"""
+xpi.engine
+----------
+
+Runs ``cfx xpi`` inside the current (long living) worker process instead of
+spawning a new Python interpreter for every build.
+
+Every SDK version has its own copy of the ``cuddlefish`` package. Modules
+imported from ``<sdk>/python-lib`` are kept per SDK and swapped into
+``sys.modules`` only for the time of the build, so different SDK versions
+(and the ``cuddlefish`` used by FlightDeck itself) never see each other.
+"""
+import filecmp
+import functools
+import os
+import sys
+import threading
+import time
+import traceback
+import xml.dom.minidom
+import StringIO
+
+import commonware.log
+
+from django.conf import settings
+
+from cuddlefish.manifest import memoize_scan_module
+from xpi import artifacts, segment
+
+log = commonware.log.getLogger('f.xpi.engine')
+
+#: packages which are imported from the SDK's ``python-lib``
+ISOLATED_PACKAGES = ('cuddlefish',)
+
+# builds are changing process wide state (sys.modules, sys.path, cwd)
+_lock = threading.RLock()
+# sdk_source -> {module_name: module}
+_sdk_modules = {}
+# sdk_source -> packages config of the SDK (``packaging.build_config``)
+_sdk_configs = {}
+
+
+class PackageConflict(Exception):
+    " Package exported for the build has the name of an SDK package "
+
+
+class CfxResult(object):
+    """Structured result of the ``cfx`` run
+
+    :attr: stdout (String) captured standard output
+    :attr: stderr (String) captured standard error (with traceback if
+           ``cfx`` failed with an exception)
+    :attr: exit_code (int) argument of ``sys.exit`` called by ``cfx``
+    :attr: error (String) representation of the exception raised by ``cfx``
+    :attr: time (float) time of the ``cfx`` run in ms
+    """
+
+    def __init__(self, stdout='', stderr='', exit_code=0, error=None,
+                 time=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+        self.error = error
+        self.time = time
+
+    @property
+    def success(self):
+        return not self.exit_code and not self.error and not self.stderr
+
+    def get_response(self):
+        """:returns: (tuple) the same as ``subprocess.communicate`` would
+        return for the ``cfx`` command"""
+        return (self.stdout, self.stderr)
+
+
+class _StreamProxy(object):
+    """File-like object forwarding writes to the buffer of the running build
+
+    cuddlefish binds ``sys.stderr`` as a default argument at import time, the
+    proxy is what gets bound, so output is always captured by the build which
+    is currently running.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.buffer = None
+
+    def _target(self):
+        return self.buffer if self.buffer is not None else self.fallback
+
+    def write(self, data):
+        self._target().write(data)
+
+    def writelines(self, lines):
+        self._target().writelines(lines)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+_stdout = _StreamProxy(sys.__stdout__)
+_stderr = _StreamProxy(sys.__stderr__)
+
+
+def _is_isolated(name):
+    for package in ISOLATED_PACKAGES:
+        if name == package or name.startswith('%s.' % package):
+            return True
+    return False
+
+
+def _swap_modules(modules):
+    """Replace all isolated modules in ``sys.modules`` with ``modules``
+
+    :returns: (dict) isolated modules removed from ``sys.modules``
+    """
+    removed = {}
+    for name in [name for name in sys.modules if _is_isolated(name)]:
+        removed[name] = sys.modules.pop(name)
+    sys.modules.update(modules)
+    return removed
+
+
+def get_python_lib(sdk_source):
+    " returns the directory containing SDK's cuddlefish "
+    return os.path.join(sdk_source, 'python-lib')
+
+
+def is_loaded(sdk_source):
+    " check if SDK's modules are already imported "
+    return sdk_source in _sdk_modules
+
+
+def forget(sdk_source=None):
+    """Remove imported modules and warm state of the SDK (or all SDKs)"""
+    with _lock:
+        if sdk_source:
+            _sdk_modules.pop(sdk_source, None)
+            _sdk_configs.pop(sdk_source, None)
+        else:
+            _sdk_modules.clear()
+            _sdk_configs.clear()
+        segment.forget(sdk_source)
+
+
+class sdk_context(object):
+    """Context manager importing modules from the SDK's ``python-lib``
+
+    :params:
+        * sdk_source (String) directory of the SDK holding ``python-lib``
+
+    Inside the context ``import cuddlefish`` returns the SDK's package.
+    """
+
+    def __init__(self, sdk_source):
+        self.sdk_source = sdk_source
+
+    def __enter__(self):
+        _lock.acquire()
+        self.sys_path = list(sys.path)
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        sys.stdout = _stdout
+        sys.stderr = _stderr
+        sys.path.insert(0, get_python_lib(self.sdk_source))
+        self.removed = _swap_modules(_sdk_modules.get(self.sdk_source, {}))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            loaded = _swap_modules(self.removed)
+            _sdk_modules[self.sdk_source] = loaded
+            sys.path[:] = self.sys_path
+            sys.stdout = self.stdout
+            sys.stderr = self.stderr
+        finally:
+            _lock.release()
+        return False
+
+
+def load(sdk_source):
+    """Import SDK's ``cuddlefish`` package
+
+    :returns: (module) ``cuddlefish`` package of the SDK
+    """
+    with sdk_context(sdk_source):
+        import cuddlefish
+        return cuddlefish
+
+
+def _cache_rdf_templates(rdf):
+    """Parse ``install.rdf`` templates only once per SDK
+
+    ``RDFManifest`` gets a copy of the cached DOM instead of parsing the
+    template file for every build.
+    """
+    if getattr(rdf.RDFManifest, 'templates', None) is not None:
+        return
+    templates = {}
+
+    def __init__(self, path):
+        if path not in templates:
+            templates[path] = xml.dom.minidom.parse(path)
+        self.dom = templates[path].cloneNode(True)
+
+    rdf.RDFManifest.__init__ = __init__
+    rdf.RDFManifest.templates = templates
+
+
+def _memoize_scans():
+    """Scan files of the SDK for ``require`` calls and chrome access only
+    once (see ``cuddlefish.manifest.ScanCache``)
+
+    Called within :class:`sdk_context`
+    """
+    from cuddlefish import manifest
+    memoize_scan_module(manifest, settings.XPI_SCAN_CACHE_DIR,
+                        functools.partial(artifacts.add, 'scan'))
+    scan_cache = getattr(manifest.scan_module, 'scan_cache', None)
+    if (settings.XPI_SCAN_CACHE_DIR and scan_cache
+            and not scan_cache.directory):
+        log.warning("Scan cache directory (%s) is writable by others, "
+                    "scans are kept in memory" % settings.XPI_SCAN_CACHE_DIR)
+
+
+def warm(sdk_source):
+    """Import SDK's ``cuddlefish``, parse its packages config and
+    ``install.rdf`` template, so builds do not have to
+
+    :params:
+        * sdk_source (String) SDK's source directory
+    """
+    tstart = time.time()
+    with sdk_context(sdk_source):
+        from cuddlefish import packaging, rdf
+        from cuddlefish.bunch import Bunch
+        pkg_cfg = packaging.build_config(sdk_source, Bunch(name='dummy'))
+        del pkg_cfg.packages['dummy']
+        _sdk_configs[sdk_source] = pkg_cfg
+        _cache_rdf_templates(rdf)
+        _memoize_scans()
+        if settings.XPI_SEGMENT_DIR:
+            segment.load(sdk_source)
+        rdf.RDFManifest(os.path.join(
+            os.path.dirname(rdf.__file__), 'app-extension', 'install.rdf'))
+    log.info("SDK (%s) warmed up (%dms)" % (
+             sdk_source, (time.time() - tstart) * 1000))
+
+
+def is_warm(sdk_source):
+    " check if SDK's packages config is loaded "
+    return sdk_source in _sdk_configs
+
+
+def _is_sdk_package(package_dir, sdk_package):
+    """Is ``package_dir`` the SDK package linked or copied into the build
+    directory (see :func:`xpi.xpi_utils.sdk_workspace`)?
+    """
+    sdk_package_dir = sdk_package.get('root_dir')
+    if not sdk_package_dir:
+        return False
+    if os.path.realpath(package_dir) == os.path.realpath(sdk_package_dir):
+        return True
+    try:
+        return filecmp.cmp(os.path.join(package_dir, 'package.json'),
+                           os.path.join(sdk_package_dir, 'package.json'),
+                           shallow=False)
+    except OSError:
+        return False
+
+
+def _get_pkg_cfg(sdk_source, sdk_dir):
+    """Build packages config from the SDK's warm config and the packages
+    exported into ``sdk_dir/packages`` for this build
+
+    Called within :class:`sdk_context`
+
+    :returns: (Bunch) or None if SDK is not warm
+    :raises: :class:`PackageConflict` if an exported package replaced an
+             SDK package, the warm config would build it from the SDK
+    """
+    sdk_cfg = _sdk_configs.get(sdk_source)
+    if not sdk_cfg:
+        return None
+    from cuddlefish import packaging
+    from cuddlefish.bunch import Bunch
+    packages = Bunch(sdk_cfg.packages)
+    packages_dir = os.path.join(sdk_dir, 'packages')
+    for dirname in os.listdir(packages_dir):
+        if dirname.startswith('.'):
+            continue
+        if dirname in sdk_cfg.packages:
+            if not _is_sdk_package(os.path.join(packages_dir, dirname),
+                                   sdk_cfg.packages[dirname]):
+                raise PackageConflict(
+                        "Package %s has the name of an SDK package" % dirname)
+            continue
+        cfg = packaging.get_config_in_dir(
+                os.path.join(packages_dir, dirname))
+        if 'packages' in cfg:
+            # nested packages directories - let cfx scan everything
+            return None
+        packages[cfg.name] = cfg
+    return Bunch(packages=packages)
+
+
+def run_cfx(sdk_source, sdk_dir, package_dir, arguments, build_xpi=None):
+    """Run ``cfx`` with ``arguments`` from within the current process
+
+    :params:
+        * sdk_source (String) SDK's source directory - used to import the
+          ``cuddlefish`` package
+        * sdk_dir (String) directory of the prepared SDK (``CUDDLEFISH_ROOT``)
+        * package_dir (String) directory of the package to build, ``cfx``
+          is run from here
+        * arguments (list) ``cfx`` arguments
+        * build_xpi (function) replaces ``cuddlefish.xpi.build_xpi`` for
+          this run, it is called with the original function followed by the
+          keyword arguments passed by ``cfx``
+
+    :returns: :class:`CfxResult`
+    """
+    result = CfxResult()
+    stdout = StringIO.StringIO()
+    stderr = StringIO.StringIO()
+    tstart = time.time()
+    with sdk_context(sdk_source):
+        cwd = os.getcwd()
+        _stdout.buffer = stdout
+        _stderr.buffer = stderr
+        xpi = None
+        try:
+            os.chdir(package_dir)
+            import cuddlefish
+            _memoize_scans()
+            from cuddlefish import xpi
+            original_build_xpi = xpi.build_xpi
+            original_zipfile = xpi.zipfile
+            if build_xpi:
+                xpi.build_xpi = functools.partial(build_xpi,
+                                                  original_build_xpi)
+            if settings.XPI_SEGMENT_DIR:
+                try:
+                    xpi.zipfile = segment.get_zipfile_module(sdk_source,
+                                                             sdk_dir)
+                except Exception, err:
+                    log.warning("Unable to use segment of SDK (%s): %s" % (
+                                sdk_source, str(err)))
+            cuddlefish.run(arguments=list(arguments), env_root=sdk_dir,
+                           pkg_cfg=_get_pkg_cfg(sdk_source, sdk_dir))
+        except SystemExit, err:
+            result.exit_code = err.code or 0
+        except Exception, err:
+            result.error = repr(err)
+            traceback.print_exc(file=stderr)
+        finally:
+            if xpi:
+                xpi.build_xpi = original_build_xpi
+                xpi.zipfile = original_zipfile
+            _stdout.buffer = None
+            _stderr.buffer = None
+            os.chdir(cwd)
+    result.stdout = stdout.getvalue()
+    result.stderr = stderr.getvalue()
+    if result.exit_code and not result.stderr:
+        result.stderr = 'cfx exited with code %s' % result.exit_code
+    result.time = (time.time() - tstart) * 1000
+    log.debug("cfx %s run in process (%dms, exit code: %s)" % (
+              ' '.join(arguments), result.time, result.exit_code))
+    return result
@@ -0,0 +1,301 @@
+"""
+xpi.incremental
+---------------
+
+Rebuilds test XPIs by patching the last XPI built for the revision.
+
+After every build a copy of the XPI is kept in ``XPI_INCREMENTAL_DIR``
+together with a record of the modules and attachments it was built from.
+Test builds of the same revision replace only the members which changed and
+copy the others without recompressing. ``harness-options.json`` is rewritten
+only if the manifest holds hashes of the changed modules. If a module
+changed its ``require`` calls or chrome access, the add-on is built by cfx.
+"""
+import hashlib
+import os
+import simplejson
+import tempfile
+import time
+import zipfile
+import StringIO
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+
+from cuddlefish.manifest import scan_module
+from xpi import artifacts, status, zip_utils
+from xpi.assembler import is_ignored
+
+log = commonware.log.getLogger('f.xpi.incremental')
+
+
+def _encode(code):
+    if isinstance(code, unicode):
+        return code.encode('utf-8')
+    return code
+
+
+def get_base_paths(revision):
+    """:returns: (tuple) paths of the base XPI and of its record"""
+    base = os.path.join(settings.XPI_INCREMENTAL_DIR, str(revision.pk))
+    return ('%s.xpi' % base, '%s.json' % base)
+
+
+def _get_sources(revision, modules=(), attachments=()):
+    """Find content of every module and attachment taking the edited ones
+    into account
+
+    :returns: (tuple) ``{filename: code}`` of modules and
+              ``{filename: (path, content)}`` of attachments
+    """
+    edited = dict((mod.pk, mod) for mod in modules)
+    mod_sources = {}
+    for mod in revision.modules.all():
+        mod = edited.get(mod.pk, mod)
+        mod_sources[mod.get_filename()] = _encode(mod.code)
+    edited = dict((att.pk, att) for att in attachments)
+    att_sources = {}
+    for att in revision.attachments.all():
+        att = edited.get(att.pk, att)
+        filename = att.get_filename()
+        if is_ignored(filename):
+            continue
+        if hasattr(att, 'code'):
+            att_sources[filename] = (None, _encode(att.code))
+        else:
+            att_sources[filename] = (att.get_file_path(), None)
+    return mod_sources, att_sources
+
+
+def _scan_module(filename, code):
+    " returns record of the module "
+    requires, chrome, problems = scan_module(
+            filename, code.splitlines(True), StringIO.StringIO())
+    return {
+        'sha1': hashlib.sha1(code).hexdigest(),
+        'requires': list(requires),
+        'chrome': chrome,
+        'problems': problems}
+
+
+def _get_attachment_hash(source):
+    " saved attachments are marked with ``None`` "
+    path, content = source
+    if path:
+        return None
+    return hashlib.sha1(content).hexdigest()
+
+
+def _get_resources(harness_options, package_name):
+    """Find resources holding the modules and data of the package
+
+    :returns: (tuple) names of the lib and data resources
+    """
+    data = harness_options['packageData'][package_name]
+    data = data[len('resource://'):].strip('/')
+    lib = [name for name, package in
+           harness_options['resourcePackages'].items()
+           if package == package_name
+           and 'resource://%s/' % name in harness_options['rootPaths']]
+    if len(lib) != 1:
+        raise ValueError("Unable to find lib resource of %s" % package_name)
+    return lib[0], data
+
+
+def _write_base(revision, xpi_path, record):
+    " keep the XPI and its record, replacing the previous ones atomically "
+    base_path, record_path = get_base_paths(revision)
+    artifacts.makedirs(settings.XPI_INCREMENTAL_DIR)
+    artifacts.publish(xpi_path, base_path)
+    artifacts.add('incremental', base_path)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.XPI_INCREMENTAL_DIR)
+    with os.fdopen(fd, 'w') as f:
+        f.write(simplejson.dumps(record))
+    os.rename(tmp_path, record_path)
+
+
+def remember(revision, xpi_path, modules=(), attachments=()):
+    """Keep the built XPI as the base of incremental rebuilds
+
+    :params:
+        * revision (PackageRevision) add-on the XPI was built from
+        * xpi_path (String) path of the built XPI
+        * modules (list) edited modules used in the build
+        * attachments (list) edited attachments used in the build
+    """
+    if not settings.XPI_INCREMENTAL_DIR:
+        return
+    try:
+        xpi = zipfile.ZipFile(xpi_path)
+        try:
+            harness_options = simplejson.loads(
+                    xpi.read('harness-options.json'))
+        finally:
+            xpi.close()
+        lib, data = _get_resources(harness_options, revision.name)
+        mod_sources, att_sources = _get_sources(revision, modules,
+                                                attachments)
+        record = {
+            'sdk': revision.sdk.pk,
+            'lib': lib,
+            'data': data,
+            'modules': dict((filename, _scan_module(filename, code))
+                            for filename, code in mod_sources.items()),
+            'attachments': dict((filename, _get_attachment_hash(source))
+                                for filename, source in att_sources.items())}
+        _write_base(revision, xpi_path, record)
+    except Exception, err:
+        log.warning("Unable to keep XPI of revision (%s) for incremental "
+                    "builds: %s" % (revision.pk, str(err)))
+
+
+def _load_record(revision):
+    base_path, record_path = get_base_paths(revision)
+    if not os.path.isfile(base_path) or not os.path.isfile(record_path):
+        return None
+    with open(record_path) as f:
+        return simplejson.loads(f.read())
+
+
+def _update_harness_options(harness_options, lib, changed_modules):
+    """Update hashes of the changed modules in the manifest
+
+    :returns: (bool) True if ``harness_options`` has changed
+    """
+    manifest = harness_options.get('manifest')
+    if not isinstance(manifest, dict):
+        return False
+    updated = False
+    for filename, code in changed_modules.items():
+        entry = manifest.get('resource://%s/%s' % (lib, filename))
+        if entry and 'jsSHA256' in entry:
+            entry['jsSHA256'] = hashlib.sha256(code).hexdigest()
+            updated = True
+    return updated
+
+
+def _get_member_info(info):
+    " returns new header for the replaced member "
+    zinfo = zipfile.ZipInfo(info.filename, time.localtime()[:6])
+    zinfo.external_attr = info.external_attr
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+
+def rebuild(revision, modules=(), attachments=(), hashtag=None,
+            tstart=None):
+    """Create XPI of the add-on with edited modules and attachments by
+    patching its base XPI
+
+    :returns: (list) response as :func:`xpi.xpi_utils.build` or None if
+              the add-on needs to be built from scratch
+    """
+    if not settings.XPI_INCREMENTAL_DIR:
+        return None
+    if not tstart:
+        tstart = time.time()
+    record = _load_record(revision)
+    if not record or record['sdk'] != revision.sdk.pk:
+        statsd.incr('xpi.incremental.miss')
+        return None
+    mod_sources, att_sources = _get_sources(revision, modules, attachments)
+    if (set(mod_sources) != set(record['modules'])
+            or set(att_sources) != set(record['attachments'])):
+        statsd.incr('xpi.incremental.miss')
+        return None
+
+    mod_records = {}
+    changed_modules = {}
+    for filename, code in mod_sources.items():
+        mod_record = record['modules'][filename]
+        if mod_record['sha1'] != hashlib.sha1(code).hexdigest():
+            new_record = _scan_module(filename, code)
+            if (new_record['problems']
+                    or new_record['requires'] != mod_record['requires']
+                    or new_record['chrome'] != mod_record['chrome']):
+                log.debug("[xpi:%s] Requirements of %s changed" % (
+                          hashtag, filename))
+                statsd.incr('xpi.incremental.requirements')
+                return None
+            mod_record = new_record
+            changed_modules[filename] = code
+        mod_records[filename] = mod_record
+    changed_attachments = {}
+    att_records = {}
+    for filename, source in att_sources.items():
+        att_records[filename] = _get_attachment_hash(source)
+        if att_records[filename] != record['attachments'][filename]:
+            changed_attachments[filename] = source
+
+    members = {}
+    for filename, code in changed_modules.items():
+        members['resources/%s/%s' % (record['lib'], filename)] = (None, code)
+    for filename, source in changed_attachments.items():
+        members['resources/%s/%s' % (record['data'], filename)] = source
+
+    base_path, record_path = get_base_paths(revision)
+    xpi_targetpath = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+    artifacts.makedirs(settings.XPI_TARGETDIR)
+    fd, xpi_path = tempfile.mkstemp(suffix='.xpi', prefix='.%s-' % hashtag,
+                                    dir=settings.XPI_TARGETDIR)
+    os.close(fd)
+    try:
+        base = zipfile.ZipFile(base_path)
+        xpi = zipfile.ZipFile(xpi_path, 'w', zipfile.ZIP_DEFLATED)
+        harness_options = None
+        if changed_modules:
+            harness_options = simplejson.loads(
+                    base.read('harness-options.json'))
+            if not _update_harness_options(harness_options, record['lib'],
+                                           changed_modules):
+                harness_options = None
+        patched = 0
+        for info in base.infolist():
+            if info.filename in members:
+                path, content = members.pop(info.filename)
+                if path:
+                    xpi.write(str(path), info.filename)
+                else:
+                    xpi.writestr(_get_member_info(info), content)
+                patched += 1
+            elif (info.filename == 'harness-options.json'
+                    and harness_options is not None):
+                xpi.writestr(_get_member_info(info), simplejson.dumps(
+                    harness_options, indent=1, sort_keys=True))
+                patched += 1
+            else:
+                zip_utils.copy_member(base, info, xpi)
+        xpi.close()
+        base.close()
+        if members:
+            raise ValueError("Members missing in base XPI (%s)" %
+                             ', '.join(members.keys()))
+        os.rename(xpi_path, xpi_targetpath)
+        artifacts.touch(base_path)
+        artifacts.add('target', xpi_targetpath)
+    except Exception, err:
+        log.warning("[xpi:%s] Incremental build failed: %s" % (
+                    hashtag, str(err)))
+        statsd.incr('xpi.incremental.failed')
+        if os.path.exists(xpi_path):
+            os.remove(xpi_path)
+        return None
+
+    record['modules'] = mod_records
+    record['attachments'] = att_records
+    try:
+        _write_base(revision, xpi_targetpath, record)
+    except Exception, err:
+        log.warning("[xpi:%s] Unable to update base XPI: %s" % (
+                    hashtag, str(err)))
+
+    build_time = (time.time() - tstart) * 1000
+    statsd.timing('xpi.incremental.build', build_time)
+    log.info('[xpi:%s] Patched %d members of the previous xpi (%dms)' % (
+             hashtag, patched, build_time))
+    response = ('Patched %d members of %s.xpi.\n' % (patched, revision.name),
+                '')
+    status.finish(hashtag, 'success', response[0])
+    return response
@@ -0,0 +1,161 @@
+"""
+xpi.inflight
+------------
+
+Coalescing of concurrent builds of the same saved revision.
+
+The first request for a build fingerprint (the leader) queues the build.
+Requests for the same fingerprint coming in while it's queued or running
+(followers) are registered in the cache instead. After the build the
+leader's XPI (or error) is made available for every follower's hashtag by
+:func:`release`.
+
+The leader's key expires after ``XPI_INFLIGHT_TIMEOUT`` while the build is
+queued. Once it runs (see :class:`leading`) the key is refreshed with the
+shorter ``XPI_INFLIGHT_LEADER_TIMEOUT``, if the worker dies the next
+request for the fingerprint is elected the leader. Followers are kept per
+fingerprint, so they get the result of whichever leader finishes first.
+"""
+import os
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+from django.core.cache import cache
+
+from xpi import artifacts, scheduler, status, tracing
+
+log = commonware.log.getLogger('f.xpi.inflight')
+
+
+def _get_key(fingerprint):
+    return 'xpi:inflight:%s' % fingerprint
+
+
+def _get_followers_key(fingerprint):
+    return '%s:followers' % _get_key(fingerprint)
+
+
+def _follow(leader, hashtag):
+    """Make result of the ``leader``'s build available for ``hashtag``
+
+    :returns: (bool) False if there is no result
+    """
+    record = status.get(leader)
+    if not status.is_finished(record):
+        return False
+    if record['state'] == 'failed':
+        status.finish(hashtag, 'error', record['message'])
+        tracing.finish(hashtag, error='cfx')
+        return True
+    base = os.path.join(settings.XPI_TARGETDIR, leader)
+    if os.path.isfile('%s.xpi' % base):
+        xpi_path = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+        try:
+            artifacts.publish('%s.xpi' % base, xpi_path)
+            artifacts.add('target', xpi_path)
+        except Exception, err:
+            log.warning("[xpi:%s] Unable to copy XPI of %s: %s" % (
+                        hashtag, leader, str(err)))
+            return False
+        status.finish(hashtag, 'success', 'XPI built for %s' % leader)
+        tracing.finish(hashtag)
+        return True
+    return False
+
+
+def join(fingerprint, hashtag):
+    """Attach ``hashtag`` to the build of ``fingerprint`` in flight
+
+    :returns: (bool) True if the caller has to queue the build, False if
+              ``hashtag`` will get the result of the build in flight
+    """
+    key = _get_key(fingerprint)
+    if cache.add(key, hashtag, settings.XPI_INFLIGHT_TIMEOUT):
+        return True
+    leader = cache.get(key)
+    if not leader:
+        return True
+    if leader == hashtag:
+        # request repeated, the build in flight finishes it
+        return False
+    followers_key = _get_followers_key(fingerprint)
+    cache.add(followers_key, 0, settings.XPI_INFLIGHT_TIMEOUT)
+    try:
+        number = cache.incr(followers_key)
+    except ValueError:
+        # the build has just been released
+        return not _follow(leader, hashtag)
+    cache.set('%s:%d' % (followers_key, number), hashtag,
+              settings.XPI_INFLIGHT_TIMEOUT)
+    if cache.get(key) != leader:
+        # released before the follower was registered
+        return not _follow(leader, hashtag)
+    log.info("[xpi:%s] Joined build of %s" % (hashtag, leader))
+    statsd.incr('xpi.inflight.joined')
+    return False
+
+
+def refresh(fingerprint, hashtag):
+    """Keep ``hashtag`` the leader of ``fingerprint`` for
+    ``XPI_INFLIGHT_LEADER_TIMEOUT`` seconds
+    """
+    key = _get_key(fingerprint)
+    leader = cache.get(key)
+    if leader == hashtag:
+        cache.set(key, hashtag, settings.XPI_INFLIGHT_LEADER_TIMEOUT)
+    elif not leader:
+        cache.add(key, hashtag, settings.XPI_INFLIGHT_LEADER_TIMEOUT)
+
+
+class leading(object):
+    """Lead the build of ``fingerprint`` while the block runs
+
+    The leader's key is refreshed in a thread, results are passed to the
+    followers by :func:`release` on exit. Does nothing if ``fingerprint``
+    is None.
+    """
+
+    def __init__(self, fingerprint, hashtag):
+        self.fingerprint = fingerprint
+        self.hashtag = hashtag
+        self.heartbeat = None
+
+    def __enter__(self):
+        if self.fingerprint:
+            refresh(self.fingerprint, self.hashtag)
+            self.heartbeat = scheduler.heartbeat(
+                    lambda: refresh(self.fingerprint, self.hashtag),
+                    settings.XPI_INFLIGHT_LEADER_TIMEOUT / 3.0)
+            self.heartbeat.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.heartbeat:
+            self.heartbeat.__exit__(exc_type, exc_value, tb)
+        if self.fingerprint:
+            release(self.fingerprint, self.hashtag)
+
+
+def release(fingerprint, hashtag):
+    """Finish the build of the leader ``hashtag``, pass its result to the
+    followers of ``fingerprint``
+    """
+    key = _get_key(fingerprint)
+    if cache.get(key) == hashtag:
+        cache.delete(key)
+    followers_key = _get_followers_key(fingerprint)
+    number = cache.get(followers_key) or 0
+    cache.delete(followers_key)
+    if not number:
+        return
+    follower_keys = ['%s:%d' % (followers_key, i)
+                     for i in range(1, number + 1)]
+    followers = cache.get_many(follower_keys)
+    cache.delete_many(follower_keys)
+    for follower in followers.values():
+        if not _follow(hashtag, follower):
+            log.warning("[xpi:%s] No result of %s to follow" % (
+                        follower, hashtag))
+            status.finish(follower, 'error', 'Add-on build failed')
@@ -0,0 +1,142 @@
+"""
+xpi.library_cache
+-----------------
+
+Exported library package directories shared across builds.
+
+Library revisions do not change once saved. Each one is exported into
+``LIBRARY_EXPORT_DIR`` once per SDK and linked into the ``packages``
+directory of every build which depends on it. Least recently used exports
+are removed when the directory grows over ``LIBRARY_EXPORT_MAX_SIZE``.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+
+log = commonware.log.getLogger('f.xpi.library_cache')
+
+# exports used recently might be linked into running builds
+MIN_EVICTION_AGE = 10 * 60  # seconds
+SIZE_FILE_SUFFIX = '.size'
+
+
+def is_enabled():
+    return bool(settings.LIBRARY_EXPORT_DIR) and hasattr(os, 'symlink')
+
+
+def get_export_path(revision, sdk=None):
+    " returns directory of the exported library revision "
+    sdk_id = sdk.pk if sdk else 0
+    return os.path.join(settings.LIBRARY_EXPORT_DIR, '%d-%d-%d' % (
+        revision.pk, sdk_id, time.mktime(revision.created_at.timetuple())))
+
+
+def is_export(path):
+    " is ``path`` a link to an exported library revision? "
+    if not settings.LIBRARY_EXPORT_DIR or not os.path.islink(path):
+        return False
+    return (os.path.dirname(os.path.realpath(path)) ==
+            os.path.realpath(settings.LIBRARY_EXPORT_DIR))
+
+
+def _get_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def _export(revision, export_path, sdk=None):
+    " export the library revision (without dependencies) atomically "
+    tmp_dir = tempfile.mkdtemp(dir=settings.LIBRARY_EXPORT_DIR,
+                               prefix='.export-')
+    try:
+        revision.export_files(tmp_dir, sdk=sdk)
+        package_dir = revision.get_dir_name(tmp_dir)
+        with open('%s%s' % (export_path, SIZE_FILE_SUFFIX), 'w') as f:
+            f.write(str(_get_size(package_dir)))
+        try:
+            os.rename(package_dir, export_path)
+        except OSError:
+            # exported by another build in the meantime
+            if not os.path.isdir(export_path):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def link(revision, packages_dir, sdk=None):
+    """Link exported library revision into ``packages_dir``, export it if
+    needed
+
+    :returns: (bool) False if library has to be exported by the caller
+    """
+    if not is_enabled():
+        return False
+    package_dir = revision.get_dir_name(packages_dir)
+    if os.path.lexists(package_dir):
+        # package included multiple times
+        return True
+    export_path = get_export_path(revision, sdk)
+    try:
+        if os.path.isdir(export_path):
+            statsd.incr('xpi.library_cache.hit')
+            # mark as recently used
+            os.utime(export_path, None)
+        else:
+            statsd.incr('xpi.library_cache.miss')
+            if not os.path.isdir(settings.LIBRARY_EXPORT_DIR):
+                os.makedirs(settings.LIBRARY_EXPORT_DIR)
+            _export(revision, export_path, sdk=sdk)
+            evict()
+        os.symlink(export_path, package_dir)
+    except Exception, err:
+        log.warning("Unable to link exported library (%s): %s" % (
+                    export_path, str(err)))
+        return False
+    return True
+
+
+def evict(max_size=None):
+    """Remove least recently used exports until the directory fits in
+    ``max_size`` bytes (``LIBRARY_EXPORT_MAX_SIZE`` by default)
+    """
+    if max_size is None:
+        max_size = settings.LIBRARY_EXPORT_MAX_SIZE
+    exports = []
+    total = 0
+    for filename in os.listdir(settings.LIBRARY_EXPORT_DIR):
+        path = os.path.join(settings.LIBRARY_EXPORT_DIR, filename)
+        if filename.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            with open('%s%s' % (path, SIZE_FILE_SUFFIX)) as f:
+                size = int(f.read())
+        except (IOError, ValueError):
+            size = _get_size(path)
+        exports.append((os.path.getmtime(path), size, path))
+        total += size
+    if total <= max_size:
+        return
+    exports.sort()
+    now = time.time()
+    for used, size, path in exports:
+        if total <= max_size or now - used < MIN_EVICTION_AGE:
+            break
+        log.debug("Evicting exported library (%s)" % path)
+        try:
+            shutil.rmtree(path)
+            os.remove('%s%s' % (path, SIZE_FILE_SUFFIX))
+        except OSError, err:
+            log.warning("Unable to evict exported library (%s): %s" % (
+                        path, str(err)))
+            continue
+        total -= size
+        statsd.incr('xpi.library_cache.evicted')
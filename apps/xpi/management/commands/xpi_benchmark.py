@@ -0,0 +1,82 @@
+"""
+xpi.management.commands.xpi_benchmark
+-------------------------------------
+
+Benchmark building and repackaging of a synthetic add-on, write the results
+as JSON (see :mod:`xpi.benchmark`)
+"""
+import simplejson
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from jetpack.models import SDK
+from xpi import benchmark
+
+
+class Command(BaseCommand):
+    args = "[output file]"
+    help = "Benchmark the XPI build pipeline on a synthetic add-on"
+    option_list = BaseCommand.option_list + (
+            make_option('--runs', action='store', type='int', dest='runs',
+                default=5, help='Number of builds and repackages'),
+            make_option('--modules', action='store', type='int',
+                dest='modules', default=10,
+                help='Number of modules of the add-on'),
+            make_option('--module-size', action='store', type='int',
+                dest='module_size', default=1024,
+                help='Size of a module in bytes'),
+            make_option('--attachments', action='store', type='int',
+                dest='attachments', default=2,
+                help='Number of attachments of the add-on'),
+            make_option('--attachment-size', action='store', type='int',
+                dest='attachment_size', default=10240,
+                help='Size of an attachment in bytes'),
+            make_option('--depth', action='store', type='int', dest='depth',
+                default=1,
+                help='Length of the chain of libraries the add-on uses'),
+            make_option('--library-modules', action='store', type='int',
+                dest='library_modules', default=2,
+                help='Number of modules of every library'),
+            make_option('--sdk', action='store', dest='sdk', default=None,
+                help='Version of the SDK, TEST_SDK by default'),
+            make_option('--no-repackage', action='store_false',
+                dest='repackage', default=True,
+                help='Do not benchmark repackaging'),
+            )
+
+    def handle(self, *args, **options):
+        sdk = None
+        if options['sdk']:
+            try:
+                sdk = SDK.objects.get(version=options['sdk'])
+            except SDK.DoesNotExist:
+                self.stderr.write("ERROR: SDK %s does not exist\n" %
+                                  options['sdk'])
+                exit(1)
+        elif not benchmark.get_benchmark_sdk():
+            self.stderr.write("ERROR: SDK %s is not registered, load it with "
+                              "./manage.py add_core_lib %s or use --sdk\n" % (
+                                  settings.TEST_SDK, settings.TEST_SDK))
+            exit(1)
+
+        results = benchmark.run(
+                sdk=sdk,
+                runs=options['runs'],
+                repackage=options['repackage'],
+                modules=options['modules'],
+                module_size=options['module_size'],
+                attachments=options['attachments'],
+                attachment_size=options['attachment_size'],
+                depth=options['depth'],
+                library_modules=options['library_modules'])
+        output = simplejson.dumps(results, indent=2)
+
+        if args:
+            with open(args[0], 'w') as f:
+                f.write(output)
+            self.stdout.write("Results written to %s\n" % args[0])
+        else:
+            self.stdout.write("%s\n" % output)
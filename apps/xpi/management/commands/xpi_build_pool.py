@@ -0,0 +1,52 @@
+"""
+xpi.management.commands.xpi_build_pool
+--------------------------------------
+
+Run the pool of pre-forked XPI build processes or print its utilisation
+"""
+import simplejson
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from jetpack.models import SDK
+from xpi import pool
+
+
+class Command(BaseCommand):
+    args = "[stats]"
+    help = "Run pre-forked XPI build processes on XPI_BUILD_POOL_ADDRESS"
+    option_list = BaseCommand.option_list + (
+            make_option('--size',
+                action='store',
+                type='int',
+                dest='size',
+                default=settings.XPI_BUILD_POOL_SIZE,
+                help='Number of build processes'),
+            )
+
+    def handle(self, *args, **options):
+        if not settings.XPI_BUILD_POOL_ADDRESS:
+            self.stderr.write("ERROR: XPI_BUILD_POOL_ADDRESS is not set\n")
+            exit(1)
+        if not settings.XPI_BUILD_POOL_AUTHKEY:
+            self.stderr.write("ERROR: XPI_BUILD_POOL_AUTHKEY is not set\n")
+            exit(1)
+
+        if args and args[0] == 'stats':
+            self.stdout.write("%s\n" % simplejson.dumps(pool.get_stats(),
+                                                        indent=2))
+            return
+
+        sdk_sources = [sdk.get_source_dir() for sdk in SDK.objects.all()]
+        build_pool = pool.BuildPool(options['size'], sdk_sources)
+        build_pool.start()
+        try:
+            build_pool.serve(settings.XPI_BUILD_POOL_ADDRESS,
+                             authkey=pool.get_authkey())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            build_pool.stop()
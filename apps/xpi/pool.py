@@ -0,0 +1,311 @@
+"""
+xpi.pool
+--------
+
+Pool of pre-forked XPI build processes.
+
+Every worker imports ``cuddlefish``, parses the packages config and the
+``install.rdf`` template of each SDK once (:func:`xpi.engine.warm`) and then
+runs ``cfx xpi`` for the jobs it gets from a local queue. Build tasks talk to
+the pool over ``XPI_BUILD_POOL_ADDRESS`` (see :func:`run_cfx`). The pool is
+started with ``./manage.py xpi_build_pool``.
+"""
+import itertools
+import multiprocessing
+import os
+import Queue
+import threading
+import time
+
+from multiprocessing.connection import Listener, Client
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from xpi import engine
+
+log = commonware.log.getLogger('f.xpi.pool')
+
+
+class PoolError(Exception):
+    " Build pool is not available or did not respond in time "
+
+
+def _worker(worker_id, jobs, results, sdk_sources):
+    """Main loop of the pre-forked build process
+
+    Jobs waiting in the queue after their ``deadline`` are dropped, nobody
+    waits for their result anymore.
+    """
+    for sdk_source in sdk_sources:
+        try:
+            engine.warm(sdk_source)
+        except Exception, err:
+            log.error("[pool:%d] Failed to warm up SDK (%s): %s" % (
+                      worker_id, sdk_source, str(err)))
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        tstart = time.time()
+        if job.get('deadline') and tstart > job['deadline']:
+            log.warning("[pool:%d] Build (%s) expired in the queue, dropped"
+                        % (worker_id, job['package_dir']))
+            statsd.incr('xpi.pool.expired')
+            continue
+        if not engine.is_warm(job['sdk_source']):
+            try:
+                engine.warm(job['sdk_source'])
+            except Exception, err:
+                log.error("[pool:%d] Failed to warm up SDK (%s): %s" % (
+                          worker_id, job['sdk_source'], str(err)))
+        result = engine.run_cfx(job['sdk_source'], job['sdk_dir'],
+                                job['package_dir'], job['arguments'])
+        results.put((job['id'], worker_id, result,
+                     (time.time() - tstart) * 1000))
+
+
+class WorkerStats(object):
+    " Utilisation of a single build process "
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.started = time.time()
+        self.jobs = 0
+        self.busy = 0
+        self.restarts = 0
+
+    def get_utilisation(self):
+        " returns part of the time the worker was building (0 - 1) "
+        alive = (time.time() - self.started) * 1000
+        return (self.busy / alive) if alive else 0
+
+    def as_dict(self):
+        return {
+            'worker': self.worker_id,
+            'jobs': self.jobs,
+            'busy': int(self.busy),
+            'restarts': self.restarts,
+            'utilisation': round(self.get_utilisation(), 4)}
+
+
+class BuildPool(object):
+    """Pre-forked build processes accepting jobs over a local queue
+
+    :params:
+        * size (int) number of build processes
+        * sdk_sources (list) SDK directories to warm up in every process
+    """
+
+    def __init__(self, size, sdk_sources=()):
+        self.size = size
+        self.sdk_sources = list(sdk_sources)
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.processes = {}
+        self.stats = {}
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.counter = itertools.count()
+        self.running = False
+
+    def _start_worker(self, worker_id):
+        process = multiprocessing.Process(
+                target=_worker,
+                args=(worker_id, self.jobs, self.results, self.sdk_sources))
+        process.daemon = True
+        process.start()
+        self.processes[worker_id] = process
+
+    def start(self):
+        " fork build processes and start collecting results "
+        self.running = True
+        for worker_id in range(self.size):
+            self.stats[worker_id] = WorkerStats(worker_id)
+            self._start_worker(worker_id)
+        collector = threading.Thread(target=self._collect_results)
+        collector.daemon = True
+        collector.start()
+        log.info("[pool] Started %d build processes" % self.size)
+
+    def stop(self):
+        " ask all build processes to finish "
+        self.running = False
+        for process in self.processes.values():
+            self.jobs.put(None)
+        for process in self.processes.values():
+            process.join(10)
+
+    def _check_workers(self):
+        " restart build processes which died "
+        for worker_id, process in self.processes.items():
+            if not process.is_alive() and self.running:
+                log.error("[pool:%d] Build process died (exit code %s), "
+                          "restarting" % (worker_id, process.exitcode))
+                self.stats[worker_id].restarts += 1
+                self._start_worker(worker_id)
+
+    def _collect_results(self):
+        while self.running:
+            try:
+                job_id, worker_id, result, busy = self.results.get(
+                        timeout=1)
+            except Queue.Empty:
+                self._check_workers()
+                continue
+            stats = self.stats[worker_id]
+            stats.jobs += 1
+            stats.busy += busy
+            statsd.timing('xpi.pool.busy', busy)
+            with self.pending_lock:
+                waiting = self.pending.pop(job_id, None)
+            if waiting:
+                waiting[1] = result
+                waiting[0].set()
+
+    def submit(self, sdk_source, sdk_dir, package_dir, arguments,
+               timeout=None):
+        """Queue the job and wait for the result
+
+        The job is dropped by the build process if it's still in the queue
+        after ``timeout``.
+
+        :returns: :class:`xpi.engine.CfxResult`
+        """
+        job_id = self.counter.next()
+        waiting = [threading.Event(), None]
+        with self.pending_lock:
+            self.pending[job_id] = waiting
+        tqueued = time.time()
+        self.jobs.put({
+            'id': job_id,
+            'sdk_source': sdk_source,
+            'sdk_dir': sdk_dir,
+            'package_dir': package_dir,
+            'arguments': arguments,
+            'deadline': tqueued + timeout if timeout else None})
+        waiting[0].wait(timeout)
+        if not waiting[0].isSet():
+            with self.pending_lock:
+                self.pending.pop(job_id, None)
+            raise PoolError("Build (%s) timed out" % package_dir)
+        statsd.timing('xpi.pool.total', (time.time() - tqueued) * 1000)
+        return waiting[1]
+
+    def get_stats(self):
+        " returns utilisation of every build process "
+        return {
+            'size': self.size,
+            'pending': len(self.pending),
+            'workers': [self.stats[worker_id].as_dict()
+                        for worker_id in sorted(self.stats)]}
+
+    def _handle(self, conn):
+        """Serve requests from one client connection
+
+        Messages are tuples - ``('build', job)`` or ``('stats',)``
+        """
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'build':
+                    job = message[1]
+                    try:
+                        result = self.submit(
+                                job['sdk_source'], job['sdk_dir'],
+                                job['package_dir'], job['arguments'],
+                                timeout=settings.XPI_BUILD_POOL_TIMEOUT)
+                    except PoolError, err:
+                        result = engine.CfxResult(stderr=str(err),
+                                                  error=repr(err))
+                    conn.send(result)
+                elif message[0] == 'stats':
+                    conn.send(self.get_stats())
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+
+    def serve(self, address, authkey=None):
+        " accept jobs from build tasks on ``address`` "
+        if isinstance(address, basestring) and os.path.exists(address):
+            os.remove(address)
+        listener = Listener(address, authkey=authkey)
+        log.info("[pool] Listening on %s" % str(address))
+        try:
+            while self.running:
+                conn = listener.accept()
+                handler = threading.Thread(target=self._handle, args=(conn,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            listener.close()
+
+
+def get_authkey():
+    """returns ``XPI_BUILD_POOL_AUTHKEY``, it has to be set if the pool is
+    used, anyone able to connect could run builds otherwise
+
+    :raises: ``ImproperlyConfigured``
+    """
+    if not settings.XPI_BUILD_POOL_AUTHKEY:
+        raise ImproperlyConfigured(
+                "XPI_BUILD_POOL_AUTHKEY has to be set to use the build pool")
+    return settings.XPI_BUILD_POOL_AUTHKEY
+
+
+def _connect():
+    try:
+        authkey = get_authkey()
+    except ImproperlyConfigured, err:
+        raise PoolError(str(err))
+    try:
+        return Client(settings.XPI_BUILD_POOL_ADDRESS, authkey=authkey)
+    except Exception, err:
+        raise PoolError("Unable to connect to the build pool (%s): %s" % (
+                        settings.XPI_BUILD_POOL_ADDRESS, str(err)))
+
+
+def run_cfx(sdk_source, sdk_dir, package_dir, arguments):
+    """Run ``cfx`` in the build pool, fall back to running it in the
+    current process if pool is not available
+
+    :returns: :class:`xpi.engine.CfxResult`
+    """
+    try:
+        conn = _connect()
+    except PoolError, err:
+        log.warning("[pool] %s - building in process" % str(err))
+        statsd.incr('xpi.pool.fallback')
+        return engine.run_cfx(sdk_source, sdk_dir, package_dir, arguments)
+    try:
+        conn.send(('build', {
+            'sdk_source': sdk_source,
+            'sdk_dir': sdk_dir,
+            'package_dir': package_dir,
+            'arguments': list(arguments)}))
+        # pool answers with an error itself after XPI_BUILD_POOL_TIMEOUT
+        if not conn.poll(settings.XPI_BUILD_POOL_TIMEOUT + 5):
+            err = PoolError("Build pool did not respond in %ss" %
+                            settings.XPI_BUILD_POOL_TIMEOUT)
+            log.error("[pool] %s" % str(err))
+            return engine.CfxResult(stderr=str(err), error=repr(err))
+        return conn.recv()
+    finally:
+        conn.close()
+
+
+def get_stats():
+    """Ask the running pool for utilisation of its build processes
+
+    :returns: (dict) see :meth:`BuildPool.get_stats`
+    """
+    conn = _connect()
+    try:
+        conn.send(('stats',))
+        return conn.recv()
+    finally:
+        conn.close()
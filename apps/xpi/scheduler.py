@@ -0,0 +1,231 @@
+"""
+xpi.scheduler
+-------------
+
+Classes of XPI builds and fair queueing within a class.
+
+Builds belong to one of :data:`CLASSES` - ``test`` (interactive test
+builds), ``download`` and ``bulk`` (low priority repackaging). Each class
+has its own celery tasks routed to its own queue in ``CELERY_ROUTES``, so
+bulk work can't hold up test builds. Every class runs at most its share
+(``XPI_CLASS_SHARES``) of builds at once across all workers. Every running
+build holds a slot - a cache key expiring after ``XPI_SLOT_TIMEOUT``
+seconds which the build refreshes while it runs, so slots of crashed
+workers are free again soon. Tasks picked up while their class uses its
+whole share are queued again after ``XPI_SHARE_RETRY_DELAY`` seconds (see
+:func:`run`).
+
+Within a class, builds of a user who already has
+``XPI_FAIR_FREE_BUILDS`` builds waiting are queued with a countdown
+growing with the number of their waiting builds. Builds of other users
+are picked up before them.
+"""
+import threading
+import time
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = commonware.log.getLogger('f.xpi.scheduler')
+
+CLASSES = ('test', 'download', 'bulk')
+#: keyword arguments added by celery to tasks accepting ``**kwargs``
+MAGIC_KWARGS = ('task_id', 'task_name', 'task_retries', 'task_is_eager',
+                'delivery_info', 'logfile', 'loglevel')
+
+
+def _get_depth_key(build_class):
+    return 'xpi:queue:%s' % build_class
+
+
+def _get_slot_keys(build_class):
+    share = settings.XPI_CLASS_SHARES.get(build_class) or 0
+    return ['xpi:running:%s:%d' % (build_class, slot)
+            for slot in range(share)]
+
+
+def _get_user_key(build_class, user):
+    return 'xpi:queue:%s:%s' % (build_class, user)
+
+
+def _incr(key):
+    " returns the incremented counter "
+    cache.add(key, 0, settings.XPI_QUEUE_TIMEOUT)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # counter expired in the meantime or cache is not shared
+        return 1
+
+
+def _decr(key):
+    try:
+        if cache.decr(key) < 0:
+            cache.set(key, 0, settings.XPI_QUEUE_TIMEOUT)
+    except ValueError:
+        pass
+
+
+def get_user(r):
+    " identifies the user requesting the build "
+    if r.user.is_authenticated():
+        return 'u%d' % r.user.pk
+    return r.META.get('REMOTE_ADDR', '')
+
+
+def enqueue(task, build_class, user=None, args=(), kwargs=None):
+    """Queue the build
+
+    :params:
+        * task (Task) celery task of the ``build_class``
+        * build_class (String) one of :data:`CLASSES`
+        * user (String) identifies the user - see :func:`get_user`
+        * args (tuple), kwargs (dict) arguments of the task
+
+    The task is called with ``tqueued`` and ``user`` keyword arguments which
+    should be passed to :func:`started`.
+
+    :returns: (int) countdown in seconds
+    """
+    kwargs = dict(kwargs or {})
+    waiting = _incr(_get_user_key(build_class, user)) - 1 if user else 0
+    depth = _incr(_get_depth_key(build_class))
+    countdown = (max(0, waiting - settings.XPI_FAIR_FREE_BUILDS + 1) *
+                 settings.XPI_FAIR_DELAY)
+    kwargs['tqueued'] = time.time()
+    kwargs['user'] = user
+    task.apply_async(args=args, kwargs=kwargs, countdown=countdown or None)
+    statsd.incr('xpi.queue.%s.queued' % build_class)
+    statsd.timing('xpi.queue.%s.depth' % build_class, depth)
+    if countdown:
+        log.debug('Build of %s delayed by %ds (%d builds waiting)' % (
+                  user, countdown, waiting))
+        statsd.incr('xpi.queue.%s.delayed' % build_class)
+    return countdown
+
+
+def started(build_class, user=None, tqueued=None):
+    """Record that the build was picked up from the queue
+
+    :returns: (float) time in ms the build waited or None
+    """
+    if user:
+        _decr(_get_user_key(build_class, user))
+    _decr(_get_depth_key(build_class))
+    if not tqueued:
+        return None
+    waited = (time.time() - tqueued) * 1000
+    statsd.timing('xpi.queue.%s.wait' % build_class, waited)
+    return waited
+
+
+def acquire(build_class):
+    """Take a slot of the class's share
+
+    The slot expires after ``XPI_SLOT_TIMEOUT`` seconds unless it's
+    refreshed (see :func:`refresh`).
+
+    :returns: (String) key of the slot, empty if the class has no share or
+              None if the class already runs its share of builds
+    """
+    if settings.CELERY_ALWAYS_EAGER:
+        return ''
+    keys = _get_slot_keys(build_class)
+    if not keys:
+        return ''
+    for running, key in enumerate(keys):
+        if cache.add(key, 1, settings.XPI_SLOT_TIMEOUT):
+            statsd.timing('xpi.queue.%s.running' % build_class, running + 1)
+            return key
+    statsd.incr('xpi.queue.%s.throttled' % build_class)
+    return None
+
+
+def refresh(slot):
+    " keep the slot taken by :func:`acquire` "
+    if slot:
+        cache.set(slot, 1, settings.XPI_SLOT_TIMEOUT)
+
+
+def release(slot):
+    " free the slot taken by :func:`acquire` "
+    if slot:
+        cache.delete(slot)
+
+
+class heartbeat(object):
+    """Call ``func`` every ``interval`` seconds in a thread while the block
+    runs
+
+    Used to refresh cache keys expiring if the worker crashes.
+    """
+
+    def __init__(self, func, interval):
+        self.func = func
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat)
+        self.thread.setDaemon(True)
+
+    def _beat(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                return
+            try:
+                self.func()
+            except Exception, err:
+                log.warning("Heartbeat failed: %s" % str(err))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run(task, build_class, func, args=(), kwargs=None):
+    """Run ``func`` within the share of ``build_class``
+
+    Called by the ``task`` picked up from the queue. If the class already
+    runs its share of builds the task is queued again with the same
+    arguments, the time it waits is counted from the first queueing.
+
+    :returns: result of ``func`` or None if the task was queued again
+    """
+    kwargs = dict((key, value) for key, value in (kwargs or {}).items()
+                  if key not in MAGIC_KWARGS)
+    slot = acquire(build_class)
+    if slot is None:
+        log.debug('Class %s runs its share of builds, %s queued again' % (
+                  build_class, task.name))
+        task.apply_async(args=args, kwargs=kwargs,
+                         countdown=settings.XPI_SHARE_RETRY_DELAY)
+        return None
+    if not slot:
+        return func(*args, **kwargs)
+    try:
+        with heartbeat(lambda: refresh(slot),
+                       settings.XPI_SLOT_TIMEOUT / 3.0):
+            return func(*args, **kwargs)
+    finally:
+        release(slot)
+
+
+def get_running():
+    " returns number of builds running in every class "
+    keys = dict((c, _get_slot_keys(c)) for c in CLASSES)
+    running = cache.get_many(sum(keys.values(), []))
+    return dict((c, len([k for k in keys[c] if k in running]))
+                for c in CLASSES)
+
+
+def get_depths():
+    " returns number of builds waiting in every class "
+    depths = cache.get_many([_get_depth_key(c) for c in CLASSES])
+    return dict((c, depths.get(_get_depth_key(c), 0)) for c in CLASSES)
@@ -0,0 +1,210 @@
+"""
+xpi.segment
+-----------
+
+Pre-compressed SDK files reused by every XPI.
+
+Files of the SDK's packages and of the XPI template are compressed once per
+SDK into a segment archive in ``XPI_SEGMENT_DIR``. During in-process builds
+(:mod:`xpi.engine`) ``cuddlefish.xpi`` gets a ``ZipFile`` which copies the
+compressed bytes and CRC of these files from the segment instead of
+deflating them again. Only the add-on's own files are compressed.
+
+SDK files are recognized in the build directory prepared by
+:func:`xpi.xpi_utils.sdk_workspace` - linked into the SDK source or copied
+with their mtime (``sdk_copy``). A file is taken from the segment only if
+its size and mtime are the ones recorded when the segment was built,
+edited SDK files are compressed.
+"""
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import commonware.log
+from statsd import statsd
+
+from django.conf import settings
+
+from xpi import zip_utils
+
+log = commonware.log.getLogger('f.xpi.segment')
+
+#: directories of the SDK stored in the segment
+SEGMENT_DIRS = ('packages',
+                os.path.join('python-lib', 'cuddlefish', 'app-extension'))
+
+#: version of the segment archive, older segments are built again
+SEGMENT_FORMAT = 2
+
+# sdk_source -> {relative path: (ZipInfo, compressed data, (size, mtime))}
+_segments = {}
+
+
+def get_segment_path(sdk_source):
+    " returns path of the segment archive of the SDK "
+    return os.path.join(settings.XPI_SEGMENT_DIR, '%s.%d.zip' % (
+        hashlib.sha1(os.path.realpath(sdk_source)).hexdigest(),
+        SEGMENT_FORMAT))
+
+
+def _get_stat(path):
+    " returns ``(size, mtime)`` the file is validated with "
+    stat = os.stat(path)
+    return (stat.st_size, int(stat.st_mtime))
+
+
+def build_segment(sdk_source, path):
+    """Compress files of the SDK into the segment archive
+
+    Members are named by their path relative to ``sdk_source``, their
+    comment holds the size and mtime of the file
+    """
+    root = os.path.realpath(sdk_source)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    os.close(fd)
+    zf = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for segment_dir in SEGMENT_DIRS:
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(root, segment_dir)):
+                for filename in filenames:
+                    abspath = os.path.join(dirpath, filename)
+                    arcname = abspath[len(root) + 1:]
+                    zf.write(abspath, arcname)
+                    zf.getinfo(arcname).comment = '%d:%d' % _get_stat(
+                            abspath)
+    finally:
+        zf.close()
+    os.rename(tmp_path, path)
+    log.info("Segment of SDK (%s) created" % sdk_source)
+
+
+def load(sdk_source):
+    """Read the segment archive of the SDK, create it if needed
+
+    :returns: (dict) ``{relative path: (ZipInfo, compressed data)}``
+    """
+    if sdk_source in _segments:
+        return _segments[sdk_source]
+    path = get_segment_path(sdk_source)
+    if not os.path.isfile(path):
+        build_segment(sdk_source, path)
+    segment = {}
+    zf = zipfile.ZipFile(path)
+    try:
+        for info in zf.infolist():
+            size, _, mtime = info.comment.partition(':')
+            segment[info.filename] = (info, zip_utils.read_raw(zf, info),
+                                      (int(size), int(mtime)))
+    finally:
+        zf.close()
+    _segments[sdk_source] = segment
+    return segment
+
+
+def forget(sdk_source=None):
+    " remove loaded segment of the SDK (or all SDKs) "
+    if sdk_source:
+        _segments.pop(sdk_source, None)
+    else:
+        _segments.clear()
+
+
+def _get_arcname(filename, arcname):
+    " normalize ``arcname`` the same way ``ZipFile.write`` does "
+    if arcname is None:
+        arcname = filename
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+
+def get_zipfile_class(sdk_source, sdk_dir=None):
+    """Create ``ZipFile`` which writes SDK files from the segment
+
+    :params:
+        * sdk_source (String) SDK's source directory
+        * sdk_dir (String) build directory with the SDK copied into it
+    :returns: (class) subclass of ``zipfile.ZipFile``
+    """
+    segment = load(sdk_source)
+    root = os.path.realpath(sdk_source)
+    sdk_dir = os.path.abspath(sdk_dir) if sdk_dir else None
+
+    class SegmentZipFile(zipfile.ZipFile):
+
+        def __init__(self, *args, **kwargs):
+            zipfile.ZipFile.__init__(self, *args, **kwargs)
+            self.copied = 0
+            self.compressed = 0
+
+        def _get_entry(self, filename):
+            realpath = os.path.realpath(filename)
+            abspath = os.path.abspath(filename)
+            if realpath.startswith(root + os.sep):
+                # linked
+                name = realpath[len(root) + 1:]
+            elif sdk_dir and abspath.startswith(sdk_dir + os.sep):
+                # copied
+                name = abspath[len(sdk_dir) + 1:]
+            else:
+                return None
+            entry = segment.get(name)
+            try:
+                if not entry or _get_stat(realpath) != entry[2]:
+                    return None
+            except OSError:
+                return None
+            return entry
+
+        def write(self, filename, arcname=None, compress_type=None):
+            entry = None
+            if (self.compression == zipfile.ZIP_DEFLATED
+                    and compress_type in (None, zipfile.ZIP_DEFLATED)):
+                entry = self._get_entry(filename)
+            if not entry:
+                self.compressed += 1
+                return zipfile.ZipFile.write(self, filename, arcname,
+                                             compress_type)
+            info, data, _ = entry
+            zinfo = zipfile.ZipInfo(_get_arcname(filename, arcname),
+                                    info.date_time)
+            zinfo.compress_type = info.compress_type
+            zinfo.external_attr = info.external_attr
+            zinfo.create_system = info.create_system
+            zinfo.flag_bits = info.flag_bits
+            zinfo.CRC = info.CRC
+            zinfo.file_size = info.file_size
+            zip_utils.write_raw(self, zinfo, data)
+            self.copied += 1
+
+        def close(self):
+            if self.fp is not None and (self.copied or self.compressed):
+                statsd.incr('xpi.segment.copied', self.copied)
+                statsd.incr('xpi.segment.compressed', self.compressed)
+            zipfile.ZipFile.close(self)
+
+    return SegmentZipFile
+
+
+class ZipModule(object):
+    """Stands for the ``zipfile`` module in ``cuddlefish.xpi``
+
+    Everything but ``ZipFile`` is taken from :mod:`zipfile`
+    """
+
+    def __init__(self, zipfile_class):
+        self.ZipFile = zipfile_class
+
+    def __getattr__(self, name):
+        return getattr(zipfile, name)
+
+
+def get_zipfile_module(sdk_source, sdk_dir=None):
+    " returns replacement of the ``zipfile`` module for the SDK's build "
+    return ZipModule(get_zipfile_class(sdk_source, sdk_dir))
@@ -0,0 +1,225 @@
+"""
+xpi.status
+----------
+
+Registry of the build status per hashtag.
+
+Every build moves through the states ``queued``, ``building`` and ``done``
+or ``failed``. The record of the build holds the state, the ``status``
+(``success`` or ``error``) and the message of the finished build, the
+location of the XPI and the times every state was entered. Poll
+endpoints answer from the registry instead of looking for files in
+``XPI_TARGETDIR``, and :func:`xpi.views.wait` holds the client's request
+until the build is finished (see :func:`wait`).
+
+Records are kept in the storage named in ``XPI_STATUS_STORAGE`` - ``cache``
+(the Django cache, shared by web and celery processes) or ``local`` (a
+dictionary of the process, enough if celery runs tasks in process and
+there's a single web process). Whatever the storage, an XPI found in
+``XPI_TARGETDIR`` finishes the build (see :func:`get`).
+"""
+import os
+import time
+
+import commonware.log
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = commonware.log.getLogger('f.xpi.status')
+
+STATES = ('queued', 'building', 'done', 'failed')
+FINISHED = ('done', 'failed')
+WAITERS_KEY = 'xpi:status:waiters'
+
+
+class CacheStorage(object):
+    " keeps records in the Django cache "
+
+    def get(self, key):
+        return cache.get(key)
+
+    def set(self, key, value, timeout):
+        cache.set(key, value, timeout)
+
+    def delete(self, key):
+        cache.delete(key)
+
+
+class LocalStorage(object):
+    " keeps records in the memory of the process "
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        expires, value = self.data.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout):
+        self.data[key] = (time.time() + timeout, value)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+STORAGES = {
+    'cache': CacheStorage(),
+    'local': LocalStorage()}
+
+
+def get_storage():
+    return STORAGES[settings.XPI_STATUS_STORAGE]
+
+
+def _get_key(hashtag):
+    return 'xpi:status:%s' % hashtag
+
+
+def _save(record):
+    get_storage().set(_get_key(record['hashtag']), record,
+                      settings.XPI_STATUS_TIMEOUT)
+
+
+def _enter(hashtag, state, **data):
+    " move the build to ``state`` "
+    record = get_storage().get(_get_key(hashtag)) or {
+        'hashtag': hashtag,
+        'times': {}}
+    record.update(data)
+    record['state'] = state
+    record['times'][state] = time.time()
+    _save(record)
+    return record
+
+
+def _get_path(hashtag):
+    return os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+
+
+def queued(hashtag):
+    """start the record of the build, forget the previous one
+
+    XPI of the previous build is removed, the file found in
+    ``XPI_TARGETDIR`` is always the result of the queued build (see
+    :func:`get`)
+    """
+    try:
+        os.remove(_get_path(hashtag))
+    except OSError:
+        pass
+    _save({
+        'hashtag': hashtag,
+        'state': 'queued',
+        'times': {'queued': time.time()}})
+
+
+def building(hashtag):
+    _enter(hashtag, 'building')
+
+
+def finish(hashtag, status, message=''):
+    """Record the result of the build and notify waiting clients
+
+    :params:
+        * hashtag (String) identifies the build
+        * status (String) ``success`` or ``error``
+        * message (String) cfx response or error message
+    """
+    path = None
+    if status == 'success':
+        path = _get_path(hashtag)
+    _enter(hashtag, 'done' if status == 'success' else 'failed',
+           status=status, message=str(message), path=path)
+
+
+def get(hashtag):
+    """:returns: (dict) record of the build or None
+
+    A record of a finished build is returned for XPIs which are in
+    ``XPI_TARGETDIR`` while the record is missing (e.g. it expired) or not
+    finished (e.g. the build was finished by a process with its own
+    storage). XPIs are renamed into place, an existing file is complete.
+    The previous XPI is removed when the build is queued, mtimes can't
+    tell the builds apart as downloaded XPIs are pinned.
+    """
+    record = get_storage().get(_get_key(hashtag))
+    if is_finished(record):
+        return record
+    path = _get_path(hashtag)
+    if not os.path.isfile(path):
+        return record
+    return {
+        'hashtag': hashtag,
+        'state': 'done',
+        'status': 'success',
+        'message': '',
+        'path': path,
+        'times': record['times'] if record else {}}
+
+
+def is_finished(record):
+    return bool(record) and record['state'] in FINISHED
+
+
+def _start_waiting():
+    """Count the waiting request
+
+    :returns: (bool) False if ``XPI_WAIT_MAX`` requests wait already, None
+              if they can't be counted (cache without ``incr``)
+    """
+    cache.add(WAITERS_KEY, 0, settings.XPI_WAIT_TIMEOUT * 2)
+    try:
+        waiters = cache.incr(WAITERS_KEY)
+    except ValueError:
+        return None
+    if waiters > settings.XPI_WAIT_MAX:
+        _stop_waiting()
+        return False
+    return True
+
+
+def _stop_waiting():
+    try:
+        cache.decr(WAITERS_KEY)
+    except ValueError:
+        pass
+
+
+def wait(hashtag, timeout=None):
+    """Block until the build is finished or ``timeout`` seconds passed
+
+    The Django cache has no notifications, the record is read every
+    ``XPI_WAIT_INTERVAL`` seconds - a cache read per interval instead of
+    a request of the client. At most ``XPI_WAIT_MAX`` requests wait at
+    once, so waiting clients can't take all web workers, others get the
+    current state right away.
+
+    :returns: (tuple) record of the finished build or None and whether the
+              request waited
+    """
+    if timeout is None:
+        timeout = settings.XPI_WAIT_TIMEOUT
+    record = get(hashtag)
+    if is_finished(record):
+        return record, True
+    counted = _start_waiting()
+    if counted is False:
+        return None, False
+    try:
+        tend = time.time() + timeout
+        while not is_finished(record) and time.time() < tend:
+            time.sleep(settings.XPI_WAIT_INTERVAL)
+            record = get(hashtag)
+    finally:
+        if counted:
+            _stop_waiting()
+    return (record if is_finished(record) else None), True
+
+
+def clear(hashtag):
+    " forget the build "
+    get_storage().delete(_get_key(hashtag))
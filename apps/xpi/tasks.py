@@ -1,26 +1,51 @@
 import commonware.log
 import time
+from functools import partial
 from statsd import statsd
 
 from celery.decorators import task
 
-from xpi import xpi_utils
+from xpi import inflight, scheduler, status, tracing, xpi_utils
 
 from jetpack.models import PackageRevision
 
 log = commonware.log.getLogger('f.celery')
 
 
-@task(rate_limit='30/m')
-def xpi_build_from_model(rev_pk, mod_codes={}, att_codes={}, hashtag=None, tqueued=None):
+@task
+def xpi_build_from_model(*args, **kwargs):
+    """A wrapper for :meth:`build_from_model` routed to the queue of test
+    builds, run within the share of the class (see :mod:`xpi.scheduler`)
+    """
+    return scheduler.run(xpi_build_from_model, 'test',
+                         partial(build_from_model, 'test'), args, kwargs)
+
+
+@task
+def xpi_download_from_model(*args, **kwargs):
+    """A wrapper for :meth:`build_from_model` routed to the queue of
+    download builds, run within the share of the class (see
+    :mod:`xpi.scheduler`)
+    """
+    return scheduler.run(xpi_download_from_model, 'download',
+                         partial(build_from_model, 'download'), args, kwargs)
+
+
+def build_from_model(build_class, rev_pk, mod_codes={}, att_codes={},
+        hashtag=None, tqueued=None, fingerprint=None, user=None):
     """ Get object and build xpi
+
+    ``fingerprint`` is given if requests for the same saved revision wait
+    for this build (see :mod:`xpi.inflight`)
     """
+    tinqueue = scheduler.started(build_class, user, tqueued)
     if not hashtag:
         log.critical("No hashtag provided")
         return
+    status.building(hashtag)
     tstart = time.time()
     if tqueued:
-        tinqueue = (tstart - tqueued) * 1000
+        tracing.add_span(hashtag, 'queue', tqueued, tstart)
         statsd.timing('xpi.build.queued', tinqueue)
         log.info('[xpi:%s] Addon job picked from queue (%dms)' % (hashtag, tinqueue))
     revision = PackageRevision.objects.get(pk=rev_pk)
@@ -35,8 +60,9 @@ def xpi_build_from_model(rev_pk, mod_codes={}, att_codes={}, hashtag=None, tqueu
         if str(att.pk) in att_codes:
             att.code = att_codes[str(att.pk)]
             attachments.append(att)
-    revision.build_xpi(
-            modules=modules,
-            attachments=attachments,
-            hashtag=hashtag,
-            tstart=tstart)
+    with inflight.leading(fingerprint, hashtag):
+        revision.build_xpi(
+                modules=modules,
+                attachments=attachments,
+                hashtag=hashtag,
+                tstart=tstart)
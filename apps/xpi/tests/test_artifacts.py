@@ -0,0 +1,77 @@
+"""
+xpi.tests.test_artifacts
+------------------------
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from mock import patch
+from nose.tools import eq_
+from test_utils import TestCase
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from xpi import artifacts
+
+cache = get_cache('locmem://')
+
+
+class ArtifactsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.old_targetdir = settings.XPI_TARGETDIR
+        self.old_max_size = settings.XPI_TARGETDIR_MAX_SIZE
+        settings.XPI_TARGETDIR = tempfile.mkdtemp()
+        settings.XPI_TARGETDIR_MAX_SIZE = 35
+
+    def tearDown(self):
+        shutil.rmtree(settings.XPI_TARGETDIR)
+        settings.XPI_TARGETDIR = self.old_targetdir
+        settings.XPI_TARGETDIR_MAX_SIZE = self.old_max_size
+
+    def _create(self, filename, age):
+        path = os.path.join(settings.XPI_TARGETDIR, filename)
+        with open(path, 'w') as f:
+            f.write('x' * 10)
+        used = time.time() - age
+        os.utime(path, (used, used))
+        return path
+
+    @patch('xpi.artifacts.cache', cache)
+    def test_least_recently_used_evicted(self):
+        old = self._create('old.xpi', 3600)
+        old_info = self._create('old.json', 3600)
+        pinned = self._create('pinned.xpi', 4000)
+        used = self._create('used.xpi', 2000)
+        unrelated = self._create('unrelated.txt', 4000)
+        artifacts.pin(pinned)
+        # using the pinned artifact does not shorten the pin
+        artifacts.touch(pinned)
+        assert os.path.getmtime(pinned) > time.time()
+        new = self._create('new.xpi', 0)
+        artifacts.add('target', new)
+        assert not os.path.exists(old)
+        assert not os.path.exists(old_info)
+        assert os.path.exists(pinned)
+        assert os.path.exists(used)
+        assert os.path.exists(unrelated)
+        assert os.path.exists(new)
+        # next added file fits into the counted size
+        eq_(cache.get(artifacts._get_size_key(settings.XPI_TARGETDIR)), 30)
+
+    def test_publish_leaves_linked_files(self):
+        cached = self._create('cached.xpi', 0)
+        target = os.path.join(settings.XPI_TARGETDIR, 'target.xpi')
+        artifacts.publish(cached, target)
+        eq_(open(target).read(), 'x' * 10)
+        # rebuilt under the same name
+        built = os.path.join(settings.XPI_TARGETDIR, 'built')
+        with open(built, 'w') as f:
+            f.write('y' * 10)
+        artifacts.publish(built, target, link=False)
+        eq_(open(target).read(), 'y' * 10)
+        eq_(open(cached).read(), 'x' * 10)
@@ -0,0 +1,56 @@
+"""
+xpi.tests.test_benchmark
+------------------------
+"""
+import tempfile
+
+from test_utils import TestCase
+from nose.tools import eq_
+
+from xpi import benchmark, tracing
+
+
+class BenchmarkTest(TestCase):
+
+    def test_make_code(self):
+        code = benchmark.make_code(1000)
+        assert 1000 <= len(code) < 1100
+        assert code.startswith('// synthetic module')
+
+    def test_measure_collects_spans(self):
+        def build():
+            tracing.add_span('abc', 'cfx', 10, 10.5)
+            tracing.add_span('abc', 'copy', 11, 11.1)
+            tracing.add_span('other', 'cfx', 10, 12)
+            return ['abc.xpi', '', '']
+
+        result, measurement = benchmark.measure(build, 'abc')
+        eq_(result, ['abc.xpi', '', ''])
+        eq_(sorted(measurement['spans'].keys()), ['cfx', 'copy'])
+        eq_(measurement['spans']['cfx'], 500)
+        assert measurement['peak_rss_kb']['self'] > 0
+        assert measurement['bytes_written'] >= 0
+        # listener is removed
+        eq_(tracing._listeners, [])
+
+    def test_measure_counts_written_bytes(self):
+        if benchmark._get_written() is None:
+            # no /proc/self/io
+            return
+
+        def write():
+            with tempfile.TemporaryFile() as f:
+                f.write('x' * 4096)
+
+        result, measurement = benchmark.measure(write, 'abc')
+        assert measurement['bytes_written'] >= 4096
+
+    def test_summarize(self):
+        measurements = [
+            {'time': 30, 'spans': {'cfx': 20}},
+            {'time': 10, 'spans': {'cfx': 5}},
+            {'time': 20, 'spans': {'cfx': 10, 'sdk': 1}}]
+        summary = benchmark.summarize(measurements)
+        eq_(summary['total'], {'min': 10, 'median': 20, 'max': 30})
+        eq_(summary['cfx'], {'min': 5, 'median': 10, 'max': 20})
+        eq_(summary['sdk'], {'min': 1, 'median': 1, 'max': 1})
@@ -1,20 +1,25 @@
 # coding=utf-8
 import commonware
 import os
+import Queue
 import shutil
 import simplejson
 import tempfile
 import time
+import zipfile
 
-from mock import Mock
+from mock import Mock, patch
 from nose.tools import eq_
 from utils.test import TestCase
 
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
+from cuddlefish import manifest
 from jetpack.models import Module, Package, PackageRevision, SDK
-from xpi import xpi_utils
+from xpi import (artifacts, assembler, engine, incremental, library_cache,
+                 pool, segment, status, xpi_utils)
 from base.templatetags.base_helpers import hashtag
 
 log = commonware.log.getLogger('f.tests')
@@ -59,8 +64,7 @@ class XPIBuildTest(TestCase):
             os.remove(self.attachment_file_name)
         if os.path.exists('%s.xpi' % self.target_basename):
             os.remove('%s.xpi' % self.target_basename)
-        if os.path.exists('%s.json' % self.target_basename):
-            os.remove('%s.json' % self.target_basename)
+        status.clear(self.hashtag)
 
     def makeSDKDir(self):
         os.mkdir('%s/packages' % self.SDKDIR)
@@ -129,6 +133,32 @@ class XPIBuildTest(TestCase):
                 self.addon.latest.get_lib_dir(),
                 self.addonrev.module_main)))
 
+    def test_library_export_cached(self):
+        old_export_dir = settings.LIBRARY_EXPORT_DIR
+        settings.LIBRARY_EXPORT_DIR = os.path.join(self.SDKDIR, 'exports')
+        try:
+            self.addonrev.dependency_add(self.librev)
+            export_path = library_cache.get_export_path(
+                    self.librev, self.addonrev.sdk)
+            for build in ('first', 'second'):
+                packages_dir = os.path.join(self.SDKDIR, build)
+                os.mkdir(packages_dir)
+                self.addonrev.export_files_with_dependencies(
+                        packages_dir, sdk=self.addonrev.sdk)
+                lib_dir = self.librev.get_dir_name(packages_dir)
+                assert os.path.islink(lib_dir)
+                eq_(os.path.realpath(lib_dir), os.path.realpath(export_path))
+                assert os.path.isfile(os.path.join(
+                    lib_dir, self.librev.get_lib_dir(), 'test_module.js'))
+            # recently used exports are kept
+            library_cache.evict(0)
+            assert os.path.isdir(export_path)
+            os.utime(export_path, (0, 0))
+            library_cache.evict(0)
+            assert not os.path.exists(export_path)
+        finally:
+            settings.LIBRARY_EXPORT_DIR = old_export_dir
+
     def test_addon_export_with_attachment(self):
         """Test if attachment file is copied."""
         self.makeSDKDir()
@@ -151,6 +181,95 @@ class XPIBuildTest(TestCase):
         xpi_utils.sdk_copy(self.addonrev.sdk.get_source_dir(), self.SDKDIR)
         self.failUnless(os.path.isdir(self.SDKDIR))
 
+    def test_build_fingerprint(self):
+        fingerprint = self.addonrev.get_build_fingerprint()
+        eq_(fingerprint, self.addonrev.get_build_fingerprint())
+        self.addonrev.module_create(
+            filename='another_module',
+            code='// another module',
+            author=self.author)
+        with_module = self.addonrev.get_build_fingerprint()
+        assert fingerprint != with_module
+        self.addonrev.dependency_add(self.librev)
+        assert with_module != self.addonrev.get_build_fingerprint()
+
+    def test_build_fingerprint_ignores_row_order(self):
+        def create_module(filename):
+            return Module.objects.create(filename=filename,
+                    code='// %s' % filename, author=self.author)
+
+        mods = [create_module('a_module'), create_module('b_module')]
+        self.addonrev.modules.add(*mods)
+        fingerprint = self.addonrev.get_build_fingerprint()
+        self.addonrev.modules.remove(*mods)
+        # the same modules stored in reversed order
+        mods = [create_module('b_module'), create_module('a_module')]
+        self.addonrev.modules.add(*mods)
+        eq_(self.addonrev.get_build_fingerprint(), fingerprint)
+
+    def test_xpi_cached_after_build(self):
+        old_cache_dir = settings.XPI_CACHE_DIR
+        settings.XPI_CACHE_DIR = os.path.join(self.SDKDIR, 'cache')
+        try:
+            response = self.addonrev.build_xpi(hashtag=self.hashtag)
+            assert not response[1]
+            cached = xpi_utils.get_cached_xpi_path(
+                    self.addonrev.get_build_fingerprint())
+            assert os.path.isfile(cached)
+            os.remove('%s.xpi' % self.target_basename)
+            assert xpi_utils.serve_cached_xpi(
+                    self.addonrev.get_build_fingerprint(), self.hashtag)
+            assert os.path.isfile('%s.xpi' % self.target_basename)
+        finally:
+            settings.XPI_CACHE_DIR = old_cache_dir
+
+    def test_sdk_workspace(self):
+        sdk_source = self.addonrev.sdk.get_source_dir()
+        xpi_utils.sdk_workspace(sdk_source, self.SDKDIR)
+        packages_dir = os.path.join(self.SDKDIR, 'packages')
+        assert os.path.isdir(packages_dir)
+        assert not os.path.islink(packages_dir)
+        assert os.path.islink(os.path.join(packages_dir, 'addon-kit'))
+        assert not os.path.islink(os.path.join(self.SDKDIR, 'python-lib'))
+        assert os.path.islink(os.path.join(self.SDKDIR, 'bin'))
+        # exporting the add-on does not touch the SDK source
+        self.addonrev.export_keys(self.SDKDIR)
+        self.addonrev.export_files_with_dependencies(packages_dir)
+        assert not os.path.exists(os.path.join(sdk_source, 'packages',
+                                               self.addonrev.name))
+        # a package overriding the SDK one is written into a copy
+        kit_dir = os.path.join(packages_dir, 'addon-kit')
+        assert xpi_utils.unlink_package(kit_dir)
+        assert not os.path.islink(kit_dir)
+        with open(os.path.join(kit_dir, 'package.json'), 'w') as f:
+            f.write('{}')
+        assert not xpi_utils.unlink_package(kit_dir)
+        shutil.rmtree(self.SDKDIR)
+        assert os.path.isdir(os.path.join(sdk_source, 'packages',
+                                          'addon-kit'))
+        with open(os.path.join(sdk_source, 'packages', 'addon-kit',
+                               'package.json')) as f:
+            assert f.read() != '{}'
+
+    def test_addon_named_like_sdk_package(self):
+        addon = Package.objects.create(
+                author=self.author,
+                full_name='addon-kit',
+                name='addon-kit',
+                type='a')
+        sdk_source = addon.latest.sdk.get_source_dir()
+        kit_dir = os.path.join(sdk_source, 'packages', 'addon-kit')
+        before = sorted(os.listdir(kit_dir))
+        with open(os.path.join(kit_dir, 'package.json')) as f:
+            manifest = f.read()
+        response = addon.latest.build_xpi(hashtag=self.hashtag)
+        assert 'SDK package' in response[1]
+        eq_(status.get(self.hashtag)['state'], 'failed')
+        # SDK source is unchanged
+        eq_(sorted(os.listdir(kit_dir)), before)
+        with open(os.path.join(kit_dir, 'package.json')) as f:
+            eq_(f.read(), manifest)
+
     def test_minimal_xpi_creation(self):
         " xpi build from an addon straight after creation "
         tstart = time.time()
@@ -166,7 +285,245 @@ class XPIBuildTest(TestCase):
         assert not err[1]
         # assert xpi was created
         assert os.path.isfile('%s.xpi' % self.target_basename)
-        assert os.path.isfile('%s.json' % self.target_basename)
+        eq_(status.get(self.hashtag)['state'], 'done')
+
+    def test_xpi_creation_in_process(self):
+        import cuddlefish
+        old_in_process = settings.XPI_BUILD_IN_PROCESS
+        settings.XPI_BUILD_IN_PROCESS = True
+        sdk_source = self.addonrev.sdk.get_source_dir()
+        try:
+            xpi_utils.sdk_copy(sdk_source, self.SDKDIR)
+            self.addonrev.export_keys(self.SDKDIR)
+            self.addonrev.export_files_with_dependencies(
+                '%s/packages' % self.SDKDIR)
+            err = xpi_utils.build(
+                    self.SDKDIR,
+                    self.addon.latest.get_dir_name('%s/packages' % self.SDKDIR),
+                    self.addon.name, self.hashtag, sdk_source=sdk_source)
+        finally:
+            settings.XPI_BUILD_IN_PROCESS = old_in_process
+        assert not err[1]
+        assert os.path.isfile('%s.xpi' % self.target_basename)
+        # SDK's modules are kept, FlightDeck's cuddlefish is restored
+        assert engine.is_loaded(sdk_source)
+        import cuddlefish as current_cuddlefish
+        eq_(cuddlefish, current_cuddlefish)
+
+    def test_xpi_creation_with_segment(self):
+        old_in_process = settings.XPI_BUILD_IN_PROCESS
+        old_segment_dir = settings.XPI_SEGMENT_DIR
+        settings.XPI_BUILD_IN_PROCESS = True
+        settings.XPI_SEGMENT_DIR = os.path.join(self.SDKDIR, 'segments')
+        sdk_source = self.addonrev.sdk.get_source_dir()
+        try:
+            response = self.addonrev.build_xpi(hashtag=self.hashtag)
+            assert os.path.isfile(segment.get_segment_path(sdk_source))
+        finally:
+            segment.forget(sdk_source)
+            settings.XPI_BUILD_IN_PROCESS = old_in_process
+            settings.XPI_SEGMENT_DIR = old_segment_dir
+        assert not response[1]
+        xpi = zipfile.ZipFile('%s.xpi' % self.target_basename)
+        eq_(xpi.testzip(), None)
+        widget = [name for name in xpi.namelist()
+                  if name.endswith('-addon-kit-lib/widget.js')][0]
+        eq_(xpi.read(widget), open(os.path.join(sdk_source, 'packages',
+            'addon-kit', 'lib', 'widget.js')).read())
+
+    def test_segment_validated(self):
+        sdk_source = os.path.join(self.SDKDIR, 'source')
+        lib_dir = os.path.join(sdk_source, 'packages', 'test-kit', 'lib')
+        os.makedirs(lib_dir)
+        module = os.path.join(lib_dir, 'main.js')
+        with open(module, 'w') as f:
+            f.write('exports.a = 1;')
+        old_segment_dir = settings.XPI_SEGMENT_DIR
+        settings.XPI_SEGMENT_DIR = os.path.join(self.SDKDIR, 'segments')
+        # SDK copied with mtimes (SDK_WORKSPACE_LINKS off)
+        sdk_dir = os.path.join(self.SDKDIR, 'build')
+        shutil.copytree(sdk_source, sdk_dir)
+        copied = os.path.join(sdk_dir, 'packages', 'test-kit', 'lib',
+                              'main.js')
+        xpi_path = os.path.join(self.SDKDIR, 'test.xpi')
+        try:
+            zipfile_class = segment.get_zipfile_class(sdk_source, sdk_dir)
+            xpi = zipfile_class(xpi_path, 'w', zipfile.ZIP_DEFLATED)
+            xpi.write(copied, 'main.js')
+            eq_((xpi.copied, xpi.compressed), (1, 0))
+            xpi.close()
+            # edited without changing its size
+            with open(copied, 'w') as f:
+                f.write('exports.a = 2;')
+            os.utime(copied, (time.time() + 10, time.time() + 10))
+            xpi = zipfile_class(xpi_path, 'w', zipfile.ZIP_DEFLATED)
+            xpi.write(copied, 'main.js')
+            eq_((xpi.copied, xpi.compressed), (0, 1))
+            xpi.close()
+        finally:
+            segment.forget(sdk_source)
+            settings.XPI_SEGMENT_DIR = old_segment_dir
+        eq_(zipfile.ZipFile(xpi_path).read('main.js'), 'exports.a = 2;')
+
+    def test_scan_cache(self):
+        calls = []
+
+        def scan_module(fn, lines, stderr):
+            calls.append(fn)
+            return manifest.scan_module(fn, lines, stderr)
+
+        cache_dir = os.path.join(self.SDKDIR, 'scans')
+        cached_scan = manifest.ScanCache(cache_dir).wrap(scan_module)
+        lines = ['var tabs = require("tabs");\n']
+        eq_(cached_scan('/a/main.js', lines), (['tabs'], False, False))
+        eq_(cached_scan('/b/main.js', lines), (['tabs'], False, False))
+        eq_(len(calls), 1)
+        # results are shared through the directory
+        added = []
+        cached_scan = manifest.ScanCache(cache_dir, added.append).wrap(
+                scan_module)
+        eq_(cached_scan('/c/main.js', lines), (['tabs'], False, False))
+        eq_(len(calls), 1)
+        eq_(added, [])
+        # new files are passed to be kept within the budget
+        eq_(cached_scan('/c/lib.js', lines), (['tabs'], False, False))
+        eq_(len(calls), 2)
+        eq_(len(added), 1)
+        assert artifacts.ARTIFACT_RE.match(os.path.basename(added[0]))
+        # stored as JSON, never unpickled
+        eq_(simplejson.load(open(added[0])), [['tabs'], False, False])
+        # directory writable by others is not used
+        os.chmod(cache_dir, 0777)
+        eq_(manifest.ScanCache(cache_dir).directory, None)
+
+    def test_package_conflict(self):
+        sdk_package = os.path.join(self.SDKDIR, 'sdk', 'test-harness')
+        os.makedirs(sdk_package)
+        with open(os.path.join(sdk_package, 'package.json'), 'w') as f:
+            f.write('{"name": "test-harness"}')
+        packages_dir = os.path.join(self.SDKDIR, 'packages')
+        os.makedirs(packages_dir)
+        linked = os.path.join(packages_dir, 'linked')
+        os.symlink(sdk_package, linked)
+        copied = os.path.join(packages_dir, 'copied')
+        shutil.copytree(sdk_package, copied)
+        exported = os.path.join(packages_dir, 'exported')
+        os.mkdir(exported)
+        with open(os.path.join(exported, 'package.json'), 'w') as f:
+            f.write('{"name": "test-harness", "main": "main"}')
+        cfg = {'root_dir': sdk_package}
+        assert engine._is_sdk_package(linked, cfg)
+        assert engine._is_sdk_package(copied, cfg)
+        assert not engine._is_sdk_package(exported, cfg)
+
+    def test_pool_requires_authkey(self):
+        authkey = settings.XPI_BUILD_POOL_AUTHKEY
+        settings.XPI_BUILD_POOL_AUTHKEY = None
+        address = settings.XPI_BUILD_POOL_ADDRESS
+        settings.XPI_BUILD_POOL_ADDRESS = os.path.join(self.SDKDIR, 'pool')
+        try:
+            self.assertRaises(ImproperlyConfigured, pool.get_authkey)
+            # builds fall back to running in process
+            with patch('xpi.engine.run_cfx', Mock(return_value='built')):
+                eq_(pool.run_cfx('sdk', 'sdk_dir', 'package_dir', ['xpi']),
+                    'built')
+        finally:
+            settings.XPI_BUILD_POOL_AUTHKEY = authkey
+            settings.XPI_BUILD_POOL_ADDRESS = address
+
+    def test_pool_drops_expired_jobs(self):
+        jobs = Queue.Queue()
+        results = Queue.Queue()
+        jobs.put({'id': 0, 'sdk_source': 'sdk', 'sdk_dir': 'sdk_dir',
+                  'package_dir': 'package_dir', 'arguments': ['xpi'],
+                  'deadline': time.time() - 1})
+        jobs.put(None)
+        run_cfx = Mock()
+        with patch('xpi.engine.is_warm', Mock(return_value=True)):
+            with patch('xpi.engine.run_cfx', run_cfx):
+                pool._worker(0, jobs, results, [])
+        assert not run_cfx.called
+        assert results.empty()
+
+    def test_xpi_creation_in_pool(self):
+        sdk_source = self.addonrev.sdk.get_source_dir()
+        xpi_utils.sdk_copy(sdk_source, self.SDKDIR)
+        self.addonrev.export_keys(self.SDKDIR)
+        self.addonrev.export_files_with_dependencies(
+            '%s/packages' % self.SDKDIR)
+        package_dir = self.addon.latest.get_dir_name(
+                '%s/packages' % self.SDKDIR)
+        build_pool = pool.BuildPool(1, [sdk_source])
+        build_pool.start()
+        try:
+            result = build_pool.submit(sdk_source, self.SDKDIR, package_dir,
+                    ['--keydir=%s/%s' % (self.SDKDIR, settings.KEYDIR), 'xpi'],
+                    timeout=60)
+        finally:
+            build_pool.stop()
+        assert result.success
+        assert os.path.isfile(os.path.join(package_dir,
+                                           '%s.xpi' % self.addon.name))
+        stats = build_pool.get_stats()
+        eq_(stats['workers'][0]['jobs'], 1)
+
+    def test_xpi_assembled(self):
+        " assembled XPI has the same content as the one built by cfx "
+        attachment = self.addonrev.attachment_create(
+            filename='test_filename.txt',
+            author=self.author
+        )
+        attachment.create_path()
+        attachment.data = 'unit test file'
+        attachment.write()
+        response = self.addonrev.build_xpi(hashtag=self.hashtag)
+        assert not response[1]
+        built = zipfile.ZipFile('%s.xpi' % self.target_basename)
+        assembled_hashtag = hashtag()
+        assembled_basename = os.path.join(
+                settings.XPI_TARGETDIR, assembled_hashtag)
+        try:
+            response = assembler.build(self.addonrev,
+                                       hashtag=assembled_hashtag)
+            assert not response[1]
+            assembled = zipfile.ZipFile('%s.xpi' % assembled_basename)
+            eq_(sorted(built.namelist()), sorted(assembled.namelist()))
+            for name in built.namelist():
+                if name != 'harness-options.json':
+                    eq_(built.read(name), assembled.read(name))
+            eq_(status.get(assembled_hashtag)['state'], 'done')
+        finally:
+            if os.path.exists('%s.xpi' % assembled_basename):
+                os.remove('%s.xpi' % assembled_basename)
+
+    def test_incremental_rebuild(self):
+        old_incremental_dir = settings.XPI_INCREMENTAL_DIR
+        settings.XPI_INCREMENTAL_DIR = os.path.join(self.SDKDIR,
+                                                    'incremental')
+        try:
+            response = self.addonrev.build_xpi(hashtag=self.hashtag)
+            assert not response[1]
+            base_path, record_path = incremental.get_base_paths(
+                    self.addonrev)
+            assert os.path.isfile(base_path)
+            record = simplejson.loads(open(record_path).read())
+            mod = self.addonrev.modules.get(
+                    filename=self.addonrev.module_main)
+            mod.code = '// edited main'
+            response = incremental.rebuild(self.addonrev, modules=[mod],
+                                           hashtag=self.hashtag)
+            assert response
+            assert not response[1]
+            xpi = zipfile.ZipFile('%s.xpi' % self.target_basename)
+            eq_(xpi.read('resources/%s/main.js' % record['lib']),
+                '// edited main')
+            eq_(xpi.testzip(), None)
+            # changed requirements need the full build
+            mod.code = 'require("tabs");'
+            eq_(incremental.rebuild(self.addonrev, modules=[mod],
+                                    hashtag=self.hashtag), None)
+        finally:
+            settings.XPI_INCREMENTAL_DIR = old_incremental_dir
 
     def test_addon_with_other_modules(self):
         " addon has now more modules "
@@ -187,7 +544,7 @@ class XPIBuildTest(TestCase):
         assert not err[1]
         # assert xpi was created
         assert os.path.isfile('%s.xpi' % self.target_basename)
-        assert os.path.isfile('%s.json' % self.target_basename)
+        eq_(status.get(self.hashtag)['state'], 'done')
 
     def test_xpi_with_empty_dependency(self):
         " empty lib is created "
@@ -212,7 +569,7 @@ class XPIBuildTest(TestCase):
         assert not err[1]
         # assert xpi was created
         assert os.path.isfile('%s.xpi' % self.target_basename)
-        assert os.path.isfile('%s.json' % self.target_basename)
+        eq_(status.get(self.hashtag)['state'], 'done')
 
     def test_xpi_with_dependency(self):
         " addon has one dependency with a file "
@@ -230,7 +587,7 @@ class XPIBuildTest(TestCase):
         assert not err[1]
         # assert xpi was created
         assert os.path.isfile('%s.xpi' % self.target_basename)
-        assert os.path.isfile('%s.json' % self.target_basename)
+        eq_(status.get(self.hashtag)['state'], 'done')
 
     def test_broken_dependency(self):
         # A > B
@@ -0,0 +1,85 @@
+"""
+xpi.tests.test_inflight
+-----------------------
+"""
+import os
+
+from mock import patch
+from nose.tools import eq_
+from test_utils import TestCase
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from xpi import inflight, status
+
+cache = get_cache('locmem://')
+
+
+class InflightTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.fingerprint = 'fingerprint'
+        self.paths = []
+
+    def tearDown(self):
+        for hashtag in ('leader', 'follower', 'followerA', 'followerB',
+                        'next'):
+            status.clear(hashtag)
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _get_path(self, hashtag, ext):
+        path = os.path.join(settings.XPI_TARGETDIR, '%s.%s' % (hashtag, ext))
+        self.paths.append(path)
+        return path
+
+    @patch('xpi.inflight.cache', cache)
+    def test_followers_get_leader_xpi(self):
+        assert inflight.join(self.fingerprint, 'leader')
+        assert not inflight.join(self.fingerprint, 'followerA')
+        assert not inflight.join(self.fingerprint, 'followerB')
+        with open(self._get_path('leader', 'xpi'), 'w') as xpi:
+            xpi.write('xpi')
+        inflight.release(self.fingerprint, 'leader')
+        for follower in ('followerA', 'followerB'):
+            with open(self._get_path(follower, 'xpi')) as xpi:
+                eq_(xpi.read(), 'xpi')
+            eq_(status.get(follower)['state'], 'done')
+        # next request builds again
+        assert inflight.join(self.fingerprint, 'next')
+
+    @patch('xpi.inflight.cache', cache)
+    @patch('xpi.status.cache', cache)
+    def test_followers_get_leader_error(self):
+        assert inflight.join(self.fingerprint, 'leader')
+        assert not inflight.join(self.fingerprint, 'follower')
+        status.finish('leader', 'error', 'cfx failed')
+        inflight.release(self.fingerprint, 'leader')
+        record = status.get('follower')
+        eq_(record['state'], 'failed')
+        eq_(record['message'], 'cfx failed')
+
+    @patch('xpi.inflight.cache', cache)
+    def test_repeated_request_not_built_again(self):
+        assert inflight.join(self.fingerprint, 'leader')
+        assert not inflight.join(self.fingerprint, 'leader')
+
+    @patch('xpi.inflight.cache', cache)
+    def test_leader_reelected(self):
+        assert inflight.join(self.fingerprint, 'leader')
+        assert not inflight.join(self.fingerprint, 'follower')
+        # worker of the leader died, its key expired
+        cache.delete(inflight._get_key(self.fingerprint))
+        assert inflight.join(self.fingerprint, 'next')
+        with inflight.leading(self.fingerprint, 'next'):
+            eq_(cache.get(inflight._get_key(self.fingerprint)), 'next')
+            with open(self._get_path('next', 'xpi'), 'w') as xpi:
+                xpi.write('xpi')
+        # follower of the dead leader gets the result of the new one
+        with open(self._get_path('follower', 'xpi')) as xpi:
+            eq_(xpi.read(), 'xpi')
+        eq_(status.get('follower')['state'], 'done')
+        assert inflight.join(self.fingerprint, 'leader')
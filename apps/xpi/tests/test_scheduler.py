@@ -0,0 +1,92 @@
+"""
+xpi.tests.test_scheduler
+------------------------
+"""
+import time
+
+from mock import Mock, patch
+from nose.tools import eq_
+from test_utils import TestCase
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from xpi import scheduler
+
+cache = get_cache('locmem://')
+
+
+class SchedulerTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.task = Mock()
+
+    @patch('xpi.scheduler.cache', cache)
+    def test_fair_countdown(self):
+        free = settings.XPI_FAIR_FREE_BUILDS
+        for i in range(free):
+            eq_(scheduler.enqueue(self.task, 'test', 'heavy'), 0)
+        eq_(scheduler.enqueue(self.task, 'test', 'heavy'),
+            settings.XPI_FAIR_DELAY)
+        eq_(scheduler.enqueue(self.task, 'test', 'heavy'),
+            2 * settings.XPI_FAIR_DELAY)
+        # other users and classes are not affected
+        eq_(scheduler.enqueue(self.task, 'test', 'light'), 0)
+        eq_(scheduler.enqueue(self.task, 'download', 'heavy'), 0)
+        eq_(scheduler.get_depths(), {'test': free + 3, 'download': 1,
+                                     'bulk': 0})
+        kwargs = self.task.apply_async.call_args[1]['kwargs']
+        eq_(kwargs['user'], 'heavy')
+        assert scheduler.started('download', 'heavy', kwargs['tqueued']) >= 0
+        eq_(scheduler.get_depths()['download'], 0)
+
+    @patch('xpi.scheduler.cache', cache)
+    def test_share_enforced(self):
+        shares, eager = settings.XPI_CLASS_SHARES, settings.CELERY_ALWAYS_EAGER
+        settings.XPI_CLASS_SHARES = {'bulk': 1}
+        settings.CELERY_ALWAYS_EAGER = False
+        calls = []
+
+        def build(*args, **kwargs):
+            calls.append((args, kwargs))
+            # the class uses its whole share while building
+            eq_(scheduler.run(self.task, 'bulk', build, ('other',)), None)
+            return 'built'
+
+        try:
+            eq_(scheduler.run(self.task, 'bulk', build, ('addon',),
+                              {'task_id': 'x', 'tqueued': 1}), 'built')
+        finally:
+            settings.XPI_CLASS_SHARES = shares
+            settings.CELERY_ALWAYS_EAGER = eager
+        eq_(calls, [(('addon',), {'tqueued': 1})])
+        # the task over the share is queued again
+        eq_(self.task.apply_async.call_args[1]['args'], ('other',))
+        eq_(scheduler.get_running()['bulk'], 0)
+
+    @patch('xpi.scheduler.cache', cache)
+    def test_slot_of_crashed_worker_expires(self):
+        shares, eager = settings.XPI_CLASS_SHARES, settings.CELERY_ALWAYS_EAGER
+        timeout = settings.XPI_SLOT_TIMEOUT
+        settings.XPI_CLASS_SHARES = {'bulk': 1}
+        settings.CELERY_ALWAYS_EAGER = False
+        settings.XPI_SLOT_TIMEOUT = 1
+        try:
+            # never released
+            assert scheduler.acquire('bulk')
+            eq_(scheduler.acquire('bulk'), None)
+            eq_(scheduler.get_running()['bulk'], 1)
+            time.sleep(1.1)
+            slot = scheduler.acquire('bulk')
+            assert slot
+            # running builds keep their slot
+            with scheduler.heartbeat(lambda: scheduler.refresh(slot), 0.3):
+                time.sleep(1.1)
+                eq_(scheduler.acquire('bulk'), None)
+            scheduler.release(slot)
+            eq_(scheduler.get_running()['bulk'], 0)
+        finally:
+            settings.XPI_CLASS_SHARES = shares
+            settings.CELERY_ALWAYS_EAGER = eager
+            settings.XPI_SLOT_TIMEOUT = timeout
@@ -0,0 +1,54 @@
+"""
+xpi.tests.test_status
+---------------------
+"""
+import os
+
+from nose.tools import eq_
+from test_utils import TestCase
+
+from django.conf import settings
+
+from xpi import artifacts, status
+
+
+class StatusTest(TestCase):
+
+    def setUp(self):
+        self.old_storage = settings.XPI_STATUS_STORAGE
+        # record of another process is not seen
+        settings.XPI_STATUS_STORAGE = 'local'
+        artifacts.makedirs(settings.XPI_TARGETDIR)
+        self.path = os.path.join(settings.XPI_TARGETDIR, 'statustest.xpi')
+
+    def tearDown(self):
+        status.clear('statustest')
+        settings.XPI_STATUS_STORAGE = self.old_storage
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_queued_build_finished_by_file(self):
+        status.queued('statustest')
+        assert not status.is_finished(status.get('statustest'))
+        with open(self.path, 'w') as f:
+            f.write('xpi')
+        record = status.get('statustest')
+        eq_(record['state'], 'done')
+        eq_(record['path'], self.path)
+
+    def test_previous_file_removed(self):
+        with open(self.path, 'w') as f:
+            f.write('xpi')
+        # pinned by a download
+        artifacts.pin(self.path)
+        status.queued('statustest')
+        assert not os.path.exists(self.path)
+        eq_(status.get('statustest')['state'], 'queued')
+
+    def test_wait(self):
+        status.queued('statustest')
+        eq_(status.wait('statustest', timeout=0), (None, True))
+        status.finish('statustest', 'success')
+        record, waited = status.wait('statustest', timeout=0)
+        eq_(record['state'], 'done')
+
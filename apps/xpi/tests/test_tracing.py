@@ -0,0 +1,76 @@
+"""
+xpi.tests.test_tracing
+----------------------
+"""
+from mock import patch
+from test_utils import TestCase
+from nose.tools import eq_
+
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+
+from xpi import tracing
+
+cache = get_cache('locmem://')
+
+
+def _trace(hashtag, started, finished, *spans):
+    tracing.start(hashtag, 'test', started)
+    for name, duration in spans:
+        tracing.add_span(hashtag, name, started, started + duration / 1000.0)
+    if finished:
+        tracing.finish(hashtag, finished)
+
+
+class TracingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @patch('xpi.tracing.cache', cache)
+    def test_histograms(self):
+        _trace('a', 10, 11, ('queue', 5), ('cfx', 900))
+        _trace('b', 20, 22, ('queue', 40), ('cfx', 1500))
+        _trace('c', 30, None, ('queue', 60000))
+        histograms = tracing.get_histograms()
+        eq_(sorted(histograms.keys()), ['cfx', 'queue', 'total'])
+        queue = histograms['queue']
+        eq_(queue['count'], 3)
+        eq_(queue['p50'], 50)
+        eq_(queue['max'], None)
+        eq_(queue['buckets'][0], [10, 1])
+        eq_(queue['buckets'][2], [50, 1])
+        eq_(queue['buckets'][-1], [None, 1])
+        eq_(sum(count for bound, count in queue['buckets']), 3)
+        # unfinished builds are not counted in total
+        eq_(histograms['total']['count'], 2)
+        eq_(histograms['total']['max'], 2500)
+
+    @patch('xpi.tracing.cache', cache)
+    def test_trace(self):
+        _trace('a', 10, None, ('queue', 5), ('cfx', 900))
+        tracing.finish('a', 11, error='cfx')
+        # only the first finish is recorded
+        tracing.finish('a', 12)
+        tracing.add_poll_span('a', 11.5)
+        tracing.add_poll_span('a', 12)
+        trace = tracing.get('a')
+        eq_(trace['finished'], 11)
+        eq_(trace['error'], 'cfx')
+        eq_([span['name'] for span in trace['spans']],
+            ['queue', 'cfx', 'poll'])
+        eq_(trace['spans'][-1]['duration'], 500)
+        # rebuilt under the same hashtag
+        tracing.start('a', 'test', 20)
+        trace = tracing.get('a')
+        eq_(trace['spans'], [])
+        eq_(trace['finished'], None)
+        _trace('b', 30, 31)
+        eq_([t['hashtag'] for t in tracing.get_recent()], ['b', 'a'])
+
+    def test_add_span_returns_duration(self):
+        eq_(tracing.add_span(None, 'cfx', 10, 10.5), 500)
+
+    def test_traces_for_superuser_only(self):
+        response = self.client.get(reverse('xpi_traces'))
+        eq_(response.status_code, 302)
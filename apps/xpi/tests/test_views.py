@@ -5,6 +5,8 @@ xpi.tests.test_views
 import mock
 import simplejson
 import os
+import shutil
+import tempfile
 import commonware
 
 from test_utils import TestCase
@@ -17,8 +19,9 @@ from django.conf import settings
 from base.shortcuts import get_object_with_related_or_404
 
 from base.templatetags.base_helpers import hashtag
-from xpi import tasks
+from xpi import tasks, xpi_utils
 from jetpack.models import PackageRevision
+from utils.wsgi import get_wsgi_body
 
 log = commonware.log.getLogger('f.test')
 
@@ -34,10 +37,14 @@ class TestViews(TestCase):
                 args=['1000003', 0])
         self.xpi_path = os.path.join(
             settings.XPI_TARGETDIR, '%s.xpi' % self.hashtag)
+        self.old_cache_dir = settings.XPI_CACHE_DIR
+        settings.XPI_CACHE_DIR = tempfile.mkdtemp()
 
     def tearDown(self):
         if os.path.isfile(self.xpi_path):
             os.remove(self.xpi_path)
+        shutil.rmtree(settings.XPI_CACHE_DIR)
+        settings.XPI_CACHE_DIR = self.old_cache_dir
 
     @patch('os.path.isfile')
     def test_package_check_download(self, isfile):
@@ -55,6 +62,36 @@ class TestViews(TestCase):
         response = simplejson.loads(r.content)
         assert response['ready']
 
+    @patch('xpi.status.wait')
+    def test_wait(self, wait):
+        uri = reverse('jp_wait_xpi', args=[self.hashtag])
+        wait.return_value = (None, True)
+        r = self.client.get(uri)
+        eq_(r.status_code, 200)
+        response = simplejson.loads(r.content)
+        assert not response['ready']
+        assert response['wait']
+        # too many waiting requests
+        wait.return_value = (None, False)
+        r = self.client.get(uri)
+        assert not simplejson.loads(r.content)['wait']
+        wait.return_value = ({'state': 'failed', 'status': 'error',
+                              'message': 'cfx failed'}, True)
+        r = self.client.get(uri)
+        response = simplejson.loads(r.content)
+        assert response['ready']
+        eq_(response['status'], 'error')
+        eq_(response['message'], 'cfx failed')
+
+    def test_wait_without_status(self):
+        # file is ready even if its status is not in the cache
+        with open(self.xpi_path, 'w') as xpi:
+            xpi.write('test')
+        r = self.client.get(reverse('jp_wait_xpi', args=[self.hashtag]))
+        response = simplejson.loads(r.content)
+        assert response['ready']
+        eq_(response['status'], 'success')
+
     def test_downloading_xpi(self):
         """Check if the right file is downloaded
         """
@@ -71,6 +108,55 @@ class TestViews(TestCase):
         eq_(response.status_code, 200)
         eq_(response.content, 'test')
 
+    def test_xpi_etag(self):
+        uri = reverse('jp_download_xpi', args=[self.hashtag, 'test'])
+        with open(self.xpi_path, 'w') as xpi:
+            xpi.write('test')
+        response = self.client.get(uri)
+        eq_(response.status_code, 200)
+        eq_(response['Content-Length'], '4')
+        eq_(response['Cache-Control'], settings.XPI_CACHE_CONTROL)
+        etag = response['ETag']
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 304)
+        # rebuilt under the same hashtag
+        os.remove(self.xpi_path)
+        with open(self.xpi_path, 'w') as xpi:
+            xpi.write('rebuilt')
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        eq_(response.status_code, 200)
+        eq_(response.content, 'rebuilt')
+
+    def test_xpi_sendfile(self):
+        old_header = settings.XPI_SENDFILE_HEADER
+        settings.XPI_SENDFILE_HEADER = 'X-Sendfile'
+        try:
+            with open(self.xpi_path, 'w') as xpi:
+                xpi.write('test')
+            response = self.client.get(
+                    reverse('jp_test_xpi', args=[self.hashtag]))
+        finally:
+            settings.XPI_SENDFILE_HEADER = old_header
+        eq_(response.status_code, 200)
+        eq_(response['X-Sendfile'], self.xpi_path)
+        eq_(response['Content-Length'], '4')
+        eq_(response.content, '')
+
+    def test_xpi_file_wrapper(self):
+        with open(self.xpi_path, 'w') as xpi:
+            xpi.write('test')
+        response = self.client.get(reverse('jp_test_xpi', args=[self.hashtag]))
+        file_wrapper = mock.Mock()
+        body = get_wsgi_body({'wsgi.file_wrapper': file_wrapper}, response)
+        eq_(body, file_wrapper.return_value)
+        wrapped, block_size = file_wrapper.call_args[0]
+        eq_(block_size, settings.XPI_SENDFILE_BLOCK_SIZE)
+        eq_(wrapped.read(), 'test')
+        wrapped.close()
+        assert response.file_to_stream.closed
+        # servers without wsgi.file_wrapper iterate the response
+        eq_(get_wsgi_body({}, response), response)
+
     def test_hashtag(self):
         revision = PackageRevision.objects.get(pk=205)
         uri = reverse('jp_addon_revision_test',
@@ -91,11 +177,30 @@ class TestViews(TestCase):
 
     def test_cach_hashtag(self):
         os.path.exists = mock.Mock(return_value=True)
-        tasks.xpi_build_from_model.delay = mock.Mock()
+        tasks.xpi_build_from_model.apply_async = mock.Mock()
         response = self.client.post(self.prepare_test_url, {
             'hashtag': 'abc'})
-        assert not tasks.xpi_build_from_model.delay.called
+        assert not tasks.xpi_build_from_model.apply_async.called
         os.path.exists = mock.Mock(return_value=False)
         response = self.client.post(self.prepare_test_url, {
             'hashtag': 'abc'})
-        assert tasks.xpi_build_from_model.delay.called
+        assert tasks.xpi_build_from_model.apply_async.called
+
+    def test_download_served_from_cache(self):
+        revision = PackageRevision.objects.get(pk=205)
+        uri = reverse('jp_addon_revision_xpi',
+            args=[revision.package.id_number, revision.revision_number])
+        tasks.xpi_download_from_model.apply_async = mock.Mock()
+        response = self.client.post(uri, {'hashtag': self.hashtag})
+        eq_(response.status_code, 200)
+        assert tasks.xpi_download_from_model.apply_async.called
+        # put the "built" XPI into the cache
+        tasks.xpi_download_from_model.apply_async = mock.Mock()
+        with open(xpi_utils.get_cached_xpi_path(
+                revision.get_build_fingerprint()), 'w') as xpi:
+            xpi.write('cached')
+        response = self.client.post(uri, {'hashtag': self.hashtag})
+        eq_(response.status_code, 200)
+        assert not tasks.xpi_download_from_model.apply_async.called
+        with open(self.xpi_path) as xpi:
+            eq_(xpi.read(), 'cached')
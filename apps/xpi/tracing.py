@@ -0,0 +1,293 @@
+"""
+xpi.tracing
+-----------
+
+Per-build traces keyed by hashtag.
+
+Stages of the build - from the request which queued it to the download of
+the XPI - are recorded as spans of the trace kept in the cache, so the web
+and celery processes add to the same trace. Nothing is read and written
+back: the start and the end of the trace are stored once under their own
+keys, every span under a key numbered with ``cache.incr``. Recent traces
+are kept in a ring of ``XPI_TRACE_RECENT`` keys and durations of the spans
+are counted in the buckets of their histogram (:func:`get_histograms`),
+both are served by :func:`xpi.views.traces`.
+
+Spans: ``enqueue``, ``queue``, ``sdk``, ``modules``, ``attachments``,
+``dependencies``, ``incremental``, ``cfx``, ``copy``, ``poll`` (from the
+XPI being ready to the client noticing it) and ``download``.
+
+Functions registered with :func:`add_listener` are called with every
+recorded span, even if the cache doesn't keep traces (see
+:mod:`xpi.benchmark`).
+"""
+import math
+import time
+
+import commonware.log
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = commonware.log.getLogger('f.xpi.tracing')
+
+RECENT_KEY = 'xpi:traces:recent'
+#: spans with histograms (``total`` is the time from start to finish)
+SPANS = ('enqueue', 'queue', 'incremental', 'sdk', 'modules',
+         'attachments', 'dependencies', 'export', 'cfx', 'copy', 'poll',
+         'download', 'total')
+#: upper bounds (ms) of the histogram buckets, last bucket is unbounded
+HISTOGRAM_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                     30000)
+
+_listeners = []
+
+
+def _get_key(hashtag):
+    return 'xpi:trace:%s' % hashtag
+
+
+def _get_finish_key(hashtag):
+    return '%s:finished' % _get_key(hashtag)
+
+
+def _get_poll_key(hashtag):
+    return '%s:poll' % _get_key(hashtag)
+
+
+def _get_spans_key(hashtag):
+    return '%s:spans' % _get_key(hashtag)
+
+
+def _get_span_keys(hashtag, number):
+    spans_key = _get_spans_key(hashtag)
+    return ['%s:%d' % (spans_key, i) for i in range(1, number + 1)]
+
+
+def _get_histogram_key(window, name, bucket):
+    return 'xpi:traces:histogram:%d:%s:%d' % (window, name, bucket)
+
+
+def _incr(key, timeout):
+    " returns the incremented counter or None if the cache can't count "
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return None
+
+
+def _get_window(tnow=None):
+    return int((tnow or time.time()) / settings.XPI_TRACE_TIMEOUT)
+
+
+def _count(name, duration):
+    " count the ``duration`` in the histogram of the span "
+    for bucket, bound in enumerate(HISTOGRAM_BUCKETS):
+        if duration <= bound:
+            break
+    else:
+        bucket = len(HISTOGRAM_BUCKETS)
+    _incr(_get_histogram_key(_get_window(), name, bucket),
+          settings.XPI_TRACE_TIMEOUT * 2)
+
+
+def _new_trace(hashtag, kind, tstart):
+    return {
+        'hashtag': hashtag,
+        'kind': kind,
+        'started': tstart,
+        'finished': None,
+        'error': None,
+        'spans': []}
+
+
+def start(hashtag, kind, tstart=None, **meta):
+    """Create the trace of the build, forget the previous build of the
+    ``hashtag``
+
+    :params:
+        * hashtag (String) identifies the build
+        * kind (String) ``test``, ``download`` or ``repackage``
+        * tstart (float) time.time() the request came in
+        * meta - stored with the trace (e.g. revision)
+    """
+    trace = _new_trace(hashtag, kind, tstart or time.time())
+    trace.update(meta)
+    cache.delete_many([_get_finish_key(hashtag), _get_poll_key(hashtag),
+                       _get_spans_key(hashtag)])
+    cache.set(_get_key(hashtag), trace, settings.XPI_TRACE_TIMEOUT)
+    number = _incr(RECENT_KEY, settings.XPI_TRACE_TIMEOUT)
+    if number:
+        cache.set('%s:%d' % (RECENT_KEY, number % settings.XPI_TRACE_RECENT),
+                  hashtag, settings.XPI_TRACE_TIMEOUT)
+    return trace
+
+
+def _get_traces(hashtags):
+    " returns traces of ``hashtags`` found in the cache "
+    keys = []
+    for hashtag in hashtags:
+        keys.extend([_get_key(hashtag), _get_finish_key(hashtag),
+                     _get_spans_key(hashtag)])
+    values = cache.get_many(keys)
+    span_keys = []
+    for hashtag in hashtags:
+        span_keys.extend(_get_span_keys(
+                hashtag, values.get(_get_spans_key(hashtag)) or 0))
+    spans = cache.get_many(span_keys) if span_keys else {}
+    traces = []
+    for hashtag in hashtags:
+        number = values.get(_get_spans_key(hashtag)) or 0
+        trace = values.get(_get_key(hashtag))
+        if not trace and not number:
+            continue
+        trace = dict(trace or _new_trace(hashtag, None, None))
+        trace.update(values.get(_get_finish_key(hashtag)) or {})
+        trace['spans'] = [spans[key]
+                          for key in _get_span_keys(hashtag, number)
+                          if key in spans]
+        if not trace['started'] and trace['spans']:
+            trace['started'] = trace['spans'][0]['start']
+        traces.append(trace)
+    return traces
+
+
+def get(hashtag):
+    " returns the trace or None "
+    traces = _get_traces([hashtag])
+    return traces[0] if traces else None
+
+
+def add_listener(listener):
+    " call ``listener(hashtag, name, duration)`` for every recorded span "
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def add_span(hashtag, name, tstart, tend=None):
+    """Record the stage of the build
+
+    :params:
+        * hashtag (String) identifies the build
+        * name (String) name of the span
+        * tstart (float) time.time() the stage started
+        * tend (float) time.time() the stage ended, now if not given
+
+    :returns: (float) duration of the span in ms
+    """
+    if tend is None:
+        tend = time.time()
+    duration = (tend - tstart) * 1000
+    if not hashtag:
+        return duration
+    for listener in _listeners:
+        listener(hashtag, name, duration)
+    number = _incr(_get_spans_key(hashtag), settings.XPI_TRACE_TIMEOUT)
+    if number:
+        cache.set(_get_span_keys(hashtag, number)[-1], {
+            'name': name,
+            'start': tstart,
+            'duration': duration}, settings.XPI_TRACE_TIMEOUT)
+    _count(name, duration)
+    return duration
+
+
+def finish(hashtag, tend=None, error=None):
+    " mark the XPI as ready (or failed), only the first call is recorded "
+    trace = cache.get(_get_key(hashtag))
+    if not trace:
+        return
+    tend = tend or time.time()
+    if not cache.add(_get_finish_key(hashtag),
+                     {'finished': tend, 'error': error},
+                     settings.XPI_TRACE_TIMEOUT):
+        return
+    if trace.get('started'):
+        _count('total', (tend - trace['started']) * 1000)
+
+
+def add_poll_span(hashtag, tend=None):
+    """Record time between the XPI being ready and the client noticing it
+
+    Only the first poll after the build finished is recorded
+    """
+    finished = cache.get(_get_finish_key(hashtag))
+    if not finished or not cache.add(_get_poll_key(hashtag), 1,
+                                     settings.XPI_TRACE_TIMEOUT):
+        return
+    add_span(hashtag, 'poll', finished['finished'], tend)
+
+
+def get_total(hashtag, tend=None):
+    """:returns: (float) time in ms since the build was requested or None"""
+    trace = cache.get(_get_key(hashtag))
+    if not trace or not trace.get('started'):
+        return None
+    return ((tend or time.time()) - trace['started']) * 1000
+
+
+def get_recent():
+    " returns recent traces, the newest first "
+    number = cache.get(RECENT_KEY) or 0
+    size = settings.XPI_TRACE_RECENT
+    keys = ['%s:%d' % (RECENT_KEY, i % size)
+            for i in range(number, max(0, number - size), -1)]
+    found = cache.get_many(keys)
+    hashtags = []
+    for key in keys:
+        # hashtags rebuilt recently are listed once
+        if key in found and found[key] not in hashtags:
+            hashtags.append(found[key])
+    return _get_traces(hashtags)
+
+
+def _percentile(buckets, count, percent):
+    " returns upper bound of the bucket holding the percentile "
+    rank = max(1, int(math.ceil(percent / 100.0 * count)))
+    seen = 0
+    for bound, number in buckets:
+        seen += number
+        if seen >= rank:
+            return bound
+
+
+def get_histograms():
+    """Summarise spans recorded in the last one to two ``XPI_TRACE_TIMEOUT``
+
+    :returns: (dict) ``{span name: {'count', 'buckets', 'p50', 'p90', 'p99',
+              'max'}}`` where ``buckets`` is a list of ``[upper bound (ms),
+              count]``, the last bound is None. Percentiles and ``max``
+              are upper bounds of the buckets they fall in.
+    """
+    window = _get_window()
+    bounds = list(HISTOGRAM_BUCKETS) + [None]
+    keys = [(name, bucket, _get_histogram_key(w, name, bucket))
+            for name in SPANS
+            for bucket in range(len(bounds))
+            for w in (window - 1, window)]
+    counts = cache.get_many([key for name, bucket, key in keys])
+    histograms = {}
+    for name, bucket, key in keys:
+        if key not in counts:
+            continue
+        buckets = histograms.setdefault(
+                name, [[bound, 0] for bound in bounds])
+        buckets[bucket][1] += counts[key]
+    for name, buckets in histograms.items():
+        count = sum(number for bound, number in buckets)
+        if not count:
+            del histograms[name]
+            continue
+        histograms[name] = {
+            'count': count,
+            'buckets': buckets,
+            'p50': _percentile(buckets, count, 50),
+            'p90': _percentile(buckets, count, 90),
+            'p99': _percentile(buckets, count, 99),
+            'max': [bound for bound, number in buckets if number][-1]}
+    return histograms
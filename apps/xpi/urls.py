@@ -16,8 +16,15 @@ urlpatterns = patterns('xpi.views',
         'get_test', name='jp_test_xpi'),
     url(r'^check_download/(?P<hashtag>[a-zA-Z0-9]+)/$',
         'check_download', name='jp_check_download_xpi'),
+    url(r'^wait/(?P<hashtag>[a-zA-Z0-9]+)/$',
+        'wait', name='jp_wait_xpi'),
     url(r'^download/(?P<hashtag>[a-zA-Z0-9]+)/(?P<filename>.*)/$',
         'get_download', name='jp_download_xpi'),
     url(r'^remove/(?P<path>.*)/$', 'clean', name='jp_rm_xpi'),
 
+    # build traces
+    url(r'^traces/$', 'traces', name='xpi_traces'),
+    url(r'^traces/(?P<hashtag>[a-zA-Z0-9]+)/$', 'traces',
+        name='xpi_trace'),
+
 )
@@ -1,34 +1,139 @@
 import os
 import commonware.log
-import codecs
 import simplejson
 import time
 from statsd import statsd
 
-from django.core.cache import cache
-from django.views.static import serve
-from django.http import HttpResponse, HttpResponseForbidden, HttpResponseServerError, HttpResponseNotFound
+from django.http import (Http404, HttpResponse, HttpResponseForbidden,
+        HttpResponseServerError, HttpResponseNotFound,
+        HttpResponseNotModified)
 from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import add_never_cache_headers
+from django.utils.http import parse_etags
 from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_POST
 from django.conf import settings
+from django.contrib.auth.decorators import user_passes_test
 
 from base.shortcuts import get_object_with_related_or_404
-from jetpack.models import PackageRevision, SDK
+from jetpack import sdk_registry
+from jetpack.models import PackageRevision
 from utils import validator
 from utils.helpers import get_random_string
-from xpi import xpi_utils
+from utils.wsgi import FileResponse
+from xpi import (artifacts, inflight, scheduler, status, tracing,
+                 xpi_utils)
 from xpi import tasks
 
 
 log = commonware.log.getLogger('f.xpi')
 
+
+def _get_fingerprint(revision, hashtag):
+    " returns build fingerprint of the saved ``revision`` or None "
+    try:
+        return revision.get_build_fingerprint()
+    except Exception, err:
+        log.warning('[xpi:%s] Unable to fingerprint revision (%s): %s' % (
+                    hashtag, revision.pk, str(err)))
+        return None
+
+
+def _queue_build(r, build_class, revision, hashtag, **kwargs):
+    " queue the build of ``revision`` in ``build_class`` (test or download) "
+    log.info('[xpi:%s] Addon added to queue' % hashtag)
+    task = (tasks.xpi_download_from_model if build_class == 'download'
+            else tasks.xpi_build_from_model)
+    tenqueue = time.time()
+    kwargs['hashtag'] = hashtag
+    scheduler.enqueue(task, build_class, scheduler.get_user(r),
+                      args=(revision.pk,), kwargs=kwargs)
+    tracing.add_span(hashtag, 'enqueue', tenqueue)
+
+
+def _queue_saved_build(r, build_class, revision, hashtag):
+    """Make the XPI built from saved ``revision`` available for ``hashtag``
+
+    The XPI is taken from the build cache, or from the build of the same
+    revision in flight. Only if neither is available is the build
+    queued.
+    """
+    status.queued(hashtag)
+    fingerprint = _get_fingerprint(revision, hashtag)
+    if fingerprint and xpi_utils.serve_cached_xpi(fingerprint, hashtag):
+        tracing.finish(hashtag)
+        return
+    if fingerprint and not inflight.join(fingerprint, hashtag):
+        return
+    _queue_build(r, build_class, revision, hashtag, fingerprint=fingerprint)
+
+
+def _send_xpi(r, path, mimetype):
+    """Stream the XPI or let the front-end server send it
+
+    ``XPI_SENDFILE_HEADER`` (``X-Sendfile`` or ``X-Accel-Redirect``)
+    hands the file over to the front-end server, otherwise it's returned
+    as :class:`utils.wsgi.FileResponse` which the WSGI script passes to
+    the server's ``wsgi.file_wrapper``. Raises ``IOError`` if the file does
+    not exist.
+
+    Responses may be cached (``XPI_CACHE_CONTROL``) and are revalidated
+    with ``If-None-Match``. The ETag is derived from the inode, XPIs are
+    never written in place (see :func:`xpi.artifacts.publish`), and not
+    from the mtime which is moved by pinning.
+    """
+    stat = os.stat(path)
+    etag = '"%x-%x-%x"' % (stat.st_dev, stat.st_ino, stat.st_size)
+    if_none_match = r.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (if_none_match.strip() == '*'
+                          or etag in parse_etags(if_none_match)):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = settings.XPI_CACHE_CONTROL
+        artifacts.touch(path)
+        return response
+    header = settings.XPI_SENDFILE_HEADER
+    if header:
+        response = HttpResponse(mimetype=mimetype)
+        if header == 'X-Accel-Redirect':
+            # nginx needs the URI of an internal location
+            path = '%s%s' % (settings.XPI_SENDFILE_PREFIX,
+                             os.path.relpath(path, settings.XPI_TARGETDIR))
+        response[header] = path
+    else:
+        response = FileResponse(open(path, 'rb'),
+                                settings.XPI_SENDFILE_BLOCK_SIZE,
+                                mimetype=mimetype)
+    response['Content-Length'] = str(stat.st_size)
+    response['ETag'] = etag
+    response['Cache-Control'] = settings.XPI_CACHE_CONTROL
+    artifacts.pin(path)
+    return response
+
+
+def _not_ready(content=''):
+    " response of the XPI which is not built yet, never cached "
+    response = HttpResponse(content)
+    add_never_cache_headers(response)
+    return response
+
+
+def _get_total(hashtag, tend=None):
+    " send and return the time since the build was requested "
+    ttotal = tracing.get_total(hashtag, tend)
+    if ttotal is None:
+        return 'n/a'
+    statsd.timing('xpi.build.total', ttotal)
+    return '%dms' % ttotal
+
+
 @csrf_exempt
 @require_POST
 def prepare_test(r, id_number, revision_number=None):
     """
     Test XPI from data saved in the database
     """
+    tstart = time.time()
     revision = get_object_with_related_or_404(PackageRevision,
                         package__id_number=id_number, package__type='a',
                         revision_number=revision_number)
@@ -54,16 +159,15 @@ def prepare_test(r, id_number, revision_number=None):
                 att_codes[str(att.pk)] = code
     if mod_codes or att_codes or not os.path.exists('%s.xpi' %
             os.path.join(settings.XPI_TARGETDIR, hashtag)):
-        log.info('[xpi:%s] Addon added to queue' % hashtag)
-        tqueued = time.time()
-        tkey = xpi_utils.get_queued_cache_key(hashtag, r)
-        cache.set(tkey, tqueued, 120)
-        tasks.xpi_build_from_model.delay(revision.pk,
-                mod_codes=mod_codes, att_codes=att_codes,
-                hashtag=hashtag, tqueued=tqueued)
+        tracing.start(hashtag, 'test', tstart, revision=revision.pk)
+        if not mod_codes and not att_codes:
+            _queue_saved_build(r, 'test', revision, hashtag)
+            return HttpResponse('{"delayed": true}')
+        status.queued(hashtag)
+        _queue_build(r, 'test', revision, hashtag, mod_codes=mod_codes,
+                     att_codes=att_codes)
     return HttpResponse('{"delayed": true}')
 
-@never_cache
 def get_test(r, hashtag):
     """
     return XPI file for testing
@@ -71,44 +175,33 @@ def get_test(r, hashtag):
     if not validator.is_valid('alphanum', hashtag):
         log.warning('[security] Wrong hashtag provided')
         return HttpResponseForbidden("{'error': 'Wrong hashtag'}")
-    base = os.path.join(settings.XPI_TARGETDIR, hashtag)
+    record = status.get(hashtag)
+    if not status.is_finished(record):
+        log.debug('[xpi:%s] Add-on not yet created' % hashtag)
+        return _not_ready()
+    if record['state'] == 'failed':
+        log.warning('Error creating xpi (%s)' % record['message'])
+        response = HttpResponseNotFound(record['message'])
+        add_never_cache_headers(response)
+        return response
     mimetype = 'text/plain; charset=x-user-defined'
     tfile = time.time()
     try:
-        xpi = codecs.open('%s.xpi' % base, mode='rb').read()
-    except Exception, err:
-        if os.path.exists('%s.json' % base):
-            with open('%s.json' % base) as error_file:
-                error_json = simplejson.loads(error_file.read())
-            os.remove('%s.json' % base)
-            if error_json['status'] == 'error':
-                log.warning('Error creating xpi (%s)'
-                        % error_json['message'] )
-                return HttpResponseNotFound(error_json['message'])
-
+        response = _send_xpi(r, os.path.join(settings.XPI_TARGETDIR,
+                                             '%s.xpi' % hashtag), mimetype)
+    except (IOError, OSError), err:
         log.debug('[xpi:%s] Add-on not yet created: %s' % (hashtag, str(err)))
-        return HttpResponse('')
+        return _not_ready()
 
     tend = time.time()
-    tread = (tend - tfile) * 1000
-    log.info('[xpi:%s] Add-on file found and read (%dms)' % (hashtag, tread))
+    tracing.add_poll_span(hashtag, tfile)
+    tread = tracing.add_span(hashtag, 'download', tfile, tend)
+    log.info('[xpi:%s] Add-on file found (%dms)' % (hashtag, tread))
     statsd.timing('xpi.build.fileread', tread)
 
-    # Clean up
-    if os.path.exists('%s.json' % base):
-        os.remove('%s.json' % base)
-
-    tkey = xpi_utils.get_queued_cache_key(hashtag, r)
-    tqueued = cache.get(tkey)
-    if tqueued:
-        ttotal = (tend - tqueued) * 1000
-        statsd.timing('xpi.build.total', ttotal)
-        total = '%dms' % ttotal
-    else:
-        total = 'n/a'
-
-    log.info('[xpi:%s] Downloading Add-on (%s)' % (hashtag, total))
-    return HttpResponse(xpi, mimetype=mimetype)
+    log.info('[xpi:%s] Downloading Add-on (%s)' % (hashtag,
+                                                    _get_total(hashtag, tend)))
+    return response
 
 @csrf_exempt
 @require_POST
@@ -117,6 +210,7 @@ def prepare_download(r, id_number, revision_number=None):
     Prepare download XPI.  This package is built asynchronously and we assume
     it works. It will be downloaded in ``get_download``
     """
+    tstart = time.time()
     revision = get_object_with_related_or_404(PackageRevision,
                         package__id_number=id_number, package__type='a',
                         revision_number=revision_number)
@@ -128,12 +222,8 @@ def prepare_download(r, id_number, revision_number=None):
     if not validator.is_valid('alphanum', hashtag):
         log.warning('[security] Wrong hashtag provided')
         return HttpResponseForbidden("{'error': 'Wrong hashtag'}")
-    log.info('[xpi:%s] Addon added to queue' % hashtag)
-    tqueued = time.time()
-    tkey = xpi_utils.get_queued_cache_key(hashtag, r)
-    cache.set(tkey, tqueued, 120)
-    tasks.xpi_build_from_model.delay(revision.pk, hashtag=hashtag,
-            tqueued=tqueued)
+    tracing.start(hashtag, 'download', tstart, revision=revision.pk)
+    _queue_saved_build(r, 'download', revision, hashtag)
     return HttpResponse('{"delayed": true}')
 
 
@@ -143,14 +233,38 @@ def check_download(r, hashtag):
     if not validator.is_valid('alphanum', hashtag):
         log.warning('[security] Wrong hashtag provided')
         return HttpResponseForbidden("{'error': 'Wrong hashtag'}")
-    path = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
-    # Check file if it exists
-    if os.path.isfile(path):
+    record = status.get(hashtag)
+    if record and record['state'] == 'done':
+        tracing.add_poll_span(hashtag)
         return HttpResponse('{"ready": true}')
     return HttpResponse('{"ready": false}')
 
 
 @never_cache
+def wait(r, hashtag):
+    """Wait until the XPI is built or ``XPI_WAIT_TIMEOUT`` passed
+
+    Used instead of polling :func:`check_download` and :func:`get_test`.
+    ``ready`` is false if the build is still running and the client should
+    wait again, ``wait`` is false if too many requests are waiting and the
+    client should ask again later.
+    """
+    if not validator.is_valid('alphanum', hashtag):
+        log.warning('[security] Wrong hashtag provided')
+        return HttpResponseForbidden("{'error': 'Wrong hashtag'}")
+    record, waited = status.wait(hashtag)
+    if not record:
+        return HttpResponse(simplejson.dumps({
+            'ready': False,
+            'wait': waited}), mimetype='application/json')
+    if record['state'] == 'done':
+        tracing.add_poll_span(hashtag)
+    return HttpResponse(simplejson.dumps({
+        'ready': True,
+        'status': record['status'],
+        'message': record['message']}), mimetype='application/json')
+
+
 def get_download(r, hashtag, filename):
     """
     Download XPI (it has to be ready)
@@ -161,21 +275,17 @@ def get_download(r, hashtag, filename):
     path = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
     log.info('[xpi:%s] Downloading Addon from %s' % (filename, path))
 
-    tend = time.time()
-    tkey = xpi_utils.get_queued_cache_key(hashtag, r)
-    tqueued = cache.get(tkey)
-    if tqueued:
-        ttotal = (tend - tqueued) * 1000
-        statsd.timing('xpi.build.total', ttotal)
-        total = '%dms' % ttotal
-    else:
-        total = 'n/a'
-
-    log.info('[xpi:%s] Downloading Add-on (%s)' % (hashtag, total))
+    tstart = time.time()
+    log.info('[xpi:%s] Downloading Add-on (%s)' % (hashtag,
+                                                    _get_total(hashtag)))
 
-    response = serve(r, path, '/', show_indexes=False)
+    try:
+        response = _send_xpi(r, path, 'application/x-xpinstall')
+    except (IOError, OSError):
+        raise Http404
     response['Content-Disposition'] = ('attachment; '
             'filename="%s.xpi"' % filename)
+    tracing.add_span(hashtag, 'download', tstart)
     return response
 
 
@@ -187,6 +297,7 @@ def clean(r, path):
         log.warning('[security] Wrong hashtag provided')
         return HttpResponseForbidden("{'error': 'Wrong hashtag'}")
     xpi_utils.remove(os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % path))
+    status.clear(path)
     return HttpResponse('{"success": true}', mimetype='application/json')
 
 
@@ -198,7 +309,7 @@ def repackage(r, amo_id, amo_file, target_version=None, sdk_dir=None):
     # validate entries
     # prepare data
     hashtag = get_random_string(10)
-    sdk = SDK.objects.all()[0]
+    sdk = sdk_registry.get_latest()
     # if (when?) choosing sdk_dir will be possible
     # sdk = SDK.objects.get(dir=sdk_dir) if sdk_dir else SDK.objects.all()[0]
     sdk_source_dir = sdk.get_source_dir()
@@ -213,3 +324,28 @@ def repackage(r, amo_id, amo_file, target_version=None, sdk_dir=None):
     # /xpi/download/{hashtag}/{desired_filename}/
     return HttpResponse('{"hashtag": "%s"}' % hashtag,
             mimetype='application/json')
+
+
+@never_cache
+@user_passes_test(lambda u: u.is_superuser)
+def traces(r, hashtag=None):
+    """Return the build trace of ``hashtag`` or recent traces with
+    histograms of their spans
+    """
+    if hashtag:
+        if not validator.is_valid('alphanum', hashtag):
+            log.warning('[security] Wrong hashtag provided')
+            return HttpResponseForbidden("{'error': 'Wrong hashtag'}")
+        trace = tracing.get(hashtag)
+        if not trace:
+            return HttpResponseNotFound('{"error": "No trace"}',
+                                        mimetype='application/json')
+        return HttpResponse(simplejson.dumps(trace),
+                            mimetype='application/json')
+    recent = tracing.get_recent()
+    return HttpResponse(simplejson.dumps({
+        'queues': scheduler.get_depths(),
+        'running': scheduler.get_running(),
+        'traces': recent,
+        'histograms': tracing.get_histograms()}),
+        mimetype='application/json')
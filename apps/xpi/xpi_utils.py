@@ -6,7 +6,6 @@ import os
 import rdflib
 import re
 import shutil
-import simplejson
 import subprocess
 import tempfile
 import time
@@ -21,17 +20,12 @@ from django.conf import settings
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext as _
 
-log = commonware.log.getLogger('f.xpi_utils')
+from xpi import artifacts, engine, library_cache, pool, status, tracing
 
+log = commonware.log.getLogger('f.xpi_utils')
 
-def info_write(path, status, message, hashtag=None):
-    data = {
-        'status': status,
-        'message': str(message)}
-    if hashtag:
-        data['hashtag'] = hashtag
-    with open(path, 'w') as info:
-        info.write(simplejson.dumps(data))
+#: entries of the SDK copied into the workspace, they're written by cfx
+SDK_WORKSPACE_COPIED = ('python-lib',)
 
 
 def sdk_copy(sdk_source, sdk_dir):
@@ -48,9 +42,62 @@ def sdk_copy(sdk_source, sdk_dir):
             shutil.copytree(sdk_source, sdk_dir)
 
 
+def sdk_workspace(sdk_source, sdk_dir):
+    """Prepare a writable SDK tree in ``sdk_dir`` without copying the SDK
+
+    Every entry of the SDK is symlinked. ``packages`` and ``KEYDIR`` are
+    created as real directories with the SDK's content linked inside, so
+    packages and keys of the built add-on are the only files written.
+    ``python-lib`` is copied, ``cfx`` writes compiled modules into it.
+    Falls back to :func:`sdk_copy` if ``SDK_WORKSPACE_LINKS`` is off.
+
+    Linked SDK packages have to be replaced with :func:`unlink_package`
+    before anything is written into them.
+    """
+    if not settings.SDK_WORKSPACE_LINKS or not hasattr(os, 'symlink'):
+        return sdk_copy(sdk_source, sdk_dir)
+    sdk_source = os.path.abspath(sdk_source)
+    log.debug("Linking SDK from (%s) to (%s)" % (sdk_source, sdk_dir))
+    with statsd.timer('xpi.workspace'):
+        if not os.path.isdir(sdk_dir):
+            os.makedirs(sdk_dir)
+        for d in os.listdir(sdk_source):
+            s_d = os.path.join(sdk_source, d)
+            t_d = os.path.join(sdk_dir, d)
+            if d in ('packages', settings.KEYDIR) and os.path.isdir(s_d):
+                os.mkdir(t_d)
+                for p in os.listdir(s_d):
+                    os.symlink(os.path.join(s_d, p), os.path.join(t_d, p))
+            elif d in SDK_WORKSPACE_COPIED and os.path.isdir(s_d):
+                shutil.copytree(s_d, t_d)
+            else:
+                os.symlink(s_d, t_d)
+
+
+def is_sdk_link(package_dir):
+    """Is ``package_dir`` an SDK package linked by :func:`sdk_workspace`?
+
+    Libraries linked by :mod:`xpi.library_cache` are not.
+    """
+    return (os.path.islink(package_dir)
+            and not library_cache.is_export(package_dir))
+
 
+def unlink_package(package_dir):
+    """Replace the SDK package linked by :func:`sdk_workspace` with its copy
 
-def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
+    :returns: (bool) True if the package was linked
+    """
+    if not os.path.islink(package_dir):
+        return False
+    source = os.path.realpath(package_dir)
+    os.remove(package_dir)
+    shutil.copytree(source, package_dir)
+    return True
+
+
+def build(sdk_dir, package_dir, filename, hashtag, tstart=None,
+          sdk_source=None):
     """Build xpi from SDK with prepared packages in sdk_dir.
 
     :params:
@@ -60,6 +107,8 @@ def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
         * hashtag (string) XPI will be copied to a file which name is creted
           using the unique hashtag
         * t1 (integer) time.time() of the process started
+        * sdk_source (String) directory the SDK was copied from, used to
+          reuse imported ``cuddlefish`` if ``XPI_BUILD_IN_PROCESS``
 
     :returns: (list) ``cfx xpi`` response where ``[0]`` is ``stdout`` and
               ``[1]`` ``stderr``
@@ -67,9 +116,8 @@ def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
 
     t1 = time.time()
 
-    # create XPI
-    os.chdir(package_dir)
-
+    # create XPI, cfx is run from the package_dir (it is not set as the cwd
+    # of the process, builds might run in parallel threads)
     # @TODO xulrunner should be a config variable
     cfx = [settings.PYTHON_EXEC, '%s/bin/cfx' % sdk_dir,
            '--binary=/usr/bin/xulrunner',
@@ -77,8 +125,19 @@ def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
 
     log.debug(cfx)
 
-    info_targetfilename = "%s.json" % hashtag
-    info_targetpath = os.path.join(settings.XPI_TARGETDIR, info_targetfilename)
+    if settings.XPI_BUILD_POOL_ADDRESS or settings.XPI_BUILD_IN_PROCESS:
+        if settings.XPI_BUILD_POOL_ADDRESS:
+            run_cfx = pool.run_cfx
+        else:
+            run_cfx = engine.run_cfx
+        result = run_cfx(sdk_source or sdk_dir, sdk_dir, package_dir,
+                         cfx[2:])
+        if result.error:
+            log.critical("[xpi:%s] cfx failed in process: %s" % (
+                         hashtag, result.error))
+        response = result.get_response()
+        return _finish_build(response, sdk_dir, package_dir, filename,
+                             hashtag, t1, tstart)
 
     env = dict(PATH='%s/bin:%s' % (sdk_dir, os.environ['PATH']),
                VIRTUAL_ENV=sdk_dir,
@@ -86,18 +145,33 @@ def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
                PYTHONPATH=os.path.join(sdk_dir, 'python-lib'))
     try:
         process = subprocess.Popen(cfx, shell=False, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, env=env)
+                                   stderr=subprocess.PIPE, env=env,
+                                   cwd=package_dir)
         response = process.communicate()
     except subprocess.CalledProcessError, err:
-        info_write(info_targetpath, 'error', str(err), hashtag)
+        status.finish(hashtag, 'error', str(err))
         log.critical("[xpi:%s] Failed to build xpi: %s.  Command(%s)" % (
                      hashtag, str(err), cfx))
         shutil.rmtree(sdk_dir)
+        tracing.finish(hashtag, error='cfx')
         raise
+    return _finish_build(response, sdk_dir, package_dir, filename, hashtag,
+                         t1, tstart)
+
+
+def _finish_build(response, sdk_dir, package_dir, filename, hashtag, t1,
+                  tstart=None):
+    """Copy the XPI created by ``cfx`` to ``XPI_TARGETDIR``, record times and
+    status
+
+    :returns: (list) ``cfx xpi`` response
+    """
     if response[1]:
-        info_write(info_targetpath, 'error', response[1], hashtag)
+        status.finish(hashtag, 'error', response[1])
         log.critical("[xpi:%s] Failed to build xpi." % hashtag)
         shutil.rmtree(sdk_dir)
+        tracing.add_span(hashtag, 'cfx', t1)
+        tracing.finish(hashtag, error='cfx')
         return response
 
     t2 = time.time()
@@ -106,15 +180,17 @@ def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
     xpi_path = os.path.join(package_dir, "%s.xpi" % filename)
     xpi_targetfilename = "%s.xpi" % hashtag
     xpi_targetpath = os.path.join(settings.XPI_TARGETDIR, xpi_targetfilename)
-    shutil.copy(xpi_path, xpi_targetpath)
+    # never written in place, the previous file might be linked from a store
+    artifacts.publish(xpi_path, xpi_targetpath, link=False)
     shutil.rmtree(sdk_dir)
+    artifacts.add('target', xpi_targetpath)
 
     ret = [xpi_targetfilename]
     ret.extend(response)
 
     t3 = time.time()
-    copy_xpi_time = (t3 - t2) * 1000
-    build_time = (t2 - t1) * 1000
+    build_time = tracing.add_span(hashtag, 'cfx', t1, t2)
+    copy_xpi_time = tracing.add_span(hashtag, 'copy', t2, t3)
     preparation_time = ((t1 - tstart) * 1000) if tstart else 0
 
     statsd.timing('xpi.build.prep', preparation_time)
@@ -125,7 +201,8 @@ def build(sdk_dir, package_dir, filename, hashtag, tstart=None):
                                         preparation_time, build_time,
                                         copy_xpi_time))
 
-    info_write(info_targetpath, 'success', response[0], hashtag)
+    status.finish(hashtag, 'success', response[0])
+    tracing.finish(hashtag, t3)
 
     return response
 
@@ -135,7 +212,84 @@ def remove(path):
     log.debug("Removing directory (%s)" % path)
     os.remove(path)
 
-def get_queued_cache_key(hashtag, request=None):
-    session = request.session.session_key if request else None
-    key = 'xpi:timing:queued:%s:%s' % (hashtag, session)
-    return key
+
+def hash_file(digest, path, chunk_size=65536):
+    """Feed ``digest`` with the content of the file under ``path``
+
+    :params:
+        * digest (hashlib object)
+        * path (String) absolute path of the file
+    """
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def get_cached_xpi_path(fingerprint):
+    " returns the path of the XPI build from content hashed to fingerprint "
+    return os.path.join(settings.XPI_CACHE_DIR, '%s.xpi' % fingerprint)
+
+
+def cache_xpi(xpi_path, fingerprint):
+    """Store the built XPI in the build cache
+
+    The file is copied under a temporary name and renamed, so readers never
+    see a partially written artifact.
+
+    :params:
+        * xpi_path (String) path of the successfully built XPI
+        * fingerprint (String) result of
+          :meth:`jetpack.models.PackageRevision.get_build_fingerprint`
+    """
+    if not settings.XPI_CACHE_DIR or not fingerprint:
+        return
+    if not os.path.isdir(settings.XPI_CACHE_DIR):
+        os.makedirs(settings.XPI_CACHE_DIR)
+    cached_path = get_cached_xpi_path(fingerprint)
+    if os.path.isfile(cached_path):
+        return
+    fd, temp_path = tempfile.mkstemp(dir=settings.XPI_CACHE_DIR)
+    os.close(fd)
+    try:
+        shutil.copy(xpi_path, temp_path)
+        os.rename(temp_path, cached_path)
+        artifacts.add('cache', cached_path)
+    except Exception, err:
+        log.warning("[xpi] Failed to cache xpi (%s): %s" % (
+                    fingerprint, str(err)))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    log.debug("[xpi] Cached xpi (%s)" % fingerprint)
+
+
+def serve_cached_xpi(fingerprint, hashtag):
+    """Make the cached XPI available as if it was built for ``hashtag``
+
+    :returns: (bool) True if XPI was found in the build cache
+    """
+    if not settings.XPI_CACHE_DIR or not fingerprint:
+        return False
+    cached_path = get_cached_xpi_path(fingerprint)
+    if not os.path.isfile(cached_path):
+        statsd.incr('xpi.cache.miss')
+        return False
+    xpi_targetpath = os.path.join(settings.XPI_TARGETDIR, '%s.xpi' % hashtag)
+    try:
+        # cache and target are usually on the same device
+        artifacts.publish(cached_path, xpi_targetpath)
+        artifacts.touch(cached_path)
+        artifacts.add('target', xpi_targetpath)
+    except Exception, err:
+        # an evicted artifact is just a cache miss
+        log.warning("[xpi:%s] Failed to serve cached xpi (%s): %s" % (
+                    hashtag, fingerprint, str(err)))
+        statsd.incr('xpi.cache.miss')
+        return False
+    status.finish(hashtag, 'success', 'XPI served from the build cache')
+    statsd.incr('xpi.cache.hit')
+    log.info("[xpi:%s] Served from build cache (%s)" % (hashtag, fingerprint))
+    return True
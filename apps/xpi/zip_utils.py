@@ -0,0 +1,58 @@
+"""
+xpi.zip_utils
+-------------
+
+Copying members between zip archives without recompressing them.
+"""
+import struct
+import zipfile
+
+
+def read_raw(zf, info):
+    """Read compressed data of the member
+
+    :params:
+        * zf (ZipFile) archive opened for reading
+        * info (ZipInfo) member of the archive
+
+    :returns: (String) compressed bytes
+    """
+    zf.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           zf.fp.read(zipfile.sizeFileHeader))
+    # local header might have different extra field than the central one
+    zf.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+               header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    return zf.fp.read(info.compress_size)
+
+
+def write_raw(zf, info, data):
+    """Append the member with already compressed ``data``
+
+    :params:
+        * zf (ZipFile) archive opened for writing
+        * info (ZipInfo) describes the member - ``CRC``, ``file_size``,
+          ``compress_size`` and ``compress_type`` have to match ``data``
+        * data (String) compressed bytes
+    """
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.external_attr = info.external_attr
+    zinfo.create_system = info.create_system
+    # there is no data descriptor after the data
+    zinfo.flag_bits = info.flag_bits & ~0x08
+    zinfo.CRC = info.CRC
+    zinfo.file_size = info.file_size
+    zinfo.compress_size = len(data)
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def copy_member(source, info, target):
+    " copy member ``info`` of the ``source`` archive to ``target`` "
+    write_raw(target, info, read_raw(source, info))
@@ -1,5 +1,11 @@
 
 import os, sys, re
+import errno
+import hashlib
+import stat
+import tempfile
+import simplejson as json
+from cStringIO import StringIO
 
 COMMENT_PREFIXES = ["//", "/*", "*", "\'", "\""]
 
@@ -116,6 +122,136 @@ def scan_package(pkg_name, dirname, stderr=sys.stderr):
                 has_problems = True
     return manifest, has_problems
 
+def is_private_dir(directory):
+    """The directory and its parents (up to a sticky one like /tmp) are
+    owned by root or the current user and nobody else can write into them
+    """
+    path = os.path.abspath(directory)
+    while True:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_uid not in (0, os.getuid()):
+            return False
+        if st.st_mode & stat.S_ISVTX:
+            return True
+        if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return False
+        parent = os.path.dirname(path)
+        if parent == path:
+            return True
+        path = parent
+
+class ScanCache(object):
+    """Results of scan_module() keyed by the name and content of the file
+
+    Results are kept in memory and, if directory is given, on disk so
+    processes can share them. They are stored as JSON, the directory is
+    used only if nobody else can write into it (see is_private_dir). Scans
+    which print to stderr are not cached, so the warnings are shown every
+    time. Files read from the directory are touched, on_set(path) is called
+    with every file written to it so the caller can keep the directory
+    within a budget. At most max_results are kept in memory, they're
+    dropped at once when the limit is reached.
+    """
+
+    def __init__(self, directory=None, on_set=None, max_results=5000):
+        if directory:
+            try:
+                os.makedirs(directory, 0755)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    directory = None
+            if directory and not is_private_dir(directory):
+                directory = None
+        self.directory = directory
+        self.on_set = on_set
+        self.max_results = max_results
+        self.results = {}
+
+    def get_key(self, fn, lines):
+        digest = hashlib.sha1(os.path.basename(fn))
+        digest.update("\0")
+        for line in lines:
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+            digest.update(line)
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, "%s.scan" % key)
+
+    def get(self, key):
+        if key in self.results:
+            return self.results[key]
+        if not self.directory:
+            return None
+        try:
+            f = open(self.get_path(key), "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                result = tuple(json.load(f))
+            except Exception:
+                return None
+        finally:
+            f.close()
+        try:
+            os.utime(self.get_path(key), None)
+        except OSError:
+            pass
+        self.remember(key, result)
+        return result
+
+    def remember(self, key, result):
+        if len(self.results) >= self.max_results:
+            self.results.clear()
+        self.results[key] = result
+
+    def set(self, key, result):
+        self.remember(key, result)
+        if not self.directory:
+            return
+        path = self.get_path(key)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            f = os.fdopen(fd, "wb")
+            try:
+                json.dump(result, f)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            return
+        if self.on_set:
+            self.on_set(path)
+
+    def wrap(self, scan):
+        def cached_scan_module(fn, lines, stderr=sys.stderr):
+            key = self.get_key(fn, lines)
+            result = self.get(key)
+            if result is None:
+                output = StringIO()
+                result = scan(fn, lines, output)
+                if output.getvalue():
+                    stderr.write(output.getvalue())
+                else:
+                    self.set(key, result)
+            return result
+        cached_scan_module.scan_cache = self
+        return cached_scan_module
+
+def memoize_scan_module(module, directory=None, on_set=None):
+    """Cache scan_module() of the manifest module (of any SDK version, its
+    scan_module has to accept (fn, lines, stderr)). Files do not have to be
+    scanned again as long as their content does not change."""
+    scan = getattr(module, "scan_module", None)
+    if scan is None or hasattr(scan, "scan_cache"):
+        return
+    module.scan_module = ScanCache(directory, on_set).wrap(scan)
+
 if __name__ == '__main__':
     for fn in sys.argv[1:]:
         requires,chrome,problems = scan_module(fn, open(fn).readlines())
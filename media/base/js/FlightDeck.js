@@ -84,7 +84,8 @@ var FlightDeck = new Class({
         try_in_browser_class: 'XPI_test',
         xpi_hashtag: '',        // hashtag for the XPI creation
         max_request_number: 50, // how many times should system try to download XPI
-        request_interval: 2000  // try to download XPI every 2 sec
+        request_interval: 2000, // try to download XPI every 2 sec
+        max_wait_number: 15     // how many times should system wait for the XPI
         //user: ''
     },
     initialize: function() {
@@ -182,15 +183,68 @@ var FlightDeck = new Class({
      * Method: downloadXPI it's running in Request's scope
      */
     downloadXPI: function(response) {
-        var time = fd.options.request_interval
-        
-        $log('FD: DEBUG: XPI delayed ... try to load every ' + time/1000 + ' seconds' );
+        $log('FD: DEBUG: XPI delayed ... waiting for the build');
         var hashtag = this.options.data.hashtag;
         var filename = this.options.data.filename;
-        fd.tests[hashtag].download_request_number = 0;
-        
-        fd.tests[hashtag].download_ID = fd.tryDownloadXPI.periodical(
-                time, fd, [hashtag, filename]);
+        var test_request = fd.tests[hashtag];
+        test_request.download_request_number = 0;
+
+        fd.waitForXPI(hashtag, function() {
+            test_request.spinner.destroy();
+            var url = '/xpi/download/'+hashtag+'/'+filename+'/';
+            $log('FD: downloading ' + filename + '.xpi from ' + url );
+            window.open(url, 'dl');
+        }, function(response) {
+            if (response) {
+                test_request.spinner.destroy();
+                fd.error.alert('Add-on Builder', response.message);
+            } else {
+                // fall back to polling
+                test_request.download_ID = fd.tryDownloadXPI.periodical(
+                        fd.options.request_interval, fd, [hashtag, filename]);
+            }
+        });
+    },
+
+    /*
+     * Method: waitForXPI
+     *
+     * Wait for the build of the XPI to finish, the server responds as soon
+     * as it's finished
+     * onReady is called if XPI was built, onFailure with the response
+     * if the build failed or without arguments if waiting failed
+     */
+    waitForXPI: function(hashtag, onReady, onFailure) {
+        var wait_number = 0;
+        var wait = function() {
+            wait_number++;
+            var url = '/xpi/wait/'+hashtag+'/';
+            $log('FD: DEBUG: waiting for ' + url);
+            new Request.JSON({
+                method: 'get',
+                url: url,
+                onSuccess: function(response) {
+                    if (!response.ready) {
+                        if (wait_number >= fd.options.max_wait_number) {
+                            onFailure();
+                        } else if (response.wait) {
+                            wait();
+                        } else {
+                            // server is busy, ask again later
+                            wait.delay(fd.options.request_interval);
+                        }
+                    } else if (response.status == 'success') {
+                        onReady();
+                    } else {
+                        onFailure(response);
+                    }
+                },
+                onFailure: function() {
+                    onFailure();
+                }
+            }).send();
+        };
+        wait();
     },
 
     /*
@@ -234,12 +288,22 @@ var FlightDeck = new Class({
      * Method: testXPI it's running in Request's scope
      */
     testXPI: function(response) {
-        $log('FD: DEBUG: XPI delayed ... try to load every ' + fd.options.request_interval/1000 + ' seconds' );
+        $log('FD: DEBUG: XPI delayed ... waiting for the build');
         var hashtag = this.options.data.hashtag;
         fd.tests[hashtag].request_number = 0;
-        fd.tryInstallXPI.delay(1000, fd, hashtag);
-        fd.tests[hashtag].install_ID = fd.tryInstallXPI.periodical(
-                fd.options.request_interval, fd, hashtag);
+        var install = function() {
+            // failed build is reported by /xpi/test/
+            fd.tryInstallXPI(hashtag);
+        };
+        fd.waitForXPI(hashtag, install, function(response) {
+            if (response) {
+                install();
+            } else {
+                // fall back to polling
+                fd.tests[hashtag].install_ID = fd.tryInstallXPI.periodical(
+                        fd.options.request_interval, fd, hashtag);
+            }
+        });
     },
 
     isXpiInstalled: function() {
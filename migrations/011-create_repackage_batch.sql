@@ -0,0 +1,23 @@
+CREATE TABLE `repackage_batchjob` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `uuid` varchar(255) NOT NULL,
+  `sdk_version` varchar(10) NOT NULL,
+  `created_at` datetime NOT NULL,
+  `modified_at` datetime NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `uuid` (`uuid`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `repackage_batchitem` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `job_id` int(11) NOT NULL,
+  `key` varchar(32) NOT NULL,
+  `hashtag` varchar(255) NOT NULL,
+  `state` varchar(10) NOT NULL,
+  `message` longtext NOT NULL,
+  `modified_at` datetime NOT NULL,
+  `finished_at` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `job_id` (`job_id`,`key`),
+  CONSTRAINT `job_id_refs_id_batchjob` FOREIGN KEY (`job_id`) REFERENCES `repackage_batchjob` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -111,7 +111,31 @@ DEFAULT_PACKAGE_SUFFIX = {
 HOMEPAGE_PACKAGES_NUMBER = 3
 
 SDKDIR_PREFIX = tempfile.gettempdir()   # removed after xpi is created
-XPI_TARGETDIR = tempfile.gettempdir()   # target dir - in shared directory
+# build artifacts and caches, evicted by their byte budgets (see
+# xpi.artifacts) - never pruned by the gc cron job, keep it out of the
+# directories it prunes. It has to be owned by the user running FlightDeck
+# and writable only by it, the scan cache is not used otherwise
+ARTIFACTS_ROOT = os.path.join(tempfile.gettempdir(),
+                              'flightdeck-%d' % os.getuid())
+# target dir - in shared directory
+XPI_TARGETDIR = os.path.join(ARTIFACTS_ROOT, 'xpi')
+# content-addressed store of built XPIs - in shared directory
+# set to None to always build
+XPI_CACHE_DIR = os.path.join(ARTIFACTS_ROOT, 'xpi_cache')
+# last XPI built for every revision, patched by test builds with edited
+# modules and attachments (see xpi.incremental) - set to None to disable
+XPI_INCREMENTAL_DIR = os.path.join(ARTIFACTS_ROOT, 'xpi_incremental')
+# library revisions exported once and linked into builds (see
+# xpi.library_cache) - set to None to export them in every build
+LIBRARY_EXPORT_DIR = os.path.join(ARTIFACTS_ROOT, 'library_exports')
+LIBRARY_EXPORT_MAX_SIZE = 512 * 1024 * 1024  # 512MB
+# link SDK files into the build directory instead of copying them
+SDK_WORKSPACE_LINKS = True
+# SDKs are kept in every process (see jetpack.sdk_registry) and reloaded
+# when another process changes them - this needs a cache shared by web and
+# celery processes, otherwise the database is checked every
+# SDK_REGISTRY_CHECK_INTERVAL seconds
+SDK_REGISTRY_CHECK_INTERVAL = 10  # seconds
 
 LIBRARY_AUTOCOMPLETE_LIMIT = 20
 KEYDIR = 'keydir'
@@ -124,6 +148,91 @@ JETPACK_DATA_DIR = 'data'
 ATTACHMENT_MAX_FILESIZE = 2 * 1024 * 1024  # 2MB
 
 PYTHON_EXEC = 'python'
+# run cfx inside the worker process instead of spawning PYTHON_EXEC for every
+# build (see xpi.engine)
+XPI_BUILD_IN_PROCESS = False
+# send cfx runs to the pre-forked build processes (./manage.py xpi_build_pool)
+# listening on this address (path of the unix socket or (host, port))
+XPI_BUILD_POOL_ADDRESS = None
+# secret shared by the pool and its clients, required with the address
+XPI_BUILD_POOL_AUTHKEY = None
+XPI_BUILD_POOL_SIZE = 4
+XPI_BUILD_POOL_TIMEOUT = 60  # seconds
+# SDK files compressed once per SDK and copied into every XPI built in
+# process (see xpi.segment) - set to None to compress them in every build
+XPI_SEGMENT_DIR = os.path.join(ARTIFACTS_ROOT, 'xpi_segments')
+# require() and chrome scans of SDK files shared by processes building in
+# process (see cuddlefish.manifest.ScanCache) - set to None to keep in memory
+XPI_SCAN_CACHE_DIR = os.path.join(ARTIFACTS_ROOT, 'xpi_scan_cache')
+# build status registry (see xpi.status) - 'cache' keeps it in the Django
+# cache, 'local' in the memory of the process (only for a single web process
+# with eager celery)
+XPI_STATUS_STORAGE = 'cache'
+XPI_STATUS_TIMEOUT = 60 * 60  # seconds
+# /xpi/wait/ responds after the build finished or after XPI_WAIT_TIMEOUT
+XPI_WAIT_TIMEOUT = 20  # seconds
+XPI_WAIT_INTERVAL = 0.25  # seconds between reads of the status
+# requests waiting at once (counted in the cache), others are answered
+# right away and the client asks again after request_interval
+XPI_WAIT_MAX = 50
+
+# XPIs are sent by the front-end server if set to 'X-Sendfile' (Apache,
+# lighttpd) or 'X-Accel-Redirect' (nginx), streamed by Django otherwise
+XPI_SENDFILE_HEADER = None
+# internal nginx location serving XPI_TARGETDIR (X-Accel-Redirect only)
+XPI_SENDFILE_PREFIX = '/xpi-files/'
+# block size of XPIs streamed through wsgi.file_wrapper (see utils.wsgi)
+XPI_SENDFILE_BLOCK_SIZE = 64 * 1024
+# XPIs may be cached by browsers and revalidated with their ETag - the same
+# hashtag is rebuilt in edit mode, use 'public, ...' to let shared proxies
+# keep them as well
+XPI_CACHE_CONTROL = 'private, max-age=0, must-revalidate'
+
+# concurrent builds of the same revision are coalesced for XPI_INFLIGHT_TIMEOUT
+# seconds (see xpi.inflight)
+XPI_INFLIGHT_TIMEOUT = 10 * 60
+# running builds keep their lead for XPI_INFLIGHT_LEADER_TIMEOUT seconds, the
+# next request is elected the leader if the worker dies
+XPI_INFLIGHT_LEADER_TIMEOUT = 30
+
+# builds of a user with more than XPI_FAIR_FREE_BUILDS builds waiting in the
+# same class are delayed by XPI_FAIR_DELAY seconds for each waiting build
+XPI_FAIR_FREE_BUILDS = 2
+XPI_FAIR_DELAY = 2
+# queue depth counters expire after XPI_QUEUE_TIMEOUT seconds
+XPI_QUEUE_TIMEOUT = 60 * 60
+# maximum number of builds of every class running at once across all workers,
+# tasks over the share are queued again after XPI_SHARE_RETRY_DELAY seconds
+# (slots are kept in the cache, not enforced with CELERY_ALWAYS_EAGER)
+XPI_CLASS_SHARES = {
+    'test': 8,
+    'download': 4,
+    'bulk': 2,
+}
+XPI_SHARE_RETRY_DELAY = 1  # seconds
+# slots of the share expire unless the running build refreshes them, slots
+# of crashed workers are free again after XPI_SLOT_TIMEOUT
+XPI_SLOT_TIMEOUT = 60  # seconds
+
+# byte budgets of directories holding XPIs, least recently used are removed
+# down to XPI_ARTIFACT_LOW_WATER of the budget (see xpi.artifacts)
+XPI_TARGETDIR_MAX_SIZE = 2 * 1024 * 1024 * 1024
+XPI_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+XPI_INCREMENTAL_MAX_SIZE = 1024 * 1024 * 1024
+XPI_SCAN_CACHE_MAX_SIZE = 64 * 1024 * 1024
+XPI_ARTIFACT_LOW_WATER = 0.9
+# downloaded XPIs are not removed for XPI_ARTIFACT_PIN_TIMEOUT seconds (their
+# mtime is set to the end of the pin)
+XPI_ARTIFACT_PIN_TIMEOUT = 10 * 60
+# directories are listed at most once per interval if the size is unknown
+XPI_ARTIFACT_EVICTION_INTERVAL = 60  # seconds
+
+# build traces kept in the cache (see xpi.tracing)
+XPI_TRACE_TIMEOUT = 60 * 60  # seconds
+XPI_TRACE_RECENT = 500  # number of traces listed in /xpi/traces/
+# export only manifests and modules, stream attachments into the XPI written
+# straight to XPI_TARGETDIR (see xpi.assembler), cfx is run in process
+XPI_ASSEMBLER = False
 
 # amo defaults
 XPI_AMO_PREFIX = "ftp://ftp.mozilla.org/pub/mozilla.org/addons/"
@@ -135,6 +244,26 @@ AUTH_DATABASE = None
 AMO_SECRET_KEY = "notsecure"
 # add directory to desired SDK else latest imported SDK will be used
 REPACKAGE_SDK_SOURCE = None
+# XPIs to rebuild are streamed to disk in chunks, bigger XPIs are rejected
+REPACKAGE_MAX_XPI_SIZE = 50 * 1024 * 1024  # bytes, 0 for no limit
+REPACKAGE_CHUNK_SIZE = 64 * 1024  # bytes
+# XPIs downloaded for rebuilds, revalidated with conditional requests
+# (see repackage.download_cache) - set to None to always download
+REPACKAGE_DOWNLOAD_CACHE_DIR = os.path.join(ARTIFACTS_ROOT,
+                                            'repackage_downloads')
+REPACKAGE_DOWNLOAD_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# undelivered pingbacks are retried after REPACKAGE_PINGBACK_BACKOFF seconds,
+# doubled with every attempt (see repackage.pingbacks)
+REPACKAGE_PINGBACK_RETRIES = 5
+REPACKAGE_PINGBACK_BACKOFF = 10  # seconds
+# results for the same pingback URL are collected for this many seconds and
+# posted together, 0 posts every result on its own
+REPACKAGE_PINGBACK_WINDOW = 5  # seconds
+# add-ons of low priority bulk rebuilds are rebuilt in batches of this size
+# by repackage.tasks.batch_rebuild, 0 queues a task per add-on
+REPACKAGE_BATCH_SIZE = 0
+# number of add-ons of a batch rebuilt in parallel
+REPACKAGE_BATCH_CONCURRENCY = 4
 
 BUILDER_SECRET_KEY = 'notsecure'
 DOMAIN = "builder.addons.mozilla.org"
@@ -314,8 +443,19 @@ djcelery.setup_loader()
 CELERY_ALWAYS_EAGER = True
 CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 
+# Each class of builds has its own queue (see xpi.scheduler). Give every
+# queue at least its share (XPI_CLASS_SHARES) of workers, i.e.
+#   celeryd -Q builder_test -c 8
+#   celeryd -Q builder_download -c 4
+#   celeryd -Q builder_bulk -c 2
+# Pingbacks to AMO are delivered by workers of the pingback queue.
 CELERY_ROUTES = {
+    'xpi.tasks.xpi_build_from_model': {'queue': 'builder_test'},
+    'xpi.tasks.xpi_download_from_model': {'queue': 'builder_download'},
     'repackage.tasks.low_rebuild': {'queue': 'builder_bulk'},
+    'repackage.tasks.batch_rebuild': {'queue': 'builder_bulk'},
+    'repackage.tasks.deliver_pingbacks': {'queue': 'pingback'},
+    'repackage.tasks.deliver_queued_pingbacks': {'queue': 'pingback'},
 }
 
 ENGAGE_ROBOTS = False
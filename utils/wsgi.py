@@ -0,0 +1,41 @@
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse
+
+
+class FileResponse(HttpResponse):
+    """Response streaming an open file
+
+    Django returns the response object itself to the WSGI server, which
+    can't offload it. :func:`get_wsgi_body` (called by the WSGI script)
+    returns ``file_to_stream`` wrapped in the server's ``wsgi.file_wrapper``
+    instead, so the server may send it with ``sendfile``.
+    """
+
+    def __init__(self, file_to_stream, block_size=8192, **kwargs):
+        super(FileResponse, self).__init__(
+                FileWrapper(file_to_stream, block_size), **kwargs)
+        self.file_to_stream = file_to_stream
+        self.block_size = block_size
+
+
+class _ResponseFile(object):
+    """Streamed file of the response, closing the response (and sending
+    ``request_finished``) when the WSGI server closes it
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def __getattr__(self, name):
+        return getattr(self.response.file_to_stream, name)
+
+    def close(self):
+        self.response.close()
+
+
+def get_wsgi_body(environ, response):
+    " returns the iterable passed to the WSGI server for the response "
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper and getattr(response, 'file_to_stream', None):
+        return file_wrapper(_ResponseFile(response), response.block_size)
+    return response